@@ -31,9 +31,10 @@ from django.contrib.auth.models import User
 from django.contrib.contenttypes import fields
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.postgres.fields import ArrayField
+from django.core.cache import caches
 from django.db import models, transaction
 from django.db.models import Q
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from django.urls import reverse
 from django.utils.encoding import smart_unicode
@@ -795,3 +796,56 @@ def updated_status_history(sender, instance, **kwargs):
     # Automatically update the username_from field if user_from is set
     if instance.user_from is not None and not instance.user_from.profile.is_anonymized_user:
         instance.username_from = instance.user_from.username
+
+
+def get_gate_state_cache_key(user_id):
+    return 'user-gate-state-%s' % user_id
+
+
+def get_user_gate_state(user):
+    """Returns a dictionary with the profile information used by the middleware to decide if a user needs to be
+    redirected (see freesound.middleware.UserGateHandler) and to record online users. If settings.USER_GATE_STATE_CACHE
+    is set, the dictionary is cached there for settings.USER_GATE_STATE_CACHE_TIME seconds and invalidated when the
+    relevant Profile, EmailBounce or SameUser objects change (see signals below), so the profile does not need to be
+    loaded on every request. The cache must be shared by all processes, otherwise invalidations made by one process
+    would not reach the others."""
+    gate_cache = caches[settings.USER_GATE_STATE_CACHE] if settings.USER_GATE_STATE_CACHE else None
+    cache_key = get_gate_state_cache_key(user.id)
+    gate_state = gate_cache.get(cache_key) if gate_cache is not None else None
+    if gate_state is None:
+        profile = user.profile
+        gate_state = {
+            'has_old_license': profile.has_old_license,
+            'accepted_tos': profile.accepted_tos,
+            'email_valid': profile.email_is_valid(),
+            'not_shown_in_online_users_list': profile.not_shown_in_online_users_list,
+        }
+        if gate_cache is not None:
+            gate_cache.set(cache_key, gate_state, settings.USER_GATE_STATE_CACHE_TIME)
+    return gate_state
+
+
+def invalidate_user_gate_state(user_ids):
+    if settings.USER_GATE_STATE_CACHE:
+        caches[settings.USER_GATE_STATE_CACHE].delete_many([get_gate_state_cache_key(user_id) for user_id in user_ids])
+
+
+@receiver(post_save, sender=Profile)
+def invalidate_gate_state_on_profile_save(sender, instance, **kwargs):
+    invalidate_user_gate_state([instance.user_id])
+
+
+@receiver(post_save, sender=EmailBounce)
+@receiver(post_delete, sender=EmailBounce)
+def invalidate_gate_state_on_email_bounce_change(sender, instance, **kwargs):
+    # Email validity of users with a SameUser object depends on the bounces of the main user
+    user_ids = {instance.user_id}
+    for sameuser in SameUser.objects.filter(Q(main_user_id=instance.user_id) | Q(secondary_user_id=instance.user_id)):
+        user_ids.update([sameuser.main_user_id, sameuser.secondary_user_id])
+    invalidate_user_gate_state(user_ids)
+
+
+@receiver(post_save, sender=SameUser)
+@receiver(post_delete, sender=SameUser)
+def invalidate_gate_state_on_sameuser_change(sender, instance, **kwargs):
+    invalidate_user_gate_state([instance.main_user_id, instance.secondary_user_id])
@@ -29,7 +29,7 @@ from django.contrib.auth.tokens import default_token_generator
 from django.core.cache import cache
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.core.management import call_command
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.utils.http import int_to_base36
 
@@ -386,6 +386,58 @@ class ProfileEmailIsValid(TestCase):
         self.assertEqual(user.profile.email_is_valid(), False)
 
 
+class UserGateStateTest(TestCase):
+
+    def test_gate_state_is_not_cached_without_cache(self):
+        user = User.objects.create_user('user', email='user@freesound.org')
+        self.assertTrue(accounts.models.get_user_gate_state(user)['accepted_tos'])
+        accounts.models.Profile.objects.filter(user=user).update(accepted_tos=False)
+        user = User.objects.get(id=user.id)
+        self.assertFalse(accounts.models.get_user_gate_state(user)['accepted_tos'])
+
+    @override_settings(USER_GATE_STATE_CACHE='default')
+    def test_gate_state_is_cached_and_invalidated(self):
+        user = User.objects.create_user('user', email='user@freesound.org')
+        cache.clear()
+        gate_state = accounts.models.get_user_gate_state(user)
+        self.assertEqual(gate_state, {'has_old_license': False, 'accepted_tos': True, 'email_valid': True,
+                                      'not_shown_in_online_users_list': False})
+        with self.assertNumQueries(0):
+            accounts.models.get_user_gate_state(user)
+
+        # Gate state is invalidated when email bounces change
+        email_bounce = EmailBounce.objects.create(user=user, type=EmailBounce.PERMANENT)
+        self.assertFalse(accounts.models.get_user_gate_state(user)['email_valid'])
+        email_bounce.delete()
+        self.assertTrue(accounts.models.get_user_gate_state(user)['email_valid'])
+
+        # Gate state is invalidated when the profile changes
+        user.profile.has_old_license = True
+        user.profile.save()
+        self.assertTrue(accounts.models.get_user_gate_state(user)['has_old_license'])
+
+    @override_settings(USER_GATE_STATE_CACHE='default')
+    def test_gate_middleware_redirects(self):
+        user = User.objects.create_user('user', email='user@freesound.org')
+        self.client.force_login(user)
+        cache.clear()  # Need to clear cache here to avoid 'random_sound' cache key being set
+        resp = self.client.get(reverse('front-page'))
+        self.assertEqual(resp.status_code, 200)
+
+        accounts.models.Profile.objects.filter(user=user).update(accepted_tos=False)
+        accounts.models.invalidate_user_gate_state([user.id])
+        resp = self.client.get(reverse('front-page'))
+        self.assertRedirects(resp, reverse('tos-acceptance'))
+        resp = self.client.post(reverse('tos-acceptance'), {'accepted_tos': 'on'})
+        self.assertRedirects(resp, reverse('accounts-home'), fetch_redirect_response=False)
+
+        user.profile.refresh_from_db()
+        user.profile.has_old_license = True
+        user.profile.save()
+        resp = self.client.get(reverse('front-page'))
+        self.assertRedirects(resp, reverse('bulk-license-change'))
+
+
 class ProfilePostInForumTest(TestCase):
 
     def setUp(self):
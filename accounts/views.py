@@ -39,7 +39,6 @@ from django.contrib.auth.models import User
 from django.contrib.auth.tokens import default_token_generator
 from django.contrib.auth.views import LoginView, PasswordResetCompleteView, PasswordResetConfirmView, \
     PasswordChangeView, PasswordChangeDoneView
-from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.db import transaction
 from django.db.models import Count, Q
@@ -63,7 +62,8 @@ from accounts.forms import EmailResetForm, FsPasswordResetForm, BwSetPasswordFor
     UsernameReminderForm, BwFsAuthenticationForm, BwRegistrationForm, \
     ProfileForm, AvatarForm, TermsOfServiceForm, DeleteUserForm, EmailSettingsForm, BulkDescribeForm, UsernameField, \
     BwProblemsLoggingInForm, username_taken_by_other_user
-from accounts.models import Profile, ResetEmailRequest, UserFlag, DeletedUser, UserDeletionRequest
+from accounts.models import Profile, ResetEmailRequest, UserFlag, DeletedUser, UserDeletionRequest, \
+    invalidate_user_gate_state
 from bookmarks.models import Bookmark
 from comments.models import Comment
 from follow import follow_utils
@@ -267,7 +267,7 @@ def tos_acceptance(request):
         form = TermsOfServiceForm(request.POST)
         if form.is_valid():
             Profile.objects.filter(user=request.user).update(accepted_tos=True)
-            cache.set('has-accepted-tos-%s' % request.user.id, 'yes', 2592000)
+            invalidate_user_gate_state([request.user.id])
             return HttpResponseRedirect(reverse('accounts-home'))
     else:
         form = TermsOfServiceForm()
@@ -34,6 +34,7 @@ if settings.IS_CELERY_WORKER:
     import community as com
     import numpy as np
     import networkx as nx
+    from scipy import sparse
     from networkx.readwrite import json_graph
     from networkx.algorithms.community import k_clique_communities, greedy_modularity_communities
     from sklearn import metrics
@@ -247,6 +248,33 @@ class ClusteringEngine():
             ), 'w') as f:
                 json.dump(result, f)
 
+    def _knn_adjacency(self, sound_ids_list, features=clust_settings.DEFAULT_FEATURES):
+        """Computes the K-Nearest Neighbors adjacency matrix of the given sounds.
+
+        Neighbors further than MAX_NEIGHBORS_DISTANCE are discarded and the matrix is made symmetric, so that it 
+        corresponds to the undirected K-Nearest Neighbors Graph.
+
+        Args:
+            sound_ids_list (List[str]): list of sound ids.
+            features (str): name of the features to be used for nearest neighbors computation. 
+                Available features are listed in the clustering settings file.
+
+        Returns:
+            Tuple(scipy.sparse.csr_matrix, List[str]): 2-element tuple containing the binary adjacency matrix and the 
+                sound ids corresponding to its rows and columns.
+        """
+        # we set k to log2(N), where N is the number of elements to cluster. This allows us to reach a sufficient number of 
+        # neighbors for small collections, while limiting it for larger collections, which ensures low-computational complexity.
+        k = int(np.ceil(np.log2(len(sound_ids_list))))
+
+        sound_features, sound_ids_out = self.feature_store.return_features(sound_ids_list)
+        A = kneighbors_graph(sound_features, k).tocsr()
+        A.data = (A.data < clust_settings.MAX_NEIGHBORS_DISTANCE).astype(np.int32)
+        A.eliminate_zeros()
+        A = A.maximum(A.T).tocsr()
+
+        return A, sound_ids_out
+
     def create_knn_graph(self, sound_ids_list, features=clust_settings.DEFAULT_FEATURES):
         """Creates a K-Nearest Neighbors Graph representation of the given sounds.
 
@@ -261,16 +289,9 @@ class ClusteringEngine():
         # Create k nearest neighbors graph        
         graph = nx.Graph()
         graph.add_nodes_from(sound_ids_list)
-        # we set k to log2(N), where N is the number of elements to cluster. This allows us to reach a sufficient number of 
-        # neighbors for small collections, while limiting it for larger collections, which ensures low-computational complexity.
-        k = int(np.ceil(np.log2(len(sound_ids_list))))
-
-        sound_features, sound_ids_out = self.feature_store.return_features(sound_ids_list)
-        A = kneighbors_graph(sound_features, k)
-        for idx_from, (idx_to, distance) in enumerate(zip(A.indices, A.data)):
-            idx_from = int(idx_from / k)
-            if distance < clust_settings.MAX_NEIGHBORS_DISTANCE:
-                graph.add_edge(sound_ids_out[idx_from], sound_ids_out[idx_to])
+        adjacency, sound_ids_out = self._knn_adjacency(sound_ids_list, features=features)
+        for idx_from, idx_to in zip(*adjacency.nonzero()):
+            graph.add_edge(sound_ids_out[idx_from], sound_ids_out[idx_to])
 
         # Remove isolated nodes
         graph.remove_nodes_from(list(nx.isolates(graph)))
@@ -288,44 +309,45 @@ class ClusteringEngine():
         Returns:
             (nx.Graph): NetworkX graph representation of sounds.
         """
-        # first create a knn graph
-        knn_graph = self.create_knn_graph(sound_ids_list, features=features)
-
-        # create the common nn graph
+        # first compute the knn adjacency matrix
+        A, sound_ids_out = self._knn_adjacency(sound_ids_list, features=features)
+
+        # the number of common neighbors of each pair of nodes is given by the product of the adjacency matrix 
+        # with its transpose. Self-loops (number of neighbors of each node) are discarded.
+        common_nn = (A * A.T).tocsr()
+        common_nn.setdiag(0)
+        common_nn.eliminate_zeros()
+
+        # keep only k most weighted edges of each node. An edge is kept if it is among the k most weighted edges of 
+        # both of its nodes.
+        k = int(np.ceil(np.log2(max(np.count_nonzero(A.getnnz(axis=1)), 1))))
+        rows = np.repeat(np.arange(common_nn.shape[0]), np.diff(common_nn.indptr))
+        # sort the edges of each row by decreasing weight and get their rank inside the row
+        order = np.lexsort((-common_nn.data, rows))
+        ranks = np.empty(len(order), dtype=np.int64)
+        ranks[order] = np.arange(len(order)) - common_nn.indptr[rows[order]]
+        pruned = sparse.csr_matrix((np.where(ranks < k, common_nn.data, 0), common_nn.indices, common_nn.indptr), 
+                                   shape=common_nn.shape)
+        pruned.eliminate_zeros()
+        pruned = pruned.minimum(pruned.T).tocoo()
+
+        # create the common nn graph directly from the pruned matrix (isolated nodes are not added)
         graph = nx.Graph()
-        graph.add_nodes_from(knn_graph.nodes)
-
-        for i, node_i in enumerate(knn_graph.nodes):
-            for j, node_j in enumerate(knn_graph.nodes):
-                if j > i:
-                    num_common_neighbors = len(set(knn_graph.neighbors(node_i)).intersection(knn_graph.neighbors(node_j)))
-                    if num_common_neighbors > 0:
-                        graph.add_edge(node_i, node_j, weight=num_common_neighbors)
-
-        # keep only k most weighted edges
-        k = int(np.ceil(np.log2(len(graph.nodes))))
-        # we iterate through the node ids and get all its corresponding edges using graph[node]
-        # there seem to be no way to get node_id & edges in the for loop.
-        for node in graph.nodes:
-            ordered_neighbors = sorted(list(six.iteritems(graph[node])), key=lambda x: x[1]['weight'], reverse=True)
-            try:
-                neighbors_to_remove = [neighbor_distance[0] for neighbor_distance in ordered_neighbors[k:]]
-                graph.remove_edges_from([(node, neighbor) for neighbor in neighbors_to_remove])
-            except IndexError:
-                pass
-
-        # Remove isolated nodes
-        graph.remove_nodes_from(list(nx.isolates(graph)))
+        graph.add_weighted_edges_from((sound_ids_out[i], sound_ids_out[j], int(weight)) 
+                                      for i, j, weight in zip(pruned.row, pruned.col, pruned.data) if j > i)
 
         return graph
 
-    def cluster_graph(self, graph):
+    def cluster_graph(self, graph, initial_partition=None):
         """Applies community detection in the given graph.
 
-        Uses the Louvain method to extract communities from the given graph.
+        Uses the Louvain method to extract communities from the given graph. An initial partition (e.g. the 
+        clustering of an overlapping query) can be given to warm-start the method.
 
         Args:
             graph (nx.Graph): NetworkX graph representation of sounds.
+            initial_partition (Dict{str: Int}): initial clustering classes for each sound {<sound_id>: <class_idx>}. 
+                Sounds that are not in the initial partition start in their own community.
 
         Returns:
             Tuple(Dict{Int: Int}, int, List[List[Int]], float): 4-element tuple containing the clustering classes for each sound 
@@ -333,8 +355,14 @@ class ClusteringEngine():
                 the modularity of the graph partition.
         
         """ 
+        if initial_partition is not None:
+            num_initial_communities = max(initial_partition.values()) + 1 if initial_partition else 0
+            initial_partition = {node: initial_partition[node] if node in initial_partition 
+                                    else num_initial_communities + i
+                                 for i, node in enumerate(graph.nodes)}
+
         # Community detection in the graph
-        partition  = com.best_partition(graph)
+        partition  = com.best_partition(graph, partition=initial_partition)
         num_communities = max(partition .values()) + 1
         communities = [[key for key, value in six.iteritems(partition ) if value == i] for i in range(num_communities)]
 
@@ -397,13 +425,15 @@ class ClusteringEngine():
                 partition[snd] -= 1
         return graph, partition, communities, ratio_intra_community_edges
 
-    def cluster_points(self, query_params, features, sound_ids):
+    def cluster_points(self, query_params, features, sound_ids, initial_partition=None):
         """Applies clustering on the requested sounds using the given features name.
 
         Args:
             query_params (str): string representing the query parameters submited by the user to the search engine.
             features (str): name of the features used for clustering the sounds.
             sound_ids (List[int]): list containing the ids of the sound to cluster.
+            initial_partition (Dict{str: Int}): initial clustering classes used to warm-start the community detection 
+                (see cluster_graph()).
         
         Returns:
             Dict: contains the resulting clustering classes and the graph in node-link format suitable for JSON serialization.
@@ -418,7 +448,7 @@ class ClusteringEngine():
         if len(graph.nodes) == 0:  # the graph does not contain any node
             return {'error': False, 'result': None, 'graph': None}
 
-        partition, num_communities, communities, modularity = self.cluster_graph(graph)
+        partition, num_communities, communities, modularity = self.cluster_graph(graph, initial_partition)
 
         ratio_intra_community_edges = self._ratio_intra_community_edges(graph, communities)
 
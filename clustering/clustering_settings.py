@@ -56,6 +56,20 @@ CLUSTERING_CACHE_TIME = 24*60*60*1
 # for too long.
 CLUSTERING_PENDING_CACHE_TIME = 60*1
 
+# Prefetching of the clustering of popular queries. The number of times the clustering of each query is requested is 
+# counted (the polls made while a clustering is pending are not counted). Queries requested at least CLUSTERING_PREFETCH_MIN_REQUESTS times (within CLUSTERING_CACHE_TIME) are 
+# considered popular, and their clustering is recomputed in the background once the cached result is older than 
+# CLUSTERING_PREFETCH_REFRESH_AGE. The old result is served until the new one is ready, so that popular queries are 
+# never shown as pending. Set CLUSTERING_PREFETCH_MIN_REQUESTS to 0 to disable prefetching.
+CLUSTERING_PREFETCH_MIN_REQUESTS = 0
+CLUSTERING_PREFETCH_REFRESH_AGE = 12*60*60
+
+# Progressive clustering. When activated, a coarse clustering is returned as soon as possible and refined later. The 
+# coarse clustering is obtained from the cached clustering of an overlapping query (the same query with one filter less) 
+# if there is one, or else by clustering only the CLUSTERING_PROGRESSIVE_NUM_RESULTS first results.
+CLUSTERING_PROGRESSIVE = False
+CLUSTERING_PROGRESSIVE_NUM_RESULTS = 200
+
 # Folder for saving the clustering results with evaluation (dev/debug/research purpose)
 SAVE_RESULTS_FOLDER = None
 
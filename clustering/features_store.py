@@ -18,59 +18,178 @@
 #     See AUTHORS file.
 #
 
+import fcntl
 import json
 import logging
 import os
+import uuid
 
 import clustering_settings as clust_settings
 import numpy as np
-import redis
-from django.conf import settings
 
 logger = logging.getLogger('clustering')
 
 
-class RedisStore(object):
-    def __init__(self):
-        self.r = redis.StrictRedis(
-            host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.AUDIO_FEATURES_REDIS_STORE_ID)
+class MemmapFeaturesStore(object):
+    """Stores feature vectors as rows of a float32 matrix in a binary file which is memory-mapped (read-only).
+
+    The matrix is stored in '<path>.f32' and the sound id of each row in '<path>.ids' (int64), together with a
+    '<path>.meta.json' file with the dimension of the vectors and the generation of the store (a random id which changes
+    every time the store is created). All processes of a host map the same file, so the features are loaded only once
+    in memory (the OS page cache) and rows are gathered without any decoding.
+    New vectors can be appended to the files (see append_features). Rows are written before their ids, so the number
+    of ids always indicates the number of complete rows. Readers check the metadata file and the size of the ids file
+    before each access and map the new rows if the ids file has grown, or all rows again if the store has been
+    recreated. Writers hold an exclusive lock on '<path>.lock' and readers a shared one while they map new rows.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data_path = path + '.f32'
+        self.ids_path = path + '.ids'
+        self.meta_path = path + '.meta.json'
+        self.lock_path = path + '.lock'
+        self.dimension = None
+        self.generation = None
+        self.meta_inode = None
+        self.matrix = None
+        self.row_ids = np.zeros(0, dtype=np.int64)
+        self.id_to_row = {}
+
+    def exists(self):
+        return os.path.exists(self.meta_path)
+
+    def _lock(self, operation=fcntl.LOCK_EX):
+        lock_file = open(self.lock_path, 'a')
+        fcntl.flock(lock_file, operation)
+        return lock_file
+
+    def _write_meta(self, dimension, generation):
+        with open(self.meta_path + '.tmp', 'w') as f:
+            json.dump({'dimension': dimension, 'generation': generation}, f)
+        os.rename(self.meta_path + '.tmp', self.meta_path)
+
+    def create(self, features):
+        """Creates the store with the given {sound_id: vector} dictionary (replacing any existing store). If features
+        is empty, the dimension is set by the first call to append_features."""
+        lock_file = self._lock()
+        try:
+            sound_ids = np.array([int(sound_id) for sound_id in features.keys()], dtype=np.int64)
+            matrix = np.array(features.values(), dtype=np.float32)
+            for path, array in ((self.data_path, matrix), (self.ids_path, sound_ids)):
+                with open(path + '.tmp', 'wb') as f:
+                    array.tofile(f)
+                os.rename(path + '.tmp', path)
+            self._write_meta(matrix.shape[1] if len(matrix) else None, uuid.uuid4().hex)
+        finally:
+            lock_file.close()
 
-    def set_feature(self, sound_id, feature):
-        self.r.set(str(sound_id), json.dumps(feature))
+    def append_features(self, features):
+        """Appends the given {sound_id: vector} dictionary to the store. Sounds already in the store are ignored."""
+        lock_file = self._lock()
+        try:
+            self._refresh()
+            new_features = [(int(sound_id), vector) for sound_id, vector in features.items()
+                            if int(sound_id) not in self.id_to_row]
+            if not new_features:
+                return 0
+            sound_ids = np.array([sound_id for sound_id, _ in new_features], dtype=np.int64)
+            matrix = np.array([vector for _, vector in new_features], dtype=np.float32)
+            if self.dimension is None:
+                # The store was created empty
+                self._write_meta(matrix.shape[1], self.generation)
+                self._refresh()
+            # Truncate possible incomplete rows of an interrupted append before appending
+            n_rows = os.path.getsize(self.ids_path) // 8
+            with open(self.data_path, 'r+b') as f:
+                f.truncate(n_rows * self.dimension * 4)
+                f.seek(0, os.SEEK_END)
+                matrix.tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.ids_path, 'ab') as f:
+                sound_ids.tofile(f)
+            self._refresh()
+        finally:
+            lock_file.close()
+        return len(new_features)
 
-    def get_feature(self, sound_id):
-        feature = self.r.get(str(sound_id))
-        if feature:
-            return json.loads(feature)
+    def refresh(self):
+        """Maps the rows appended since the last call (or all rows if the store has been recreated)."""
+        if os.stat(self.meta_path).st_ino == self.meta_inode and self.matrix is not None \
+                and os.path.getsize(self.ids_path) // 8 == len(self.row_ids):
+            return
+        lock_file = self._lock(fcntl.LOCK_SH)
+        try:
+            self._refresh()
+        finally:
+            lock_file.close()
 
-    def set_features(self, d):
-        self.r.mset({k: json.dumps(v) for k, v in d.iteritems()})
+    def _refresh(self):
+        meta_inode = os.stat(self.meta_path).st_ino
+        if meta_inode != self.meta_inode:
+            # The metadata file is replaced when the store is recreated (or when the dimension of an empty store is set)
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            if meta['generation'] != self.generation:
+                self.generation = meta['generation']
+                self.matrix = None
+                self.row_ids = np.zeros(0, dtype=np.int64)
+                self.id_to_row = {}
+            self.dimension = meta['dimension']
+            self.meta_inode = meta_inode
+        n_rows = os.path.getsize(self.ids_path) // 8
+        if n_rows == len(self.row_ids) and self.matrix is not None:
+            return
+        new_ids = np.fromfile(self.ids_path, dtype=np.int64, count=n_rows)[len(self.row_ids):]
+        for row, sound_id in enumerate(new_ids.tolist(), start=len(self.row_ids)):
+            self.id_to_row[sound_id] = row
+        self.row_ids = np.concatenate([self.row_ids, new_ids])
+        if n_rows:
+            self.matrix = np.memmap(self.data_path, dtype=np.float32, mode='r', shape=(n_rows, self.dimension))
+        else:
+            self.matrix = np.zeros((0, self.dimension or 0), dtype=np.float32)
 
     def get_features(self, sound_ids):
-        return self.r.mget(sound_ids)
+        """Returns a float32 matrix with the vectors of the given sounds (in the same order) and the list of sound ids
+        which have features (sounds without features are skipped)."""
+        self.refresh()
+        rows = []
+        sound_ids_out = []
+        for sound_id in sound_ids:
+            row = self.id_to_row.get(int(sound_id))
+            if row is not None:
+                rows.append(row)
+                sound_ids_out.append(sound_id)
+        return self.matrix[np.array(rows, dtype=np.int64)], sound_ids_out
 
 
 class FeaturesStore(object):
     """Method for storing and retrieving audio features
     """
     def __init__(self):
-        self.redis = RedisStore()
+        self.json_path = os.path.join(
+            clust_settings.INDEX_DIR,
+            clust_settings.AVAILABLE_FEATURES[clust_settings.DEFAULT_FEATURES]['DATASET_FILE']
+        )
+        self.store = MemmapFeaturesStore(os.path.splitext(self.json_path)[0])
         self.__load_features()
 
     def __load_features(self):
-        self.AS_features = json.load(open(os.path.join(
-            clust_settings.INDEX_DIR, 
-            clust_settings.AVAILABLE_FEATURES[clust_settings.DEFAULT_FEATURES]['DATASET_FILE']
-        ), 'r'))
-        self.redis.set_features(self.AS_features)
+        """Creates the memory-mapped store from the json features file the first time. If the json file is updated
+        later, only the features of the new sounds are appended to the store."""
+        json_path = self.json_path
+        if not self.store.exists():
+            logger.info('Creating features store from %s' % json_path)
+            self.store.create(json.load(open(json_path, 'r')))
+        elif os.path.getmtime(json_path) > os.path.getmtime(self.store.meta_path):
+            n_appended = self.store.append_features(json.load(open(json_path, 'r')))
+            os.utime(self.store.meta_path, None)
+            logger.info('Appended features of %i new sounds from %s' % (n_appended, json_path))
+        self.store.refresh()
+
+    def append_features(self, features):
+        """Adds the features of new sounds given as a {sound_id: vector} dictionary."""
+        return self.store.append_features(features)
 
     def return_features(self, sound_ids):
-        features = []
-        sound_ids_out = []
-        output = self.redis.get_features(sound_ids)
-        for sound_id, feature in zip(sound_ids, output):
-            if feature:
-                features.append(json.loads(feature))
-                sound_ids_out.append(sound_id)
-            
-        return np.array(features).astype('float32'), sound_ids_out
+        return self.store.get_features(sound_ids)
@@ -18,13 +18,17 @@
 #     See AUTHORS file.
 #
 
+from time import time
+
 from django.core.cache import caches
 
-from clustering_settings import DEFAULT_FEATURES, MAX_RESULTS_FOR_CLUSTERING
+from clustering_settings import DEFAULT_FEATURES, MAX_RESULTS_FOR_CLUSTERING, CLUSTERING_CACHE_TIME, \
+    CLUSTERING_PENDING_CACHE_TIME, CLUSTERING_PREFETCH_MIN_REQUESTS, CLUSTERING_PREFETCH_REFRESH_AGE, \
+    CLUSTERING_PROGRESSIVE
 from tasks import cluster_sounds
 from utils.encryption import create_hash
 from utils.search.search_general import search_prepare_query, perform_solr_query, \
-    search_prepare_parameters
+    search_prepare_parameters, remove_facet_filters
 from . import CLUSTERING_RESULT_STATUS_PENDING, CLUSTERING_RESULT_STATUS_FAILED
 
 cache_clustering = caches["clustering"]
@@ -56,12 +60,149 @@ def get_sound_ids_from_solr_query(query_params):
     return resultids
 
 
+def get_clustering_cache_key(query_params, features):
+    """Returns the hashed cache key used for storing the clustering of the given query with the given features.
+
+    Args:
+        query_params (dict): contains the query parameters of the clustered query.
+        features (str): name of the features used for clustering.
+
+    Returns:
+        str: hashed cache key.
+    """
+    cache_key = 'cluster-results-{search_query}-{filter_query}-{sort}-{tag_weight}-{username_weight}-{id_weight}-' \
+                '{description_weight}-{pack_tokenized_weight}-{original_filename_weight}-{grouping}'.format(**query_params) \
+                .replace(' ', '')
+
+    cache_key += '-{}'.format(features)
+    return hash_cache_key(cache_key)
+
+
+def get_overlapping_cache_keys(query_params, parsed_filters, features):
+    """Returns the cache keys of the clustering of the queries that overlap with the given one.
+
+    Overlapping queries are the same query with one (non facet) filter less. Their results include the results of the 
+    given query, so that their clustering can be used as a starting point for clustering the given query.
+
+    Args:
+        query_params (dict): contains the query parameters of the clustered query.
+        parsed_filters (List[List[str]]): parsed query filter.
+        features (str): name of the features used for clustering.
+
+    Returns:
+        List[str]: hashed cache keys of the overlapping queries.
+    """
+    cache_keys = []
+    for i in range(len(parsed_filters)):
+        filter_query, _ = remove_facet_filters(parsed_filters[:i] + parsed_filters[i + 1:])
+        if filter_query != query_params['filter_query']:
+            cache_key = get_clustering_cache_key(dict(query_params, filter_query=filter_query), features)
+            if cache_key not in cache_keys:
+                cache_keys.append(cache_key)
+    return cache_keys
+
+
+def restrict_clustering_result(result, sound_ids):
+    """Restricts a clustering result to the given sounds.
+
+    Sounds that are not in the given list are removed from the clusters and the graph, and empty clusters are 
+    discarded. This is used to obtain a coarse clustering of a query from the clustering of an overlapping query.
+
+    Args:
+        result (dict): clustering result as returned by ClusteringEngine.cluster_points().
+        sound_ids (List[int]): ids of the sounds to keep.
+
+    Returns:
+        Tuple(Dict, Dict{str: Int}): 2-element tuple containing the restricted clustering result and the clustering 
+            classes for each sound {<sound_id>: <class_idx>}, or (None, None) if no sound of the result is kept.
+    """
+    sound_ids = set(str(sound_id) for sound_id in sound_ids)
+    communities = [[sound_id for sound_id in community if sound_id in sound_ids] for community in result['result']]
+    communities = [community for community in communities if community]
+    if not communities:
+        return None, None
+    partition = {sound_id: cluster_id for cluster_id, community in enumerate(communities) for sound_id in community}
+
+    graph = dict(result['graph'])
+    graph['nodes'] = [dict(node, group=partition[node['id']]) for node in result['graph']['nodes']
+                      if node['id'] in partition]
+    graph['links'] = [link for link in result['graph']['links']
+                      if link['source'] in partition and link['target'] in partition]
+
+    return {'error': False, 'result': communities, 'graph': graph}, partition
+
+
+def _count_clustering_request(cache_key_hashed):
+    """Increases and returns the number of times the clustering of a query has been requested."""
+    count_cache_key = 'cluster-requests-{}'.format(cache_key_hashed)
+    try:
+        return cache_clustering.incr(count_cache_key)
+    except ValueError:
+        # the counter does not exist yet (or has expired)
+        cache_clustering.set(count_cache_key, 1, CLUSTERING_CACHE_TIME)
+        return 1
+
+
+def _schedule_clustering(cache_key_hashed, query_params, parsed_filters, features):
+    """Queries Solr for the sounds to cluster and launches the clustering Celery task.
+
+    The clustering of an overlapping query found in cache is used to warm-start the clustering and, in progressive 
+    mode, as a coarse result which is returned until the clustering is finished.
+
+    Returns:
+        Dict: contains either the pending state of the clustering or the coarse clustering result.
+    """
+    overlapping_results = cache_clustering.get_many(get_overlapping_cache_keys(query_params, parsed_filters, features))
+    sound_ids = get_sound_ids_from_solr_query(query_params)
+
+    coarse_result, initial_partition = None, None
+    for overlapping_result in overlapping_results.values():
+        if isinstance(overlapping_result, dict) and overlapping_result.get('result') \
+                and not overlapping_result.get('coarse', False):
+            coarse_result, initial_partition = restrict_clustering_result(overlapping_result, sound_ids)
+            if coarse_result is not None:
+                break
+
+    if CLUSTERING_PROGRESSIVE and coarse_result is not None:
+        coarse_result.update({'coarse': True, 'computed_time': time()})
+        cache_clustering.set(cache_key_hashed, coarse_result, CLUSTERING_PENDING_CACHE_TIME)
+    else:
+        coarse_result = None
+        cache_clustering.set(cache_key_hashed, CLUSTERING_RESULT_STATUS_PENDING, CLUSTERING_PENDING_CACHE_TIME)
+
+    # launch clustering with celery async task
+    cluster_sounds.delay(cache_key_hashed, sound_ids, features, initial_partition, CLUSTERING_PROGRESSIVE)
+
+    if coarse_result is not None:
+        coarse_result.update({'finished': True, 'error': False})
+        return coarse_result
+    return {'finished': False, 'error': False}
+
+
+def _refresh_clustering(cache_key_hashed, query_params, features, result):
+    """Recomputes in the background the clustering of a popular query whose cached result is getting old.
+
+    The cached result keeps being served until the new one is stored, and is used to warm-start the clustering.
+    """
+    if time() - result.get('computed_time', 0) < CLUSTERING_PREFETCH_REFRESH_AGE:
+        return
+    # make sure that only one refresh is scheduled
+    if not cache_clustering.add('cluster-refresh-{}'.format(cache_key_hashed), True, CLUSTERING_PENDING_CACHE_TIME):
+        return
+    sound_ids = get_sound_ids_from_solr_query(dict(query_params))
+    initial_partition = {sound_id: cluster_id for cluster_id, community in enumerate(result['result'])
+                         for sound_id in community}
+    cluster_sounds.delay(cache_key_hashed, sound_ids, features, initial_partition, False)
+
+
 def cluster_sound_results(request, features=DEFAULT_FEATURES):
     """Performs clustering on the search results of the given search request with the requested features.
 
     This is the main entry to the clustering method. It will either get the clustering results from cache, 
     or compute it (and store it in cache). When needed, the clustering will be performed async by a celery 
-    worker. 
+    worker. Depending on the clustering settings, the clustering of popular queries is refreshed in the background 
+    before it expires (prefetching) and a coarse result can be returned while the clustering is being computed 
+    (progressive mode). Coarse results are marked with 'coarse': True.
 
     Args:
         request (HttpRequest): request associated with the search query submited by the user.
@@ -77,17 +218,16 @@ def cluster_sound_results(request, features=DEFAULT_FEATURES):
     # done on the non faceted filtered results. Without that, people directly requesting a facet filtered
     # page would have a clustering performed on filtered results.
     query_params['filter_query'] = extra_vars['filter_query_non_facets']
-    cache_key = 'cluster-results-{search_query}-{filter_query}-{sort}-{tag_weight}-{username_weight}-{id_weight}-' \
-                '{description_weight}-{pack_tokenized_weight}-{original_filename_weight}-{grouping}'.format(**query_params) \
-                .replace(' ', '')
-
-    cache_key += '-{}'.format(features)
-    cache_key_hashed = hash_cache_key(cache_key)
+    cache_key_hashed = get_clustering_cache_key(query_params, features)
 
     # check if result is in cache
     result = cache_clustering.get(cache_key_hashed)
 
     if result and result not in (CLUSTERING_RESULT_STATUS_PENDING, CLUSTERING_RESULT_STATUS_FAILED):
+        # only the complete results served are counted, the polls made while the clustering is pending are not
+        if CLUSTERING_PREFETCH_MIN_REQUESTS and result['result'] is not None and not result.get('coarse', False):
+            if _count_clustering_request(cache_key_hashed) >= CLUSTERING_PREFETCH_MIN_REQUESTS:
+                _refresh_clustering(cache_key_hashed, query_params, features, result)
         result.update({'finished': True, 'error': False})
         return result
 
@@ -99,12 +239,9 @@ def cluster_sound_results(request, features=DEFAULT_FEATURES):
 
     else:
         # if not in cache, query solr and perform clustering
-        sound_ids = get_sound_ids_from_solr_query(query_params)
-
-        # launch clustering with celery async task
-        cluster_sounds.delay(cache_key_hashed, sound_ids, features)
-
-        return {'finished': False, 'error': False}
+        if CLUSTERING_PREFETCH_MIN_REQUESTS:
+            _count_clustering_request(cache_key_hashed)
+        return _schedule_clustering(cache_key_hashed, query_params, extra_vars['parsed_filters'], features)
 
 
 def hash_cache_key(key):
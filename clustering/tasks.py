@@ -23,9 +23,11 @@ from django.core.cache import caches
 from celery.decorators import task
 from celery import Task
 import logging
+from time import time
 
 from clustering import ClusteringEngine
-from clustering_settings import CLUSTERING_CACHE_TIME, CLUSTERING_PENDING_CACHE_TIME
+from clustering_settings import CLUSTERING_CACHE_TIME, CLUSTERING_PENDING_CACHE_TIME, \
+    CLUSTERING_PROGRESSIVE_NUM_RESULTS
 from . import CLUSTERING_RESULT_STATUS_PENDING, CLUSTERING_RESULT_STATUS_FAILED
 
 logger = logging.getLogger('clustering')
@@ -42,28 +44,42 @@ class ClusteringTask(Task):
             
 
 @task(name="cluster_sounds", base=ClusteringTask)
-def cluster_sounds(cache_key_hashed, sound_ids, features):
+def cluster_sounds(cache_key_hashed, sound_ids, features, initial_partition=None, progressive=False):
     """ Triggers the clustering of the sounds given as argument with the specified features.
 
     This is the task that is used for clustering the sounds of a search result asynchronously with Celery.
     The clustering result is stored in cache using the hashed cache key built with the query parameters.
+    The pending state is stored in cache when the task is scheduled (see clustering.interface).
 
     Args:
         cache_key_hashed (str): hashed key for storing/retrieving the results in cache.
         sound_ids (List[int]): list containing the ids of the sound to cluster.
         features (str): name of the features used for clustering the sounds (defined in the clustering settings file).
+        initial_partition (Dict{str: Int}): initial clustering classes used to warm-start the clustering.
+        progressive (bool): if True and no initial partition is given, a coarse clustering of the first 
+            CLUSTERING_PROGRESSIVE_NUM_RESULTS sounds is stored in cache before clustering all the sounds.
     """
-    # store pending state in cache
-    cache_clustering.set(cache_key_hashed, CLUSTERING_RESULT_STATUS_PENDING, CLUSTERING_PENDING_CACHE_TIME)
-
     try:
+        if progressive and initial_partition is None and len(sound_ids) > CLUSTERING_PROGRESSIVE_NUM_RESULTS:
+            result = cluster_sounds.engine.cluster_points(
+                cache_key_hashed, features, sound_ids[:CLUSTERING_PROGRESSIVE_NUM_RESULTS])
+            if result['result'] is not None:
+                # the coarse result only lives while the complete clustering is considered pending
+                result.update({'coarse': True, 'computed_time': time()})
+                cache_clustering.set(cache_key_hashed, result, CLUSTERING_PENDING_CACHE_TIME)
+
         # perform clustering
-        result = cluster_sounds.engine.cluster_points(cache_key_hashed, features, sound_ids)
+        result = cluster_sounds.engine.cluster_points(cache_key_hashed, features, sound_ids,
+                                                      initial_partition=initial_partition)
+        result['computed_time'] = time()
 
         # store result in cache
         cache_clustering.set(cache_key_hashed, result, CLUSTERING_CACHE_TIME)
 
     except Exception as e:  
-        # delete pending state if exception raised during clustering
-        cache_clustering.set(cache_key_hashed, CLUSTERING_RESULT_STATUS_FAILED, CLUSTERING_PENDING_CACHE_TIME)
+        # store failed state if exception raised during clustering. A complete result stored previously (when 
+        # refreshing the clustering of a popular query) is kept.
+        cached_result = cache_clustering.get(cache_key_hashed)
+        if not isinstance(cached_result, dict) or cached_result.get('coarse', False):
+            cache_clustering.set(cache_key_hashed, CLUSTERING_RESULT_STATUS_FAILED, CLUSTERING_PENDING_CACHE_TIME)
         logger.error("Exception raised while clustering sounds", exc_info=True)
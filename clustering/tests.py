@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+from __future__ import absolute_import
+
+import os
+from time import time
+from unittest import skipIf
+
+import mock
+import numpy as np
+from django.test import RequestFactory, SimpleTestCase
+
+from clustering import CLUSTERING_RESULT_STATUS_PENDING, CLUSTERING_RESULT_STATUS_FAILED
+from clustering import interface
+from clustering.clustering import ClusteringEngine
+from clustering.features_store import MemmapFeaturesStore
+from clustering.tasks import cluster_sounds
+from utils.filesystem import TemporaryDirectory
+from utils.search.lucene_parser import parse_query_filter_string
+
+try:
+    import community
+    import networkx as nx
+    from networkx.algorithms.community import k_clique_communities
+except ImportError:
+    # The clustering dependencies are only installed in the clustering workers
+    community = None
+
+
+class MemmapFeaturesStoreTest(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'features')
+        self.store = MemmapFeaturesStore(self.path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assertFeatures(self, store, features):
+        matrix, sound_ids = store.get_features(sorted(features.keys()) + [999])
+        self.assertEqual(sound_ids, sorted(features.keys()))
+        self.assertEqual(len(matrix), len(sound_ids))
+        if sound_ids:
+            np.testing.assert_allclose(matrix, [features[sound_id] for sound_id in sound_ids])
+
+    def test_create_and_append(self):
+        features = {1: [0.1, 0.2], 2: [0.3, 0.4]}
+        self.store.create(features)
+        self.assertTrue(self.store.exists())
+        self.assertFeatures(self.store, features)
+
+        # Appends are visible to other stores mapping the same files, sounds already in the store are ignored
+        reader = MemmapFeaturesStore(self.path)
+        self.assertFeatures(reader, features)
+        self.assertEqual(self.store.append_features({2: [9, 9], 3: [0.5, 0.6]}), 1)
+        features[3] = [0.5, 0.6]
+        self.assertFeatures(self.store, features)
+        self.assertFeatures(reader, features)
+
+    def test_recreate(self):
+        self.store.create({1: [0.1, 0.2], 2: [0.3, 0.4]})
+        reader = MemmapFeaturesStore(self.path)
+        self.assertFeatures(reader, {1: [0.1, 0.2], 2: [0.3, 0.4]})
+
+        # The new store has the same number of rows but different sounds and dimension
+        features = {3: [0.5, 0.6, 0.7], 4: [0.8, 0.9, 1.0]}
+        MemmapFeaturesStore(self.path).create(features)
+        self.assertFeatures(reader, features)
+        self.assertEqual(reader.get_features([1, 2])[1], [])
+        self.assertEqual(reader.dimension, 3)
+
+    def test_create_empty(self):
+        self.store.create({})
+        reader = MemmapFeaturesStore(self.path)
+        self.assertFeatures(reader, {})
+        self.assertEqual(self.store.append_features({1: [0.1, 0.2, 0.3]}), 1)
+        self.assertFeatures(self.store, {1: [0.1, 0.2, 0.3]})
+        self.assertFeatures(reader, {1: [0.1, 0.2, 0.3]})
+
+
+def clustering_result(communities):
+    partition = {sound_id: cluster_id for cluster_id, community in enumerate(communities) for sound_id in community}
+    nodes = sorted(partition.keys())
+    return {
+        'error': False,
+        'result': communities,
+        'graph': {
+            'directed': False,
+            'nodes': [{'id': sound_id, 'group': partition[sound_id]} for sound_id in nodes],
+            'links': [{'source': source, 'target': target} for source, target in zip(nodes, nodes[1:])],
+        },
+        'computed_time': time(),
+    }
+
+
+class ClusteringInterfaceTest(SimpleTestCase):
+
+    def setUp(self):
+        interface.cache_clustering.clear()
+        self.query_params = {
+            'search_query': 'dog',
+            'filter_query': 'duration:[1 TO 5] is_geotagged:1',
+            'sort': 'score desc',
+            'tag_weight': 4,
+            'username_weight': 1,
+            'id_weight': 1,
+            'description_weight': 3,
+            'pack_tokenized_weight': 2,
+            'original_filename_weight': 2,
+            'grouping': '1',
+        }
+        self.parsed_filters = parse_query_filter_string('duration:[1 TO 5] is_geotagged:1 tag:dog')
+        self.cache_key = interface.get_clustering_cache_key(self.query_params, 'features')
+
+    def tearDown(self):
+        interface.cache_clustering.clear()
+
+    def overlapping_cache_key(self, filter_query):
+        return interface.get_clustering_cache_key(dict(self.query_params, filter_query=filter_query), 'features')
+
+    def test_get_overlapping_cache_keys(self):
+        # Removing the facet filter gives the same query, which is not overlapping
+        self.assertEqual(
+            interface.get_overlapping_cache_keys(self.query_params, self.parsed_filters, 'features'),
+            [self.overlapping_cache_key('is_geotagged:1'), self.overlapping_cache_key('duration:[1TO5]')])
+        self.assertEqual(interface.get_overlapping_cache_keys(
+            dict(self.query_params, filter_query=''), [], 'features'), [])
+
+    def test_restrict_clustering_result(self):
+        result = clustering_result([['1', '2'], ['3', '4'], ['5']])
+        restricted, partition = interface.restrict_clustering_result(result, [2, 3, 4, 6])
+        self.assertEqual(restricted['result'], [['2'], ['3', '4']])
+        self.assertEqual(partition, {'2': 0, '3': 1, '4': 1})
+        self.assertEqual(restricted['graph']['nodes'],
+                         [{'id': '2', 'group': 0}, {'id': '3', 'group': 1}, {'id': '4', 'group': 1}])
+        self.assertEqual(restricted['graph']['links'],
+                         [{'source': '2', 'target': '3'}, {'source': '3', 'target': '4'}])
+        self.assertFalse(restricted['graph']['directed'])
+        # The original result is not modified
+        self.assertEqual(result['graph']['nodes'][1], {'id': '2', 'group': 0})
+
+        self.assertEqual(interface.restrict_clustering_result(result, [6, 7]), (None, None))
+
+    @mock.patch('clustering.interface.cluster_sounds')
+    @mock.patch('clustering.interface.get_sound_ids_from_solr_query')
+    def test_schedule_clustering(self, get_sound_ids_from_solr_query, cluster_sounds_task):
+        get_sound_ids_from_solr_query.return_value = [2, 3, 4]
+        result = interface._schedule_clustering(self.cache_key, self.query_params, self.parsed_filters, 'features')
+        self.assertEqual(result, {'finished': False, 'error': False})
+        self.assertEqual(interface.cache_clustering.get(self.cache_key), CLUSTERING_RESULT_STATUS_PENDING)
+        cluster_sounds_task.delay.assert_called_once_with(self.cache_key, [2, 3, 4], 'features', None, False)
+
+        # The clustering of an overlapping query warm-starts the clustering, coarse results are not used
+        interface.cache_clustering.set(self.overlapping_cache_key('is_geotagged:1'),
+                                       dict(clustering_result([['2'], ['3']]), coarse=True))
+        interface.cache_clustering.set(self.overlapping_cache_key('duration:[1TO5]'),
+                                       clustering_result([['1', '2'], ['3', '4', '5']]))
+        cluster_sounds_task.reset_mock()
+        result = interface._schedule_clustering(self.cache_key, self.query_params, self.parsed_filters, 'features')
+        self.assertEqual(result, {'finished': False, 'error': False})
+        self.assertEqual(interface.cache_clustering.get(self.cache_key), CLUSTERING_RESULT_STATUS_PENDING)
+        cluster_sounds_task.delay.assert_called_once_with(
+            self.cache_key, [2, 3, 4], 'features', {'2': 0, '3': 1, '4': 1}, False)
+
+        # In progressive mode, the restricted clustering is returned until the clustering is finished
+        cluster_sounds_task.reset_mock()
+        with mock.patch('clustering.interface.CLUSTERING_PROGRESSIVE', True):
+            result = interface._schedule_clustering(
+                self.cache_key, self.query_params, self.parsed_filters, 'features')
+        self.assertTrue(result['finished'])
+        self.assertTrue(result['coarse'])
+        self.assertEqual(result['result'], [['2'], ['3', '4']])
+        cached_result = interface.cache_clustering.get(self.cache_key)
+        self.assertTrue(cached_result['coarse'])
+        self.assertEqual(cached_result['result'], [['2'], ['3', '4']])
+        cluster_sounds_task.delay.assert_called_once_with(
+            self.cache_key, [2, 3, 4], 'features', {'2': 0, '3': 1, '4': 1}, True)
+
+    @mock.patch('clustering.interface.cluster_sounds')
+    @mock.patch('clustering.interface.get_sound_ids_from_solr_query')
+    def test_refresh_clustering(self, get_sound_ids_from_solr_query, cluster_sounds_task):
+        get_sound_ids_from_solr_query.return_value = [1, 2, 3]
+        result = clustering_result([['1', '2'], ['3']])
+        interface._refresh_clustering(self.cache_key, self.query_params, 'features', result)
+        cluster_sounds_task.delay.assert_not_called()
+
+        # Old results are refreshed only once, warm-started with the old clustering
+        result['computed_time'] -= interface.CLUSTERING_PREFETCH_REFRESH_AGE
+        interface._refresh_clustering(self.cache_key, self.query_params, 'features', result)
+        interface._refresh_clustering(self.cache_key, self.query_params, 'features', result)
+        cluster_sounds_task.delay.assert_called_once_with(
+            self.cache_key, [1, 2, 3], 'features', {'1': 0, '2': 0, '3': 1}, False)
+        # The query parameters of the caller are not modified
+        self.assertNotIn('sounds_per_page', self.query_params)
+
+    @mock.patch('clustering.interface.CLUSTERING_PREFETCH_MIN_REQUESTS', 2)
+    @mock.patch('clustering.interface._refresh_clustering')
+    @mock.patch('clustering.interface._schedule_clustering')
+    def test_count_clustering_requests(self, schedule_clustering, refresh_clustering):
+        request = RequestFactory().get('/search/', {'q': 'dog'})
+        cache_key = interface.get_clustering_cache_key(interface.search_prepare_parameters(request)[0], 'features')
+        count_cache_key = 'cluster-requests-{}'.format(cache_key)
+
+        interface.cluster_sound_results(request, 'features')
+        schedule_clustering.assert_called_once()
+        self.assertEqual(interface.cache_clustering.get(count_cache_key), 1)
+
+        # The polls made while the clustering is pending or a coarse result is shown are not counted
+        interface.cache_clustering.set(cache_key, CLUSTERING_RESULT_STATUS_PENDING)
+        interface.cluster_sound_results(request, 'features')
+        interface.cache_clustering.set(cache_key, dict(clustering_result([['1']]), coarse=True))
+        interface.cluster_sound_results(request, 'features')
+        self.assertEqual(interface.cache_clustering.get(count_cache_key), 1)
+        refresh_clustering.assert_not_called()
+
+        # The query is popular once a complete result is served again
+        interface.cache_clustering.set(cache_key, clustering_result([['1']]))
+        result = interface.cluster_sound_results(request, 'features')
+        self.assertTrue(result['finished'])
+        self.assertEqual(interface.cache_clustering.get(count_cache_key), 2)
+        refresh_clustering.assert_called_once()
+
+
+@mock.patch('clustering.tasks.logger')
+@mock.patch.object(cluster_sounds, 'engine', create=True)
+class ClusterSoundsTaskTest(SimpleTestCase):
+
+    def setUp(self):
+        interface.cache_clustering.clear()
+
+    def tearDown(self):
+        interface.cache_clustering.clear()
+
+    def test_cluster_sounds(self, engine, logger):
+        engine.cluster_points.return_value = clustering_result([['1', '2']])
+        cluster_sounds('key', [1, 2], 'features', {'1': 0})
+        engine.cluster_points.assert_called_once_with('key', 'features', [1, 2], initial_partition={'1': 0})
+        self.assertEqual(interface.cache_clustering.get('key')['result'], [['1', '2']])
+
+    def test_cluster_sounds_failure(self, engine, logger):
+        engine.cluster_points.side_effect = Exception('Clustering failed')
+
+        # A complete result stored previously is kept when refreshing the clustering
+        result = clustering_result([['1', '2']])
+        interface.cache_clustering.set('key', result)
+        cluster_sounds('key', [1, 2], 'features', {'1': 0, '2': 0})
+        self.assertEqual(interface.cache_clustering.get('key'), result)
+
+        # The failed state replaces pending and coarse results
+        interface.cache_clustering.set('key', dict(result, coarse=True))
+        cluster_sounds('key', [1, 2], 'features')
+        self.assertEqual(interface.cache_clustering.get('key'), CLUSTERING_RESULT_STATUS_FAILED)
+        interface.cache_clustering.set('key', CLUSTERING_RESULT_STATUS_PENDING)
+        cluster_sounds('key', [1, 2], 'features')
+        self.assertEqual(interface.cache_clustering.get('key'), CLUSTERING_RESULT_STATUS_FAILED)
+        self.assertEqual(logger.error.call_count, 3)
+
+
+@skipIf(community is None, "The clustering dependencies are not installed")
+@mock.patch('clustering.clustering.com', community, create=True)
+@mock.patch('clustering.clustering.FeaturesStore', create=True)
+class ClusterGraphTest(SimpleTestCase):
+
+    def setUp(self):
+        # Two cliques joined by a single edge
+        self.graph = nx.Graph()
+        for clique in (['1', '2', '3', '4'], ['5', '6', '7', '8']):
+            self.graph.add_edges_from((a, b) for a in clique for b in clique if a < b)
+        self.graph.add_edge('4', '5')
+
+    def test_cluster_graph(self, features_store):
+        partition, num_communities, communities, modularity = ClusteringEngine().cluster_graph(self.graph)
+        self.assertEqual(num_communities, 2)
+        self.assertEqual(sorted(sorted(c) for c in communities), [['1', '2', '3', '4'], ['5', '6', '7', '8']])
+        self.assertGreater(modularity, 0)
+
+    def test_cluster_graph_initial_partition(self, features_store):
+        with mock.patch.object(community, 'best_partition', wraps=community.best_partition) as best_partition:
+            partition, num_communities, communities, _ = ClusteringEngine().cluster_graph(
+                self.graph, initial_partition={'1': 0, '2': 0, '5': 1, '9': 0})
+            # Sounds that are not in the initial partition start in their own community
+            initial_partition = best_partition.call_args[1]['partition']
+            self.assertEqual({node: initial_partition[node] for node in ('1', '2', '5')}, {'1': 0, '2': 0, '5': 1})
+            self.assertEqual(sorted(initial_partition.keys()), sorted(self.graph.nodes))
+            self.assertEqual(len(set(initial_partition[node] for node in ('3', '4', '6', '7', '8'))), 5)
+            self.assertTrue(all(initial_partition[node] >= 2 for node in ('3', '4', '6', '7', '8')))
+
+            ClusteringEngine().cluster_graph(self.graph, initial_partition={})
+            self.assertEqual(sorted(best_partition.call_args[1]['partition'].values()), range(8))
+
+        self.assertEqual(num_communities, 2)
+        self.assertEqual(sorted(sorted(c) for c in communities), [['1', '2', '3', '4'], ['5', '6', '7', '8']])
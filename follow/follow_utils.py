@@ -20,15 +20,25 @@
 #     See AUTHORS file.
 #
 
+import hashlib
+import json
+import urllib
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+
 from follow.models import FollowingUserItem, FollowingQueryItem
 import sounds
 from utils.search.search_general import search_prepare_query, search_prepare_sort
-from django.conf import settings
-from utils.search.solr import Solr, SolrResponseInterpreter
+from utils.search.solr import Solr
 from search.forms import SEARCH_SORT_OPTIONS_WEB
-import urllib
 
 SOLR_QUERY_LIMIT_PARAM = 3
+# Maximum number of followed users and of followed groups of tags included in a single Solr query (more are split in
+# several queries so that query URLs do not get too long)
+SOLR_MAX_USERS_PER_QUERY = 100
+SOLR_MAX_TAG_QUERIES_PER_QUERY = 50
 
 
 def get_users_following_qs(user):
@@ -65,96 +75,181 @@ def is_user_following_tag(user, slash_tag):
     return FollowingQueryItem.objects.filter(user=user, query=slash_tag.replace("/", " ")).exists()
 
 
-def get_stream_sounds(user, time_lapse):
+def get_user_stream_filter(username, time_lapse):
+    return "username:" + username + " created:" + time_lapse
 
-    solr = Solr(settings.SOLR_URL)
 
-    sort_str = search_prepare_sort("created desc", SEARCH_SORT_OPTIONS_WEB)
+def get_tags_stream_query(tags):
+    return " ".join("tag:" + tag for tag in tags)
 
-    #
-    # USERS FOLLOWING
-    #
 
-    users_following = get_users_following(user)
+def get_tags_stream_filter(tags, time_lapse):
+    return get_tags_stream_query(tags) + "  created:" + time_lapse
 
-    users_sounds = []
-    for user_following in users_following:
 
-        filter_str = "username:" + user_following.username + " created:" + time_lapse
+def get_stream_cache_key(user, time_lapse, usernames, tags_following):
+    data = json.dumps([time_lapse, usernames, tags_following])
+    return 'stream-sounds-%i-%s' % (user.id, hashlib.md5(data.encode('utf-8')).hexdigest())
 
+
+def get_users_stream_from_solr(solr, usernames, time_lapse, sort_str):
+    """Returns a dictionary with lowercased usernames as keys and (sound ids, num found) tuples as values with the
+    latest sounds uploaded by the given users. Results are grouped by username so that a single Solr query is needed
+    for every SOLR_MAX_USERS_PER_QUERY users (the username field is case insensitive, therefore the lowercased keys).
+    """
+    results = {}
+    for start in range(0, len(usernames), SOLR_MAX_USERS_PER_QUERY):
+        usernames_chunk = usernames[start:start + SOLR_MAX_USERS_PER_QUERY]
+        filter_str = u"username:(" + u" OR ".join(u'"%s"' % username for username in usernames_chunk) + \
+                     u") created:" + time_lapse
         query = search_prepare_query(
             "",
             filter_str,
             sort_str,
             1,
-            SOLR_QUERY_LIMIT_PARAM,
+            len(usernames_chunk),
             grouping=False,
             include_facets=False
         )
+        query.set_group_field(group_field="username")
+        query.set_group_options(group_limit=SOLR_QUERY_LIMIT_PARAM, group_sort=sort_str[0], group_num_groups=False)
+        response = solr.select(unicode(query))
+        for group in response['grouped']['username']['groups']:
+            doclist = group['doclist']
+            results[group['groupValue'].lower()] = ([doc['id'] for doc in doclist['docs']], doclist['numFound'])
+    return results
+
+
+def get_tags_stream_from_solr(solr, tag_queries, time_lapse, sort_str):
+    """Returns a dictionary with tag queries (see get_tags_stream_query) as keys and (sound ids, num found) tuples as
+    values with the latest sounds tagged with all the tags of every query. Every tag query is sent as a group query so
+    that a single Solr query is needed for every SOLR_MAX_TAG_QUERIES_PER_QUERY tag queries."""
+    results = {}
+    for start in range(0, len(tag_queries), SOLR_MAX_TAG_QUERIES_PER_QUERY):
+        tag_queries_chunk = tag_queries[start:start + SOLR_MAX_TAG_QUERIES_PER_QUERY]
+        query = search_prepare_query(
+            "",
+            "created:" + time_lapse,
+            sort_str,
+            1,
+            len(tag_queries_chunk),
+            grouping=False,
+            include_facets=False
+        )
+        query.set_group_options(group_query=tag_queries_chunk, group_limit=SOLR_QUERY_LIMIT_PARAM,
+                                group_sort=sort_str[0], group_num_groups=False)
+        response = solr.select(unicode(query))
+        for tag_query in tag_queries_chunk:
+            doclist = response['grouped'][tag_query]['doclist']
+            results[tag_query] = ([doc['id'] for doc in doclist['docs']], doclist['numFound'])
+    return results
+
+
+def get_stream_sounds_from_results(users_following, tags_following, time_lapse, users_results, tags_results,
+                                   sound_objs_by_id):
+    """Builds the users_sounds and tags_sounds lists returned by get_stream_sounds from the results of
+    get_users_stream_from_solr and get_tags_stream_from_solr (which might include results for other users and tags) and
+    a dictionary with the Sound objects of the results."""
+    sort_str = search_prepare_sort("created desc", SEARCH_SORT_OPTIONS_WEB)
 
-        result = SolrResponseInterpreter(solr.select(unicode(query)))
-
-        if result.num_rows != 0:
-
-            more_count = max(0, result.num_found - SOLR_QUERY_LIMIT_PARAM)
-
-            # the sorting only works if done like this!
-            more_url_params = [urllib.quote(filter_str), urllib.quote(sort_str[0])]
+    def build_stream_item(ids, num_found, filter_str):
+        more_count = max(0, num_found - SOLR_QUERY_LIMIT_PARAM)
+        # the sorting only works if done like this!
+        more_url_params = [urllib.quote(filter_str), urllib.quote(sort_str[0])]
+        sound_objs = [sound_objs_by_id[sound_id] for sound_id in ids if sound_id in sound_objs_by_id]
+        new_count = more_count + len(ids)
+        return sound_objs, more_url_params, more_count, new_count
 
-            # this is the same link but for the email has to be "quoted"
-            more_url = u"?f=" + filter_str + u"&s=" + sort_str[0]
-            # more_url_quoted = urllib.quote(more_url)
+    #
+    # USERS FOLLOWING
+    #
 
-            sound_ids = [element['id'] for element in result.docs]
-            sound_objs = sounds.models.Sound.objects.filter(id__in=sound_ids).select_related('license', 'user')
-            new_count = more_count + len(sound_ids)
-            users_sounds.append(((user_following, False), sound_objs, more_url_params, more_count, new_count))
+    users_sounds = []
+    for user_following in users_following:
+        ids, num_found = users_results.get(user_following.username.lower(), ([], 0))
+        if ids:
+            filter_str = get_user_stream_filter(user_following.username, time_lapse)
+            users_sounds.append(((user_following, False), ) + build_stream_item(ids, num_found, filter_str))
 
     #
     # TAGS FOLLOWING
     #
 
-    tags_following = get_tags_following(user)
-
     tags_sounds = []
     for tag_following in tags_following:
-
         tags = tag_following.split(" ")
-        tag_filter_query = ""
-        for tag in tags:
-            tag_filter_query += "tag:" + tag + " "
-
-        tag_filter_str = tag_filter_query + " created:" + time_lapse
-
-        query = search_prepare_query(
-            "",
-            tag_filter_str,
-            sort_str,
-            1,
-            SOLR_QUERY_LIMIT_PARAM,
-            grouping=False,
-            include_facets=False
-        )
-
-        result = SolrResponseInterpreter(solr.select(unicode(query)))
+        ids, num_found = tags_results.get(get_tags_stream_query(tags), ([], 0))
+        if ids:
+            filter_str = get_tags_stream_filter(tags, time_lapse)
+            tags_sounds.append((tags, ) + build_stream_item(ids, num_found, filter_str))
 
-        if result.num_rows != 0:
+    return users_sounds, tags_sounds
 
-            more_count = max(0, result.num_found - SOLR_QUERY_LIMIT_PARAM)
 
-            # the sorting only works if done like this!
-            more_url_params = [urllib.quote(tag_filter_str), urllib.quote(sort_str[0])]
+def get_sound_objs_for_results(*results):
+    """Returns a dictionary with the Sound objects (loaded with a single query) of all the sound ids in the given
+    results dictionaries (see get_users_stream_from_solr)."""
+    sound_ids = set()
+    for results_dict in results:
+        for ids, _ in results_dict.values():
+            sound_ids.update(ids)
+    if not sound_ids:
+        return {}
+    return sounds.models.Sound.objects.dict_ids(list(sound_ids))
 
-            # this is the same link but for the email has to be "quoted"
-            more_url = u"?f=" + tag_filter_str + u"&s=" + sort_str[0]
-            # more_url_quoted = urllib.quote(more_url)
 
-            sound_ids = [element['id'] for element in result.docs]
-            sound_objs = sounds.models.Sound.objects.filter(id__in=sound_ids)
-            new_count = more_count + len(sound_ids)
-            tags_sounds.append((tags, sound_objs, more_url_params, more_count, new_count))
+def get_stream_sounds(user, time_lapse):
+    """Returns the latest sounds uploaded by the users followed by user and the latest sounds tagged with the tags
+    followed by user in the given time_lapse. All followed users and followed tags are queried with a few grouped
+    Solr queries, and the results of these queries are cached for settings.STREAM_SOUNDS_CACHE_TIME seconds (the cache
+    key depends on the followed users and tags so that changes in these are reflected immediately). Sound objects are
+    loaded with a single query."""
+    users_following = get_users_following(user)
+    tags_following = get_tags_following(user)
+    usernames = [user_following.username for user_following in users_following]
+
+    cache_key = get_stream_cache_key(user, time_lapse, usernames, tags_following)
+    stream_results = cache.get(cache_key)
+    if stream_results is None:
+        solr = Solr(settings.SOLR_URL)
+        sort_str = search_prepare_sort("created desc", SEARCH_SORT_OPTIONS_WEB)
+        tag_queries = [get_tags_stream_query(tag_following.split(" ")) for tag_following in tags_following]
+        stream_results = (get_users_stream_from_solr(solr, usernames, time_lapse, sort_str),
+                          get_tags_stream_from_solr(solr, tag_queries, time_lapse, sort_str))
+        cache.set(cache_key, stream_results, settings.STREAM_SOUNDS_CACHE_TIME)
+    users_results, tags_results = stream_results
+
+    return get_stream_sounds_from_results(users_following, tags_following, time_lapse, users_results, tags_results,
+                                          get_sound_objs_for_results(users_results, tags_results))
+
+
+def get_users_stream_sounds(users, time_lapse):
+    """Returns a dictionary with user ids as keys and (users_sounds, tags_sounds) tuples (see get_stream_sounds) as
+    values with the streams of all the given users for the same time_lapse. The users and tags followed by all users
+    are loaded at once and every distinct followed user and group of tags is only queried once in Solr, so this is much
+    faster than calling get_stream_sounds for every user when many of them follow the same users or tags."""
+    user_ids = [user.id for user in users]
+    users_following = defaultdict(list)
+    for item in FollowingUserItem.objects.select_related('user_to__profile')\
+            .filter(user_from_id__in=user_ids).order_by('user_to__username'):
+        users_following[item.user_from_id].append(item.user_to)
+    tags_following = defaultdict(list)
+    for item in FollowingQueryItem.objects.filter(user_id__in=user_ids).order_by('query'):
+        tags_following[item.user_id].append(item.query)
+
+    usernames = sorted(set(user_following.username for users_list in users_following.values()
+                           for user_following in users_list))
+    tag_queries = sorted(set(get_tags_stream_query(tag_following.split(" ")) for tags_list in tags_following.values()
+                             for tag_following in tags_list))
+    solr = Solr(settings.SOLR_URL)
+    sort_str = search_prepare_sort("created desc", SEARCH_SORT_OPTIONS_WEB)
+    users_results = get_users_stream_from_solr(solr, usernames, time_lapse, sort_str)
+    tags_results = get_tags_stream_from_solr(solr, tag_queries, time_lapse, sort_str)
+    sound_objs_by_id = get_sound_objs_for_results(users_results, tags_results)
 
-    return users_sounds, tags_sounds
+    return {user_id: get_stream_sounds_from_results(users_following[user_id], tags_following[user_id], time_lapse,
+                                                    users_results, tags_results, sound_objs_by_id)
+            for user_id in user_ids}
 
 
 def build_time_lapse(date_from, date_to):
@@ -20,9 +20,12 @@
 import datetime
 import json
 import logging
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
-from django.contrib.auth.models import User
+from django.core.mail import get_connection
+from django.db import connection as db_connection
 
 from accounts.models import Profile, EmailPreferenceType
 from follow import follow_utils
@@ -34,9 +37,48 @@ commands_logger = logging.getLogger("commands")
 console_logger = logging.getLogger('console')
 
 
+def send_stream_emails(emails):
+    """Sends the given list of (profile, extra_email_subject, text_content) tuples reusing a single SMTP connection.
+    Returns a list of (profile, error) tuples where error is None if the email was sent. This runs in the threads of
+    the pool of the command, so the database connection of the thread is closed at the end."""
+    results = []
+    email_connection = get_connection(username=None, password=None, fail_silently=False)
+    try:
+        email_connection.open()
+        for profile, extra_email_subject, text_content in emails:
+            if not profile.email_is_valid():
+                # send_mail would not send the email either, check it here so that a failed send_mail means that the
+                # SMTP connection failed
+                results.append((profile, None))
+                continue
+            try:
+                sent = send_mail(settings.EMAIL_SUBJECT_STREAM_EMAILS, text_content,
+                                 extra_subject=extra_email_subject, user_to=profile.user, connection=email_connection)
+            except Exception as e:
+                results.append((profile, e))
+                continue
+            results.append((profile, None))
+            if not sent:
+                # The SMTP connection might be broken after the error, start a new one for the next emails
+                email_connection.close()
+                email_connection.open()
+    except Exception as e:
+        # Could not open the SMTP connection, the remaining emails are not sent
+        sent_profiles = set(profile.id for profile, _ in results)
+        results += [(profile, e) for profile, _, _ in emails if profile.id not in sent_profiles]
+    finally:
+        email_connection.close()
+        db_connection.close()
+    return results
+
+
 class Command(LoggingBaseCommand):
     """
     This command should be run periodically several times a day, and it will only send emails to users that "require it"
+
+    Users are grouped by the period for which their stream is computed so that the sounds of every followed user and
+    group of tags are only queried once per period (see follow_utils.get_users_stream_sounds). Emails are rendered in
+    the main thread and sent from settings.STREAM_EMAILS_NUM_WORKERS threads, each one reusing its SMTP connection.
     """
     help = 'Send stream notifications to users who have not been notified for the last ' \
            'settings.NOTIFICATION_TIMEDELTA_PERIOD period and whose stream has new sounds for that period'
@@ -56,63 +98,69 @@ class Command(LoggingBaseCommand):
 
         users_enabled_notifications = Profile.objects.filter(user_id__in=user_ids).exclude(
             last_stream_email_sent__gt=date_today_minus_notification_timedelta).order_by(
-            "-last_attempt_of_sending_stream_email")[:settings.MAX_EMAILS_PER_COMMAND_RUN]
+            "-last_attempt_of_sending_stream_email").select_related('user')[:settings.MAX_EMAILS_PER_COMMAND_RUN]
 
-        n_emails_sent = 0
-        for profile in users_enabled_notifications:
+        # Variable names use the terminology "week" because settings.NOTIFICATION_TIMEDELTA_PERIOD defaults to a
+        # week, but a more generic terminology could be used
+        week_last_day = datetime.datetime.now()
+        week_last_day_str = week_last_day.strftime("%d %b").lstrip("0")
 
-            username = profile.user.username
+        # Group users by the date range from which to get upload notifications
+        profiles_by_time_lapse = defaultdict(list)
+        for profile in users_enabled_notifications:
             profile.last_attempt_of_sending_stream_email = datetime.datetime.now()
+            time_lapse = follow_utils.build_time_lapse(profile.last_stream_email_sent, week_last_day)
+            profiles_by_time_lapse[time_lapse].append(profile)
 
-            # Variable names use the terminology "week" because settings.NOTIFICATION_TIMEDELTA_PERIOD defaults to a
-            # week, but a more generic terminology could be used
-            week_first_day = profile.last_stream_email_sent
-            week_last_day = datetime.datetime.now()
-
-            week_first_day_str = week_first_day.strftime("%d %b").lstrip("0")
-            week_last_day_str = week_last_day.strftime("%d %b").lstrip("0")
-
-            extra_email_subject = unicode(week_first_day_str) + u' to ' + unicode(week_last_day_str)
-
-            # Set date range from which to get upload notifications
-            time_lapse = follow_utils.build_time_lapse(week_first_day, week_last_day)
-
-            # construct message
-            user = User.objects.get(username=username)
+        # Construct messages
+        emails = []
+        for time_lapse, profiles in profiles_by_time_lapse.items():
             try:
-                users_sounds, tags_sounds = follow_utils.get_stream_sounds(user, time_lapse)
+                streams = follow_utils.get_users_stream_sounds([profile.user for profile in profiles], time_lapse)
             except Exception as e:
-                # If error occur do not send the email
-                console_logger.info("could not get new sounds data for {0}".format(username.encode('utf-8')))
-                profile.save()  # Save last_attempt_of_sending_stream_email
+                # If error occur do not send the emails
+                console_logger.info("could not get new sounds data for {0} users ({1})".format(len(profiles), e))
+                for profile in profiles:
+                    profile.save()  # Save last_attempt_of_sending_stream_email
                 continue
 
-            if not users_sounds and not tags_sounds:
-                console_logger.info("no news sounds for {0}".format(username.encode('utf-8')))
-                profile.save()  # Save last_attempt_of_sending_stream_email
-                continue
-
-            tvars = {'username': username,
-                     'users_sounds': users_sounds,
-                     'tags_sounds': tags_sounds}
-            text_content = render_mail_template('follow/email_stream.txt', tvars)
-
-            # Send email
-            try:
-                send_mail(settings.EMAIL_SUBJECT_STREAM_EMAILS, text_content,
-                          extra_subject=extra_email_subject, user_to=user)
-            except Exception as e:
-                # Do not send the email and do not update the last email sent field in the profile
-                profile.save()  # Save last_attempt_of_sending_stream_email
-                commands_logger.error("Unexpected error while sending stream notification email (%s)" % json.dumps(
-                    {'email_to': profile.get_email_for_delivery(),
-                     'username': profile.user.username,
-                     'error': str(e)}))
-                continue
-            n_emails_sent += 1
-
-            # update last stream email sent date
-            profile.last_stream_email_sent = datetime.datetime.now()
-            profile.save()
+            for profile in profiles:
+                username = profile.user.username
+                users_sounds, tags_sounds = streams[profile.user_id]
+                if not users_sounds and not tags_sounds:
+                    console_logger.info("no news sounds for {0}".format(username.encode('utf-8')))
+                    profile.save()  # Save last_attempt_of_sending_stream_email
+                    continue
+
+                week_first_day_str = profile.last_stream_email_sent.strftime("%d %b").lstrip("0")
+                extra_email_subject = unicode(week_first_day_str) + u' to ' + unicode(week_last_day_str)
+                tvars = {'username': username,
+                         'users_sounds': users_sounds,
+                         'tags_sounds': tags_sounds}
+                emails.append((profile, extra_email_subject, render_mail_template('follow/email_stream.txt', tvars)))
+
+        # Send emails
+        n_emails_sent = 0
+        if emails:
+            num_workers = min(settings.STREAM_EMAILS_NUM_WORKERS, len(emails))
+            pool = ThreadPool(num_workers)
+            results = pool.map(send_stream_emails, [emails[i::num_workers] for i in range(num_workers)])
+            pool.close()
+            pool.join()
+
+            for profile, error in [result for worker_results in results for result in worker_results]:
+                if error is not None:
+                    # Do not update the last email sent field in the profile
+                    profile.save()  # Save last_attempt_of_sending_stream_email
+                    commands_logger.error("Unexpected error while sending stream notification email (%s)" % json.dumps(
+                        {'email_to': profile.get_email_for_delivery(),
+                         'username': profile.user.username,
+                         'error': str(error)}))
+                    continue
+                n_emails_sent += 1
+
+                # update last stream email sent date
+                profile.last_stream_email_sent = datetime.datetime.now()
+                profile.save()
 
         self.log_end({'n_users_notified': n_emails_sent})
@@ -19,11 +19,18 @@
 # Authors:
 #     See AUTHORS file.
 #
+import smtplib
+
+import mock
+from django.core.cache import cache
 from django.test import TestCase
 from django.test.client import Client
-from accounts.models import Profile
+from accounts.models import Profile, EmailBounce
 from django.contrib.auth.models import User
+from follow import follow_utils
+from follow.management.commands.send_stream_emails import send_stream_emails
 from follow.models import FollowingUserItem, FollowingQueryItem
+from utils.test_helpers import create_user_and_sounds
 
 
 class FollowTestCase(TestCase):
@@ -147,3 +154,105 @@ class FollowTestCase(TestCase):
         # Stream should return OK
         resp = self.client.get("/home/stream/")
         self.assertEqual(resp.status_code, 200)
+
+
+class StreamSoundsTestCase(TestCase):
+
+    fixtures = ['licenses']
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("follower", password="testpass")
+        self.followed_user, _, self.sounds = create_user_and_sounds(num_sounds=5, tags="field-recording")
+        FollowingUserItem.objects.create(user_from=self.user, user_to=self.followed_user)
+        FollowingQueryItem.objects.create(user=self.user, query="field-recording")
+        self.time_lapse = "[2018-01-01T00:00:00Z TO 2018-01-07T23:59:59.999Z]"
+
+    def fake_solr_select(self, query):
+        sound_ids = [sound.id for sound in reversed(self.sounds)][:follow_utils.SOLR_QUERY_LIMIT_PARAM]
+        doclist = {'numFound': 5, 'docs': [{'id': sound_id} for sound_id in sound_ids]}
+        if 'group.field=username' in query:
+            return {'grouped': {'username': {'groups': [
+                {'groupValue': self.followed_user.username.lower(), 'doclist': doclist}]}}}
+        return {'grouped': {'tag:field-recording': {'doclist': doclist}}}
+
+    @mock.patch('follow.follow_utils.Solr')
+    def test_get_stream_sounds(self, solr):
+        solr.return_value.select.side_effect = self.fake_solr_select
+
+        # Followed users and tags are requested with one Solr query each and sounds are loaded with one DB query
+        with self.assertNumQueries(3):
+            users_sounds, tags_sounds = follow_utils.get_stream_sounds(self.user, self.time_lapse)
+        self.assertEqual(solr.return_value.select.call_count, 2)
+
+        expected_ids = [sound.id for sound in reversed(self.sounds)][:follow_utils.SOLR_QUERY_LIMIT_PARAM]
+        (user, _), sound_objs, more_url_params, more_count, new_count = users_sounds[0]
+        self.assertEqual(user, self.followed_user)
+        self.assertEqual([sound_obj.id for sound_obj in sound_objs], expected_ids)
+        self.assertEqual(more_count, 2)
+        self.assertEqual(new_count, 5)
+        self.assertIn('username%3A' + self.followed_user.username, more_url_params[0])
+
+        tags, sound_objs, more_url_params, more_count, new_count = tags_sounds[0]
+        self.assertEqual(tags, ["field-recording"])
+        self.assertEqual([sound_obj.id for sound_obj in sound_objs], expected_ids)
+        self.assertEqual(new_count, 5)
+
+        # Solr results are cached
+        follow_utils.get_stream_sounds(self.user, self.time_lapse)
+        self.assertEqual(solr.return_value.select.call_count, 2)
+
+        # Changes in the followed tags are not hidden by the cache
+        FollowingQueryItem.objects.create(user=self.user, query="another-tag")
+        solr.return_value.select.side_effect = lambda query: {'grouped': {
+            'tag:field-recording': {'doclist': {'numFound': 0, 'docs': []}},
+            'tag:another-tag': {'doclist': {'numFound': 0, 'docs': []}}}} if 'group.query' in query \
+            else self.fake_solr_select(query)
+        users_sounds, tags_sounds = follow_utils.get_stream_sounds(self.user, self.time_lapse)
+        self.assertEqual(solr.return_value.select.call_count, 4)
+        self.assertEqual(len(users_sounds), 1)
+        self.assertEqual(tags_sounds, [])
+
+    @mock.patch('follow.follow_utils.Solr')
+    def test_get_users_stream_sounds(self, solr):
+        solr.return_value.select.side_effect = self.fake_solr_select
+        other_user = User.objects.create_user("other_follower", email="other@freesound.org", password="testpass")
+        FollowingUserItem.objects.create(user_from=other_user, user_to=self.followed_user)
+        not_following_user = User.objects.create_user("not_follower", email="not@freesound.org", password="testpass")
+
+        # Users and tags followed by several users are only requested once
+        with self.assertNumQueries(3):
+            streams = follow_utils.get_users_stream_sounds(
+                [self.user, other_user, not_following_user], self.time_lapse)
+        self.assertEqual(solr.return_value.select.call_count, 2)
+
+        expected_ids = [sound.id for sound in reversed(self.sounds)][:follow_utils.SOLR_QUERY_LIMIT_PARAM]
+        users_sounds, tags_sounds = streams[self.user.id]
+        self.assertEqual([sound_obj.id for sound_obj in users_sounds[0][1]], expected_ids)
+        self.assertEqual([sound_obj.id for sound_obj in tags_sounds[0][1]], expected_ids)
+        users_sounds, tags_sounds = streams[other_user.id]
+        self.assertEqual([sound_obj.id for sound_obj in users_sounds[0][1]], expected_ids)
+        self.assertEqual(tags_sounds, [])
+        self.assertEqual(streams[not_following_user.id], ([], []))
+
+
+class SendStreamEmailsTestCase(TestCase):
+
+    def setUp(self):
+        self.profiles = [User.objects.create_user("user%i" % i, email="user%i@freesound.org" % i).profile
+                         for i in range(4)]
+        EmailBounce.objects.create(user=self.profiles[1].user, type=EmailBounce.PERMANENT)
+
+    @mock.patch('follow.management.commands.send_stream_emails.db_connection')
+    @mock.patch('follow.management.commands.send_stream_emails.get_connection')
+    def test_send_stream_emails(self, get_connection, db_connection):
+        email_connection = get_connection.return_value
+        email_connection.send_messages.side_effect = [1, smtplib.SMTPServerDisconnected('Connection lost'), 1]
+        results = send_stream_emails([(profile, 'subject', 'content') for profile in self.profiles])
+        self.assertEqual(results, [(profile, None) for profile in self.profiles])
+
+        # The email to the bounced address is not sent, and the connection is only reopened after the SMTP error
+        self.assertEqual(email_connection.send_messages.call_count, 3)
+        self.assertEqual(email_connection.open.call_count, 2)
+        self.assertEqual(email_connection.close.call_count, 2)
+        db_connection.close.assert_called_once_with()
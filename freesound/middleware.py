@@ -18,43 +18,61 @@
 #     See AUTHORS file.
 #
 
+import re
+
 from django.conf import settings
 from django.http import HttpResponseRedirect
 from django.urls import reverse
 from django.contrib import messages
 
+from accounts.models import get_user_gate_state
 from utils.onlineusers import cache_online_users
 
 
-class OnlineUsersHandler(object):
-    def __init__(self, get_response):
-        self.get_response = get_response
+def compile_path_matcher(substrings):
+    """Returns a compiled regular expression which matches paths containing any of the given substrings."""
+    return re.compile('|'.join(re.escape(substring) for substring in substrings))
 
-    def __call__(self, request):
-        cache_online_users(request)
-        response = self.get_response(request)
-        return response
 
+class UserGateHandler(object):
+    """
+    For authenticated users, redirects to the terms of service acceptance page, the bulk license change page or the
+    email reset page if the user has not accepted the terms of service, has sounds with old licenses or has an invalid
+    email address (in that order), and records the user as online.
+
+    The profile fields needed for these checks are obtained from a cached per-user "gate state" (see
+    accounts.models.get_user_gate_state), so in most requests no queries are needed. Paths where each redirect must not
+    happen (to avoid infinite loops and to allow users to log out or read the terms of service) are matched with
+    precompiled regular expressions.
+    """
+    tos_exempt_paths = compile_path_matcher(
+        ['tosacceptance', 'logout', 'tos_api', 'tos_web', 'contact', 'bulklicensechange'])
+    license_exempt_paths = compile_path_matcher(['bulklicensechange', 'logout', 'tosacceptance'])
+    email_exempt_paths = compile_path_matcher(
+        ['tosacceptance', 'logout', 'tos_api', 'tos_web', 'contact', 'bulklicensechange', 'resetemail'])
+    invalid_email_message = "We have identified that some emails that we have sent to you didn't go through, thus it " \
+                            "appears that your email address is not valid. Please update your email address to a " \
+                            "working one to continue using Freesound"
 
-class BulkChangeLicenseHandler(object):
     def __init__(self, get_response):
         self.get_response = get_response
 
     def __call__(self, request):
-        # check for authentication,
-        # avoid infinite loop
-        # allow user to logout (maybe a bit too much...)
-        # don't run it for media URLs
-        # N.B. probably better just to check for login in the URL
-        if request.user.is_authenticated \
-                and 'bulklicensechange' not in request.get_full_path() \
-                and 'logout' not in request.get_full_path() \
-                and 'tosacceptance' not in request.get_full_path() \
-                and not request.get_full_path().startswith(settings.MEDIA_URL):
-
-            user = request.user
-            if user.profile.has_old_license:
-                return HttpResponseRedirect(reverse("bulk-license-change"))
+        if request.user.is_authenticated:
+            gate_state = get_user_gate_state(request.user)
+            path = request.get_full_path()
+            if not path.startswith(settings.MEDIA_URL):
+                if not gate_state['accepted_tos'] and not self.tos_exempt_paths.search(path):
+                    return HttpResponseRedirect(reverse("tos-acceptance"))
+
+                if gate_state['has_old_license'] and not self.license_exempt_paths.search(path):
+                    return HttpResponseRedirect(reverse("bulk-license-change"))
+
+                if not gate_state['email_valid'] and not self.email_exempt_paths.search(path):
+                    messages.add_message(request, messages.INFO, self.invalid_email_message)
+                    return HttpResponseRedirect(reverse("accounts-email-reset"))
+
+            cache_online_users(request, gate_state['not_shown_in_online_users_list'])
 
         response = self.get_response(request)
         return response
@@ -74,56 +92,3 @@ class FrontendPreferenceHandler(object):
                 request.GET.get(settings.FRONTEND_CHOOSER_REQ_PARAM_NAME)
         response = self.get_response(request)
         return response
-
-
-class TosAcceptanceHandler(object):
-    def __init__(self, get_response):
-        self.get_response = get_response
-
-    def __call__(self, request):
-
-        if request.user.is_authenticated \
-                and 'tosacceptance' not in request.get_full_path() \
-                and 'logout' not in request.get_full_path() \
-                and 'tos_api' not in request.get_full_path() \
-                and 'tos_web' not in request.get_full_path() \
-                and 'contact' not in request.get_full_path() \
-                and 'bulklicensechange' not in request.get_full_path() \
-                and not request.get_full_path().startswith(settings.MEDIA_URL):
-
-            user = request.user
-            if not user.profile.accepted_tos:
-                return HttpResponseRedirect(reverse("tos-acceptance"))
-
-        response = self.get_response(request)
-        return response
-
-
-class UpdateEmailHandler(object):
-    message = "We have identified that some emails that we have sent to you didn't go through, thus it appears that " \
-              "your email address is not valid. Please update your email address to a working one to continue using " \
-              "Freesound"
-
-    def __init__(self, get_response):
-        self.get_response = get_response
-
-    def __call__(self, request):
-        if request.user.is_authenticated \
-                and 'tosacceptance' not in request.get_full_path() \
-                and 'logout' not in request.get_full_path() \
-                and 'tos_api' not in request.get_full_path() \
-                and 'tos_web' not in request.get_full_path() \
-                and 'contact' not in request.get_full_path() \
-                and 'bulklicensechange' not in request.get_full_path() \
-                and 'resetemail' not in request.get_full_path() \
-                and not request.get_full_path().startswith(settings.MEDIA_URL):
-                # replace with dont_redirect() and add resetemail to it after merge with gdpr_acceptance pr
-
-            user = request.user
-
-            if not user.profile.email_is_valid():
-                messages.add_message(request, messages.INFO, self.message)
-                return HttpResponseRedirect(reverse("accounts-email-reset"))
-
-        response = self.get_response(request)
-        return response
@@ -30,10 +30,7 @@ MIDDLEWARE = [
     'silk.middleware.SilkyMiddleware',
     'admin_reorder.middleware.ModelAdminReorder',
     'ratelimit.middleware.RatelimitMiddleware',
-    'freesound.middleware.TosAcceptanceHandler',
-    'freesound.middleware.BulkChangeLicenseHandler',
-    'freesound.middleware.UpdateEmailHandler',
-    'freesound.middleware.OnlineUsersHandler',
+    'freesound.middleware.UserGateHandler',
     'corsheaders.middleware.CorsMiddleware',
     'freesound.middleware.FrontendPreferenceHandler',
 ]
@@ -159,7 +156,6 @@ REDIS_HOST = 'redis'
 REDIS_PORT = 6379
 API_MONITORING_REDIS_STORE_ID = 0
 CACHE_REDIS_STORE_ID = 1
-AUDIO_FEATURES_REDIS_STORE_ID = 2
 CELERY_BROKER_REDIS_STORE_ID = 3
 
 CACHES = {
@@ -374,7 +370,11 @@ LOG_DOWNLOADS = False
 
 # Followers notifications
 MAX_EMAILS_PER_COMMAND_RUN = 5000
+STREAM_EMAILS_NUM_WORKERS = 4  # Number of threads (each one with its own SMTP connection) used to send stream emails
 NOTIFICATION_TIMEDELTA_PERIOD = datetime.timedelta(days=7)
+# Time (in seconds) for which the Solr results of the stream of a user are cached (used by the stream page and by the
+# stream emails)
+STREAM_SOUNDS_CACHE_TIME = 60 * 60
 
 
 # -------------------------------------------------------------------------------
@@ -467,6 +467,19 @@ SOLR_DYNAMIC_FIELDS_SUFFIX_MAP = {
 SOLR_URL = "http://search:8080/fs2/"
 SOLR_FORUM_URL = "http://search:8080/forum/"
 
+# Timeout (in seconds) for the queries of the search page (see utils.search.search_general.perform_solr_query)
+SOLR_QUERY_TIMEOUT = 30
+
+# Cache of Solr responses for the queries of the search page (see utils.search.query_cache). Entries expire after
+# SOLR_QUERY_CACHE_TTL seconds (0 disables the cache) and are invalidated when the index is updated. If
+# SOLR_QUERY_CACHE_SHARED_CACHE is set to the name of one of the CACHES, responses and index updates are shared
+# between processes, otherwise each process has its own cache.
+SOLR_QUERY_CACHE_TTL = 60
+SOLR_QUERY_CACHE_MAX_ENTRIES = 500
+SOLR_QUERY_CACHE_MAX_BODY_SIZE = 1024 * 1024  # Bigger responses (in bytes) are not cached
+SOLR_QUERY_CACHE_SHARED_CACHE = None
+SOLR_QUERY_CACHE_GENERATION_CHECK_INTERVAL = 5
+
 ENABLE_QUERY_SUGGESTIONS = False  # Only for BW
 DEFAULT_SEARCH_WEIGHTS = {
     'id': 4,
@@ -485,6 +498,11 @@ SIMILARITY_PORT = 8008
 SIMILARITY_INDEXING_SERVER_PORT = 8009
 SIMILARITY_TIMEOUT = 10
 
+# In-process cache of sound descriptors used in front of the shared cache (see
+# utils.similarity_utilities.get_sounds_descriptors), size in number of sounds and time in seconds
+SIMILARITY_DESCRIPTORS_LOCAL_CACHE_SIZE = 2000
+SIMILARITY_DESCRIPTORS_LOCAL_CACHE_TIME = 60 * 5
+
 # -------------------------------------------------------------------------------
 # Tag recommendation client settings
 TAGRECOMMENDATION_ADDRESS = 'tagrecommendation'
@@ -516,6 +534,22 @@ GRAYLOG_PASSWORD = ''
 
 MAPBOX_ACCESS_TOKEN = ''
 
+# The precomputed tile with all public geotags (see geotags.tiles.GeotagTiles, stored in GEOTAGS_TILES_PATH) is not
+# updated when sounds or geotags change: the update_geotags_tiles management command, which reloads all geotags, must
+# be run periodically (e.g. every 5 minutes with cron). Geotags served from the tile can be outdated by the interval
+# between runs plus the 15 minutes for which geotags views are cached.
+
+# In-memory index used for bounding box queries of geotags (see geotags.spatial_index.GeotagsIndex). Indexes are
+# rebuilt every GEOTAGS_INDEX_MAX_AGE seconds to include changes made in other processes. If
+# GEOTAGS_INDEX_SHARED_CACHE is set to the name of one of the CACHES shared by all processes (not a LocMemCache),
+# processes which change sounds or geotags increase a generation number stored there and indexes are rebuilt when it
+# changes (checked every GEOTAGS_INDEX_GENERATION_CHECK_INTERVAL seconds).
+GEOTAGS_INDEX_CELL_SIZE = 1.0  # In degrees
+GEOTAGS_INDEX_MAX_DELTA = 1000
+GEOTAGS_INDEX_MAX_AGE = 60 * 60
+GEOTAGS_INDEX_SHARED_CACHE = None
+GEOTAGS_INDEX_GENERATION_CHECK_INTERVAL = 30
+
 
 # -------------------------------------------------------------------------------
 # Recaptcha settings
@@ -542,6 +576,13 @@ WORKER_MIN_FREE_DISK_SPACE_PERCENTAGE = 0.05
 # General timeout for processing/analysis workers (in seconds)
 WORKER_TIMEOUT = 60 * 60
 
+# Displays of files longer than this number of frames (~3 minutes at 44.1kHz, a buffer of ~64MB) are generated by
+# reading the file in chunks instead of loading it in memory, so memory usage does not grow with the length of the file
+PROCESSING_DISPLAYS_MAX_IN_MEMORY_FRAMES = 44100 * 60 * 3
+
+# Max number of preview encoders (lame/oggenc) that run at the same time when processing a sound
+PROCESSING_MAX_CONCURRENT_ENCODERS = 4
+
 ESSENTIA_EXECUTABLE = '/usr/local/bin/essentia_streaming_extractor_freesound'
 ESSENTIA_STATS_OUT_FORMAT = 'yaml'
 ESSENTIA_FRAMES_OUT_FORMAT = 'json'
@@ -582,6 +623,13 @@ BLOCKED_IPS = []
 CACHED_BLOCKED_IPS_KEY = 'cached_blocked_ips'
 CACHED_BLOCKED_IPS_TIME = 60 * 5  # 5 minutes
 
+# The profile information checked by freesound.middleware.UserGateHandler can be cached in USER_GATE_STATE_CACHE (the
+# name of one of the CACHES) for USER_GATE_STATE_CACHE_TIME seconds. The cache is invalidated when that information
+# changes, so it must be shared by all web processes and by the management commands which change profiles or email
+# bounces (e.g. process_email_bounces). Don't use a LocMemCache. If None, the information is loaded on every request.
+USER_GATE_STATE_CACHE = None
+USER_GATE_STATE_CACHE_TIME = 60 * 60
+
 # -------------------------------------------------------------------------------
 # API settings
 
@@ -761,6 +809,7 @@ PACKS_PATH = os.path.join(DATA_PATH, "packs/")
 UPLOADS_PATH = os.path.join(DATA_PATH, "uploads/")
 CSV_PATH = os.path.join(DATA_PATH, "csv/")
 ANALYSIS_PATH = os.path.join(DATA_PATH, "analysis/")
+GEOTAGS_TILES_PATH = os.path.join(DATA_PATH, "geotags_tiles/")
 FILE_UPLOAD_TEMP_DIR = os.path.join(DATA_PATH, "tmp_uploads/")
 PROCESSING_TEMP_DIR = os.path.join(DATA_PATH, "tmp_processing/")
 
@@ -22,7 +22,7 @@ import logging
 
 from sounds.models import Sound
 from utils.management_commands import LoggingBaseCommand
-from utils.search.search_general import get_all_sound_ids_from_solr, delete_sounds_from_solr
+from utils.search.search_general import get_solr_index_diff, delete_sounds_from_solr
 from utils.similarity_utilities import Similarity
 
 console_logger = logging.getLogger('console')
@@ -46,31 +46,26 @@ class Command(LoggingBaseCommand):
     def handle(self,  *args, **options):
         self.log_start()
 
-        # Get all solr ids
-        console_logger.info("Getting solr ids...")
-        solr_ids = get_all_sound_ids_from_solr()
+        # Compare solr ids with all moderated and processed sound ids
+        console_logger.info("Comparing solr ids with freesound db ids...")
+        in_solr_not_in_fs, in_fs_not_in_solr, n_solr_ids, n_fs_mp = get_solr_index_diff(
+            Sound.objects.filter(processing_state='OK', moderation_state='OK'))
 
         # Get ell gaia ids
         console_logger.info("Getting gaia ids...")
         gaia_ids = Similarity.get_all_sound_ids()
 
         console_logger.info("Getting freesound db data...")
-        # Get all moderated and processed sound ids
-        queryset = Sound.objects.filter(processing_state='OK', moderation_state='OK').order_by('id').only("id")
-        fs_mp = [sound.id for sound in queryset]
         # Get ell moderated, processed and analysed sounds
         queryset = Sound.objects.filter(processing_state='OK', moderation_state='OK', analysis_state='OK')\
             .order_by('id').only("id")
         fs_mpa = [sound.id for sound in queryset]
 
-        in_solr_not_in_fs = list(set(solr_ids).intersection(set(set(solr_ids).difference(fs_mp))))
-        in_fs_not_in_solr = list(set(fs_mp).intersection(set(set(fs_mp).difference(solr_ids))))
-
         messages = []
         messages.append("\nNumber of sounds per index:\n--------------------------")
-        messages.append("Solr index\t\t%i" % len(solr_ids))
+        messages.append("Solr index\t\t%i" % n_solr_ids)
         messages.append("Gaia index\t\t%i" % len(gaia_ids))
-        messages.append("Freesound\t\t%i  (moderated and processed)" % len(fs_mp))
+        messages.append("Freesound\t\t%i  (moderated and processed)" % n_fs_mp)
         messages.append("Freesound\t\t%i  (moderated, processed and analyzed)" % len(fs_mpa))
         messages.append("\n\n***************\nSOLR INDEX\n***************\n")
         messages.append("Sounds in solr but not in fs:\t%i" % len(in_solr_not_in_fs))
@@ -117,10 +112,10 @@ class Command(LoggingBaseCommand):
                     Similarity.delete(sid)
 
         self.log_end({
-            'n_sounds_in_db_moderated_processed': len(fs_mp),
+            'n_sounds_in_db_moderated_processed': n_fs_mp,
             'n_sounds_in_db_moderated_processed_analyzed': len(fs_mpa),
             'n_sounds_in_gaia': len(gaia_ids),
-            'n_sounds_in_solr': len(solr_ids),
+            'n_sounds_in_solr': n_solr_ids,
             'n_sounds_in_solr_but_not_in_fs': len(in_solr_not_in_fs),
             'n_sounds_in_fs_but_not_in_solr': len(in_fs_not_in_solr),
             'n_sounds_in_gaia_but_not_in_fs': len(in_gaia_not_in_fs),
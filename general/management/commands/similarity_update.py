@@ -19,6 +19,8 @@
 #
 
 import logging
+from itertools import izip
+from multiprocessing.pool import ThreadPool
 
 import yaml
 
@@ -29,6 +31,52 @@ from utils.management_commands import LoggingBaseCommand
 console_logger = logging.getLogger('console')
 
 
+def read_analysis_metadata(path):
+    """
+    Returns the 'metadata' section of an analysis statistics YAML file. To avoid parsing the whole file, only the lines
+    of the metadata section are parsed (the file is only fully parsed if the section can not be found that way).
+    """
+    lines = []
+    with open(path) as f:
+        for line in f:
+            if lines:
+                if line.strip() and not line[0].isspace():
+                    break  # Next top-level key
+                lines.append(line)
+            elif line.startswith('metadata:'):
+                lines.append(line)
+    if lines:
+        data = yaml.load(''.join(lines), Loader=yaml.cyaml.CLoader)
+    else:
+        with open(path) as f:
+            data = yaml.load(f, Loader=yaml.cyaml.CLoader)
+    if not data:
+        return None
+    return data['metadata']
+
+
+def check_extractor_version(sound_id, path, freesound_extractor_version):
+    """Returns None if the sound was analyzed with the given extractor version or a (log level, message) tuple
+    otherwise. Missing or unreadable analysis files are reported with ERROR level, other mismatches with INFO level."""
+    try:
+        metadata = read_analysis_metadata(path)
+    except:
+        return logging.ERROR, 'Sound with id %i was not indexed (no yaml file found when checking for extractor ' \
+                              'version)' % sound_id
+
+    if metadata:
+        if 'freesound_extractor' in metadata['version']:
+            if metadata['version']['freesound_extractor'] != freesound_extractor_version:
+                return logging.INFO, 'Sound with id %i was not indexed (it was analyzed with extractor version %s)' \
+                       % (sound_id, metadata['version']['freesound_extractor'])
+        else:
+            return logging.INFO, 'Sound with id %i was not indexed (it was analyzed with an unknown extractor)' \
+                   % sound_id
+    else:
+        return logging.INFO, 'Sound with id %i was not indexed (most probably empty yaml file)' % sound_id
+    return None
+
+
 class Command(LoggingBaseCommand):
     help = "Take all sounds that haven't been added to the similarity service yet and add them. Use option --force " \
            "to force reindex ALL sounds. Use option -l to limit the maximum number of sounds to index " \
@@ -64,10 +112,51 @@ class Command(LoggingBaseCommand):
             default=False,
             help='Send files to the indexing server instead of the main similarity server')
 
+        parser.add_argument(
+            '-b', '--batch_size',
+            action='store',
+            dest='batch_size',
+            default=100,
+            help='Number of sounds sent to the similarity server in each request')
+
+        parser.add_argument(
+            '-w', '--num_workers',
+            action='store',
+            dest='num_workers',
+            default=4,
+            help='Number of threads used to check the extractor version of the analysis files')
+
+    def add_batch(self, sounds, indexing_server):
+        points = [(sound.id, sound.locations('analysis.statistics.path')) for sound in sounds]
+        try:
+            if indexing_server:
+                result = Similarity.add_points_to_indexing_server(points)
+            else:
+                result = Similarity.add_points(points)
+        except Exception as e:
+            if not indexing_server:
+                Sound.objects.filter(id__in=[sound.id for sound in sounds]).update(similarity_state='FA')
+            console_logger.error('Unexpected error while trying to add sounds (ids: %i to %i): \n\t%s'
+                                 % (sounds[0].id, sounds[-1].id, str(e)))
+            return 0
+
+        for sound_id, message in result['failed'].items():
+            console_logger.error('Sound with id %s could not be added: %s' % (sound_id, message))
+        if not indexing_server:
+            added_ids = set(int(sound_id) for sound_id in result['added'])
+            Sound.objects.filter(id__in=added_ids).update(similarity_state='OK')
+            Sound.objects.filter(id__in=[int(sound_id) for sound_id in result['failed']]).update(
+                similarity_state='FA')
+            for sound in sounds:
+                if sound.id in added_ids:
+                    sound.invalidate_template_caches()
+        return len(result['added'])
+
     def handle(self,  *args, **options):
         self.log_start()
 
         limit = int(options['limit'])
+        batch_size = int(options['batch_size'])
         freesound_extractor_version = options['freesound_extractor_version']
         console_logger.info("limit: %s, version: %s", limit, freesound_extractor_version)
 
@@ -76,47 +165,31 @@ class Command(LoggingBaseCommand):
         else:
             to_be_added = Sound.objects.filter(
                 analysis_state='OK', similarity_state='PE', moderation_state='OK').order_by('id')[:limit]
-
+        to_be_added = list(to_be_added)
         N = len(to_be_added)
-        for count, sound in enumerate(to_be_added):
-
-            # Check if sound analyzed using the desired extractor
-            if freesound_extractor_version:
-                try:
-                    data = yaml.load(open(sound.locations('analysis.statistics.path')), Loader=yaml.cyaml.CLoader)
-                except:
-                    console_logger.error('Sound with id %i was not indexed (no yaml file found when checking for '
-                                         'extractor version)' % sound.id)
-                    continue
-
-                if data:
-                    if 'freesound_extractor' in data['metadata']['version']:
-                        if data['metadata']['version']['freesound_extractor'] != freesound_extractor_version:
-                            console_logger.info(
-                                'Sound with id %i was not indexed (it was analyzed with extractor version %s)'
-                                % (sound.id, data['metadata']['version']['freesound_extractor']))
-                            continue
-                    else:
-                        console_logger.info('Sound with id %i was not indexed (it was analyzed with an unknown '
-                                            'extractor)' % sound.id)
-                        continue
-                else:
-                    console_logger.info('Sound with id %i was not indexed (most probably empty yaml file)' % sound.id)
-                    continue
-
-            try:
-                if options['indexing_server']:
-                    result = Similarity.add_to_indeixing_server(sound.id, sound.locations('analysis.statistics.path'))
-                else:
-                    result = Similarity.add(sound.id, sound.locations('analysis.statistics.path'))
-                    sound.set_similarity_state('OK')
-                    sound.invalidate_template_caches()
-                console_logger.info("%s (%i of %i)" % (result, count+1, N))
-
-            except Exception as e:
-                if not options['indexing_server']:
-                    sound.set_similarity_state('FA')
-                console_logger.error('Unexpected error while trying to add sound (id: %i, %i of %i): \n\t%s'
-                                     % (sound.id, count+1, N, str(e)))
 
-        self.log_end({'n_sounds_added': to_be_added.count()})
+        # Check if sounds were analyzed using the desired extractor (in parallel as this requires reading the files)
+        pool = ThreadPool(int(options['num_workers']))
+        if freesound_extractor_version:
+            errors = pool.imap(lambda sound: check_extractor_version(
+                sound.id, sound.locations('analysis.statistics.path'), freesound_extractor_version), to_be_added)
+        else:
+            errors = [None] * N
+
+        n_added = 0
+        n_processed = 0
+        batch = []
+        for sound, error in izip(to_be_added, errors):
+            n_processed += 1
+            if error is not None:
+                console_logger.log(*error)
+            else:
+                batch.append(sound)
+            if batch and (len(batch) == batch_size or n_processed == N):
+                n_added += self.add_batch(batch, options['indexing_server'])
+                console_logger.info("Added %i sounds (%i of %i)" % (n_added, n_processed, N))
+                batch = []
+        pool.close()
+        pool.join()
+
+        self.log_end({'n_sounds_added': n_added})
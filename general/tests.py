@@ -20,14 +20,19 @@
 #     See AUTHORS file.
 #
 
+import logging
+import os
+
 from django.core.management import call_command
 from django.test import TestCase, RequestFactory
 from django.urls import reverse
 
 from forum.models import Thread, Post, Forum
+from general.management.commands.similarity_update import check_extractor_version
 from general.templatetags.paginator import show_paginator
 from ratings.models import SoundRating
 from sounds.models import Sound
+from utils.filesystem import TemporaryDirectory
 from utils.pagination import paginate
 from utils.test_helpers import create_user_and_sounds
 
@@ -131,6 +136,25 @@ class ReportCountStatusesManagementCommandTestCase(TestCase):
         self.assertEqual(sound.num_downloads, 0)
 
 
+class SimilarityUpdateTestCase(TestCase):
+
+    def test_check_extractor_version(self):
+        with TemporaryDirectory() as tmp_directory:
+            path = os.path.join(tmp_directory, 'statistics.yaml')
+            with open(path, 'w') as f:
+                f.write('lowlevel:\n  mfcc: [1, 2]\nmetadata:\n  version:\n    freesound_extractor: "0.3"\n'
+                        'rhythm:\n  bpm: 120\n')
+            self.assertIsNone(check_extractor_version(1, path, '0.3'))
+
+            # Mismatching versions are logged with INFO level but missing files are errors
+            level, message = check_extractor_version(1, path, '0.4')
+            self.assertEqual(level, logging.INFO)
+            self.assertIn('analyzed with extractor version 0.3', message)
+            level, message = check_extractor_version(1, os.path.join(tmp_directory, 'missing.yaml'), '0.3')
+            self.assertEqual(level, logging.ERROR)
+            self.assertIn('no yaml file found', message)
+
+
 class PaginatorTestCase(TestCase):
 
     def test_url_with_non_ascii_characters(self):
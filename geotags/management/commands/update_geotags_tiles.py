@@ -0,0 +1,48 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import logging
+import time
+
+from geotags.tiles import GeotagTiles, get_public_geotags_points
+from utils.management_commands import LoggingBaseCommand
+
+console_logger = logging.getLogger('console')
+
+
+class Command(LoggingBaseCommand):
+    """
+    This command should be run periodically (e.g. every few minutes) to keep the geotag tile served by the geotags
+    views up to date. All geotags are reloaded from the database, the tile is only rewritten if its contents changed.
+    """
+    help = 'Update the precomputed tile with the geotags of all public sounds'
+
+    def handle(self, *args, **options):
+        self.log_start()
+
+        tic = time.time()
+        points = get_public_geotags_points()
+        console_logger.info('Loaded %i geotags (%.2f seconds)' % (len(points), time.time() - tic))
+
+        tic = time.time()
+        tile_changed = GeotagTiles().update(points)
+        console_logger.info('%s tile (%.2f seconds)' % ('Updated' if tile_changed else 'Unchanged', time.time() - tic))
+
+        self.log_end({'n_geotags': len(points), 'tile_changed': tile_changed})
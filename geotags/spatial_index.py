@@ -0,0 +1,359 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import logging
+import math
+import operator
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from geotags.models import GeoTag
+from geotags.tiles import POINT_DTYPE, box_intervals, box_mask, get_geotags_points, pack_geotags
+from sounds.models import Sound
+
+web_logger = logging.getLogger('web')
+
+
+def get_public_geotags():
+    """Returns the packed geotags (see tiles.pack_geotags) of all public sounds and an array with their geotag ids."""
+    values = list(Sound.public.exclude(geotag=None).values_list('id', 'geotag__lat', 'geotag__lon', 'geotag_id'))
+    if not values:
+        return np.zeros((0, 3), dtype=POINT_DTYPE), np.zeros(0, dtype=np.int64)
+    ids, lats, lons, geotag_ids = [np.array(column) for column in zip(*values)]
+    valid = ~(np.isnan(lats.astype(np.float64)) | np.isnan(lons.astype(np.float64)))
+    return pack_geotags(ids, lats, lons), geotag_ids[valid].astype(np.int64)
+
+
+def _runs(selected):
+    """Returns the (start, end) pairs of the runs of consecutive True values of a boolean array."""
+    edges = np.diff(np.concatenate([[0], selected.astype(np.int8), [0]]))
+    return zip(np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0])
+
+
+class GeotagsIndex(object):
+    """
+    In-memory grid index with the geotags of public sounds used to answer bounding box queries.
+
+    The world is divided in cells of cell_size x cell_size degrees. Points (packed as in tiles.pack_geotags) are stored
+    in a single array sorted by cell, and cell_offsets[cell] is the position of the first point of each cell, so the
+    points of a row of consecutive cells are a slice of the array. Sounds added or modified after the index was built
+    are kept in a small dictionary (and their old points are marked as removed) until there are more than max_delta
+    of them, then the arrays are rebuilt in memory. Only changes made in this process are applied to the index, changes
+    made by other processes are included when the whole index is rebuilt (see get_geotags_index).
+    """
+
+    def __init__(self, points, geotag_ids, cell_size=1.0, max_delta=1000):
+        self.cell_size = cell_size
+        self.num_rows = int(math.ceil(180.0 / cell_size))
+        self.num_cols = int(math.ceil(360.0 / cell_size))
+        self.max_delta = max_delta
+        self.lock = threading.Lock()
+        self.built_time = time.time()
+        self.generation = 0  # see get_geotags_index
+        self.generation_checked = self.built_time
+        self._build(points, geotag_ids)
+
+    def _cells(self, lats, lons):
+        rows = np.floor((np.asarray(lats, dtype=np.float64) / 1000000 + 90) / self.cell_size).astype(np.int64)
+        cols = np.floor((np.asarray(lons, dtype=np.float64) / 1000000 + 180) / self.cell_size).astype(np.int64)
+        return np.clip(rows, 0, self.num_rows - 1), np.clip(cols, 0, self.num_cols - 1)
+
+    def _build(self, points, geotag_ids):
+        rows, cols = self._cells(points[:, 1], points[:, 2])
+        cells = rows * self.num_cols + cols
+        order = np.argsort(cells, kind='mergesort')
+        self.points = np.ascontiguousarray(points[order])
+        self.geotag_ids = geotag_ids[order]
+        self.cell_offsets = np.searchsorted(cells[order], np.arange(self.num_rows * self.num_cols + 1))
+        self.removed = np.zeros(len(self.points), dtype=bool)
+        self.id_order = np.argsort(self.points[:, 0], kind='mergesort')
+        self.sorted_ids = self.points[self.id_order, 0]
+        self.delta = {}  # sound id -> (packed point, geotag id)
+        self.delta_points = np.zeros((0, 3), dtype=POINT_DTYPE)
+
+    def size(self):
+        return int((~self.removed).sum()) + len(self.delta)
+
+    def query_box(self, min_lat, min_lon, max_lat, max_lon):
+        """Returns the packed geotags (an (N, 3) int32 array) of the sounds inside the given box. Coordinates are in
+        degrees and, as in geotags_box_barray, boxes where min > max wrap around."""
+        with self.lock:
+            points, removed, cell_offsets, delta_points = \
+                self.points, self.removed, self.cell_offsets, self.delta_points
+
+        row_selected = np.zeros(self.num_rows, dtype=bool)
+        col_selected = np.zeros(self.num_cols, dtype=bool)
+        for lat_min, lat_max in box_intervals(min_lat, max_lat, -90, 90):
+            (row_min, row_max), _ = self._cells([lat_min * 1000000, lat_max * 1000000], [0, 0])
+            row_selected[row_min:row_max + 1] = True
+        for lon_min, lon_max in box_intervals(min_lon, max_lon, -180, 180):
+            _, (col_min, col_max) = self._cells([0, 0], [lon_min * 1000000, lon_max * 1000000])
+            col_selected[col_min:col_max + 1] = True
+
+        col_runs = _runs(col_selected)
+        slices = [(cell_offsets[row * self.num_cols + col_start], cell_offsets[row * self.num_cols + col_end])
+                  for row in np.nonzero(row_selected)[0] for col_start, col_end in col_runs]
+        candidates = [np.arange(start, end) for start, end in slices if end > start]
+        if candidates:
+            candidates = np.concatenate(candidates)
+            candidates = candidates[~removed[candidates]]
+            result = points[candidates]
+            result = result[box_mask(result, min_lat, min_lon, max_lat, max_lon)]
+        else:
+            result = np.zeros((0, 3), dtype=POINT_DTYPE)
+        if len(delta_points):
+            result = np.concatenate([result, delta_points[box_mask(delta_points, min_lat, min_lon, max_lat, max_lon)]])
+        return result
+
+    def _remove(self, sound_id):
+        # must be called with the lock held, removed is copied so that running queries are not affected
+        self.delta.pop(sound_id, None)
+        position = np.searchsorted(self.sorted_ids, sound_id)
+        if position < len(self.sorted_ids) and self.sorted_ids[position] == sound_id:
+            row = self.id_order[position]
+            if not self.removed[row]:
+                removed = self.removed.copy()
+                removed[row] = True
+                self.removed = removed
+
+    def _update_delta(self):
+        # must be called with the lock held
+        if len(self.delta) > self.max_delta:
+            keep = ~self.removed
+            delta_points = np.array([point for point, _ in self.delta.values()], dtype=POINT_DTYPE).reshape(-1, 3)
+            delta_geotag_ids = np.array([geotag_id for _, geotag_id in self.delta.values()], dtype=np.int64)
+            self._build(np.concatenate([self.points[keep], delta_points]),
+                        np.concatenate([self.geotag_ids[keep], delta_geotag_ids]))
+        else:
+            self.delta_points = np.array([point for point, _ in self.delta.values()],
+                                         dtype=POINT_DTYPE).reshape(-1, 3)
+
+    def remove_sound(self, sound_id):
+        with self.lock:
+            self._remove(sound_id)
+            self._update_delta()
+
+    def update_sound(self, sound_id, lat, lon, geotag_id):
+        """Adds a sound to the index or updates its coordinates. Sounds with NaN coordinates are removed."""
+        with self.lock:
+            self._remove(sound_id)
+            points = pack_geotags([sound_id], [lat], [lon])
+            if len(points):
+                self.delta[sound_id] = (points[0], geotag_id)
+            self._update_delta()
+
+    def update_geotag(self, geotag_id, lat, lon):
+        """Updates the coordinates of the sounds with the given geotag."""
+        with self.lock:
+            sound_ids = self.points[(self.geotag_ids == geotag_id) & ~self.removed, 0].tolist()
+            sound_ids += [sound_id for sound_id, (_, delta_geotag_id) in self.delta.items()
+                          if delta_geotag_id == geotag_id]
+        for sound_id in sound_ids:
+            self.update_sound(sound_id, lat, lon, geotag_id)
+
+    def remove_geotag(self, geotag_id):
+        with self.lock:
+            sound_ids = self.points[(self.geotag_ids == geotag_id) & ~self.removed, 0].tolist()
+            sound_ids += [sound_id for sound_id, (_, delta_geotag_id) in self.delta.items()
+                          if delta_geotag_id == geotag_id]
+            for sound_id in sound_ids:
+                self._remove(sound_id)
+            self._update_delta()
+
+
+GENERATION_CACHE_KEY = 'geotags-index-generation'
+
+# Value of the indexed state of sounds and geotags whose fields were not loaded from the database
+UNKNOWN = object()
+
+_geotags_index = None
+_geotags_index_building = False
+_geotags_index_lock = threading.Lock()
+_geotags_generation = 0  # used if there is no shared cache
+
+
+def get_geotags_generation():
+    if settings.GEOTAGS_INDEX_SHARED_CACHE is None:
+        return _geotags_generation
+    return caches[settings.GEOTAGS_INDEX_SHARED_CACHE].get(GENERATION_CACHE_KEY, 0)
+
+
+def increase_geotags_generation(index):
+    """Increases the geotags generation so that the indexes of other processes are rebuilt. Should be called after
+    index (the index of this process, already updated) has been updated, or with None to rebuild all indexes. Without
+    a shared cache the generation is local to the process and indexes of other processes are only rebuilt when they are
+    older than settings.GEOTAGS_INDEX_MAX_AGE."""
+    global _geotags_generation
+    if settings.GEOTAGS_INDEX_SHARED_CACHE is None:
+        with _geotags_index_lock:
+            _geotags_generation += 1
+            generation = _geotags_generation
+    else:
+        shared_cache = caches[settings.GEOTAGS_INDEX_SHARED_CACHE]
+        try:
+            generation = shared_cache.incr(GENERATION_CACHE_KEY)
+        except ValueError:
+            # the key does not exist yet (or has been evicted from the shared cache)
+            generation = int(time.time())
+            shared_cache.set(GENERATION_CACHE_KEY, generation, None)
+    if index is not None and generation == index.generation + 1:
+        # No other process changed geotags since the index was built, so it does not need to be rebuilt
+        index.generation = generation
+
+
+def get_geotags_index():
+    """Returns the process-wide geotags index, or None if the index is being built for the first time (callers should
+    then use query_box_from_database). The index is built the first time it is used. If settings.GEOTAGS_INDEX_SHARED_CACHE
+    is set, it is rebuilt when geotags are changed by other processes, which increase the generation stored in that
+    cache (checked every settings.GEOTAGS_INDEX_GENERATION_CHECK_INTERVAL seconds). It is always rebuilt after
+    settings.GEOTAGS_INDEX_MAX_AGE seconds.
+    The index is built by the request which finds it outdated, other requests do not wait and use the old index."""
+    global _geotags_index, _geotags_index_building
+    now = time.time()
+    with _geotags_index_lock:
+        index = _geotags_index
+        if _geotags_index_building:
+            return index
+        rebuild = index is None or now - index.built_time > settings.GEOTAGS_INDEX_MAX_AGE
+        check_generation = not rebuild and now - index.generation_checked >= \
+            settings.GEOTAGS_INDEX_GENERATION_CHECK_INTERVAL
+        if check_generation:
+            index.generation_checked = now
+    if check_generation:
+        rebuild = get_geotags_generation() != index.generation
+    if not rebuild:
+        return index
+
+    with _geotags_index_lock:
+        if _geotags_index_building or _geotags_index is not index:
+            return _geotags_index
+        _geotags_index_building = True
+    try:
+        tic = time.time()
+        # Changes made while the index is built increase the generation again and the index is rebuilt later
+        generation = get_geotags_generation()
+        points, geotag_ids = get_public_geotags()
+        index = GeotagsIndex(points, geotag_ids, cell_size=settings.GEOTAGS_INDEX_CELL_SIZE,
+                             max_delta=settings.GEOTAGS_INDEX_MAX_DELTA)
+        index.generation = generation
+        with _geotags_index_lock:
+            _geotags_index = index
+        web_logger.info('Built geotags index with %i geotags (%.2f seconds)' % (len(points), time.time() - tic))
+    finally:
+        with _geotags_index_lock:
+            _geotags_index_building = False
+    return index
+
+
+def clear_geotags_index():
+    global _geotags_index
+    with _geotags_index_lock:
+        _geotags_index = None
+
+
+def query_box_from_database(min_lat, min_lon, max_lat, max_lon):
+    """Same as GeotagsIndex.query_box but reading the geotags of the sounds inside the box from the database."""
+    lat_filter = reduce(operator.or_, [Q(geotag__lat__range=interval)
+                                       for interval in box_intervals(min_lat, max_lat, -90, 90)])
+    lon_filter = reduce(operator.or_, [Q(geotag__lon__range=interval)
+                                       for interval in box_intervals(min_lon, max_lon, -180, 180)])
+    points = get_geotags_points(Sound.public.exclude(geotag=None).filter(lat_filter, lon_filter))
+    return points[box_mask(points, min_lat, min_lon, max_lat, max_lon)]
+
+
+def _indexed_geotag_id(sound):
+    """Returns the id of the geotag of sound if it is public (i.e. if it is in the index), None if it is not and
+    UNKNOWN if some of the fields were not loaded from the database (accessing them would need a query)."""
+    fields = sound.__dict__
+    if any(field not in fields for field in ('moderation_state', 'processing_state', 'geotag_id')):
+        return UNKNOWN
+    if fields['moderation_state'] == 'OK' and fields['processing_state'] == 'OK':
+        return fields['geotag_id']
+    return None
+
+
+@receiver(post_init, sender=Sound)
+def store_indexed_geotag_on_sound_init(sender, instance, **kwargs):
+    instance._indexed_geotag_id = _indexed_geotag_id(instance)
+
+
+@receiver(post_save, sender=Sound)
+def update_geotags_index_on_sound_save(sender, instance, **kwargs):
+    """Updates the index (and increases the geotags generation) only if the sound was or is public and geotagged and
+    its state or geotag changed, as most saves of sounds do not change anything the index uses. Changes of the
+    coordinates of geotags are handled by update_geotags_index_on_geotag_save."""
+    old_geotag_id = getattr(instance, '_indexed_geotag_id', UNKNOWN)
+    geotag_id = _indexed_geotag_id(instance)
+    instance._indexed_geotag_id = geotag_id
+    if UNKNOWN in (geotag_id, old_geotag_id):
+        # The sound may have changed, rebuild the indexes of all processes (including this one)
+        increase_geotags_generation(None)
+        return
+    if geotag_id == old_geotag_id:
+        return
+    index = _geotags_index
+    if index is not None:
+        if geotag_id is not None:
+            index.update_sound(instance.id, instance.geotag.lat, instance.geotag.lon, geotag_id)
+        else:
+            index.remove_sound(instance.id)
+    increase_geotags_generation(index)
+
+
+@receiver(post_delete, sender=Sound)
+def update_geotags_index_on_sound_delete(sender, instance, **kwargs):
+    index = _geotags_index
+    if index is not None:
+        index.remove_sound(instance.id)
+    increase_geotags_generation(index)
+
+
+@receiver(post_init, sender=GeoTag)
+def store_coordinates_on_geotag_init(sender, instance, **kwargs):
+    instance._indexed_coordinates = (instance.__dict__.get('lat', UNKNOWN), instance.__dict__.get('lon', UNKNOWN))
+
+
+@receiver(post_save, sender=GeoTag)
+def update_geotags_index_on_geotag_save(sender, instance, created, **kwargs):
+    coordinates = (instance.lat, instance.lon)
+    old_coordinates = getattr(instance, '_indexed_coordinates', None)
+    instance._indexed_coordinates = coordinates
+    if created or coordinates == old_coordinates:
+        # New geotags have no sounds yet, sounds are added to the index when they are saved
+        return
+    index = _geotags_index
+    if index is not None:
+        index.update_geotag(instance.id, instance.lat, instance.lon)
+    increase_geotags_generation(index)
+
+
+@receiver(post_delete, sender=GeoTag)
+def update_geotags_index_on_geotag_delete(sender, instance, **kwargs):
+    index = _geotags_index
+    if index is not None:
+        index.remove_geotag(instance.id)
+    increase_geotags_generation(index)
@@ -18,12 +18,21 @@
 #     See AUTHORS file.
 #
 
+import struct
+
+import mock
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
 from django.urls import reverse
 
+from geotags import spatial_index
 from geotags.models import GeoTag
+from geotags.spatial_index import GENERATION_CACHE_KEY, clear_geotags_index, get_geotags_index
+from geotags.tiles import GeotagTiles, get_public_geotags_points
 from sounds.models import Sound
+from utils.test_helpers import override_geotags_tiles_path_with_temp_directory
 
 
 class GeoTagsTests(TestCase):
@@ -96,3 +105,158 @@ class GeoTagsTests(TestCase):
         # Response contains 3 int32 objects per sound: id, lat and lng. Total size = 3 * 4 bytes = 12 bytes
         n_sounds = len(resp.content) / 12
         self.assertEqual(n_sounds, 2)
+
+    def create_geotagged_sounds(self):
+        sounds = list(Sound.objects.all()[:3])
+        for sound, (lat, lon) in zip(sounds, [(41.3851, 2.1734), (-33.8688, 151.2093), (64.1466, -21.9426)]):
+            sound.geotag = GeoTag.objects.create(user=sound.user, lat=lat, lon=lon, zoom=9)
+            sound.moderation_state = 'OK'
+            sound.processing_state = 'OK'
+            sound.save()
+        return sounds
+
+    def get_barray_sound_ids(self, url):
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        # Response contains 3 int32 objects per sound: id, lat and lng
+        return sorted(struct.unpack('<%ii' % (len(resp.content) / 4), resp.content)[::3])
+
+    def test_geotags_box_barray(self):
+        clear_geotags_index()
+        sounds = self.create_geotagged_sounds()
+        boxes = [
+            ('30,-10,70,10', [sounds[0].id]),
+            ('-90,-180,90,180', sorted(sound.id for sound in sounds)),
+            ('80,100,-20,160', [sounds[1].id]),  # Wraps around latitude
+            ('30,0,70,-20', sorted([sounds[0].id, sounds[2].id])),  # Wraps around longitude
+        ]
+        for box, expected_sound_ids in boxes:
+            self.assertEqual(
+                self.get_barray_sound_ids(reverse('geotags-box-barray') + '?box=' + box), expected_sound_ids)
+            # While the index is being built box queries are answered from the database
+            with mock.patch('geotags.views.get_geotags_index', return_value=None):
+                self.assertEqual(
+                    self.get_barray_sound_ids(reverse('geotags-box-barray') + '?box=' + box), expected_sound_ids)
+
+        # Once the index is built, box queries do not access the database
+        with self.assertNumQueries(0):
+            self.get_barray_sound_ids(reverse('geotags-box-barray') + '?box=30,-10,70,10')
+
+        # The index is updated when geotags and sounds change
+        sounds[1].geotag.lat = 40.0
+        sounds[1].geotag.lon = 0.0
+        sounds[1].geotag.save()
+        sounds[2].moderation_state = 'PE'
+        sounds[2].save()
+        self.assertEqual(self.get_barray_sound_ids(reverse('geotags-box-barray') + '?box=30,-10,70,10'),
+                         sorted([sounds[0].id, sounds[1].id]))
+        sounds[0].delete()
+        self.assertEqual(self.get_barray_sound_ids(reverse('geotags-box-barray') + '?box=-90,-180,90,180'),
+                         [sounds[1].id])
+
+        resp = self.client.get(reverse('geotags-box-barray') + '?box=wrong,box')
+        self.assertEqual(resp.status_code, 404)
+        clear_geotags_index()
+
+    @override_settings(GEOTAGS_INDEX_SHARED_CACHE='default', GEOTAGS_INDEX_GENERATION_CHECK_INTERVAL=0)
+    def test_geotags_index_generation(self):
+        clear_geotags_index()
+        sounds = self.create_geotagged_sounds()
+        index = get_geotags_index()
+
+        # Changes made by this process are applied to the index, which is not rebuilt
+        sounds[0].geotag.lat = 40.0
+        sounds[0].geotag.save()
+        sounds[1].save()
+        self.assertIs(get_geotags_index(), index)
+        self.assertEqual(len(index.query_box(39, -10, 41, 10)), 1)
+
+        # The index is rebuilt when other processes change geotags
+        GeoTag.objects.filter(id=sounds[0].geotag_id).update(lat=-40.0)
+        cache.incr(GENERATION_CACHE_KEY)
+        new_index = get_geotags_index()
+        self.assertIsNot(new_index, index)
+        self.assertEqual(len(new_index.query_box(-41, -10, -39, 10)), 1)
+        self.assertIs(get_geotags_index(), new_index)
+
+        # Other requests do not wait and use the old index while it is rebuilt
+        get_public_geotags = spatial_index.get_public_geotags
+
+        def get_public_geotags_while_building():
+            self.assertIs(get_geotags_index(), new_index)
+            return get_public_geotags()
+
+        cache.incr(GENERATION_CACHE_KEY)
+        with mock.patch('geotags.spatial_index.get_public_geotags', side_effect=get_public_geotags_while_building):
+            self.assertIsNot(get_geotags_index(), new_index)
+        clear_geotags_index()
+
+    @override_settings(GEOTAGS_INDEX_SHARED_CACHE='default')
+    def test_geotags_index_sound_saves(self):
+        clear_geotags_index()
+        sounds = self.create_geotagged_sounds()
+        index = get_geotags_index()
+        generation = cache.get(GENERATION_CACHE_KEY)
+
+        # Saves which do not change the public state or the geotag of sounds do not change the index
+        sound = Sound.objects.get(id=sounds[0].id)
+        sound.num_comments += 1
+        sound.save()
+        sounds[1].geotag.zoom = 10
+        sounds[1].geotag.save()
+        Sound.objects.filter(user=sounds[0].user).exclude(geotag=None).first().save()
+        self.assertEqual(cache.get(GENERATION_CACHE_KEY), generation)
+
+        sound.moderation_state = 'PE'
+        sound.save()
+        self.assertEqual(cache.get(GENERATION_CACHE_KEY), generation + 1)
+        self.assertEqual(len(index.query_box(30, -10, 70, 10)), 0)
+        sound.moderation_state = 'OK'
+        sound.save()
+        self.assertEqual(cache.get(GENERATION_CACHE_KEY), generation + 2)
+        self.assertEqual(len(index.query_box(30, -10, 70, 10)), 1)
+        self.assertIs(get_geotags_index(), index)
+
+        # If the state of the sound was not loaded, all indexes are rebuilt
+        Sound.objects.only('id', 'num_comments').get(id=sounds[2].id).save()
+        self.assertEqual(cache.get(GENERATION_CACHE_KEY), generation + 3)
+        with override_settings(GEOTAGS_INDEX_GENERATION_CHECK_INTERVAL=0):
+            self.assertIsNot(get_geotags_index(), index)
+        clear_geotags_index()
+
+    @override_settings(GEOTAGS_INDEX_GENERATION_CHECK_INTERVAL=0)
+    def test_geotags_index_without_shared_cache(self):
+        clear_geotags_index()
+        sounds = self.create_geotagged_sounds()
+        index = get_geotags_index()
+        sounds[0].moderation_state = 'PE'
+        sounds[0].save()
+        self.assertIs(get_geotags_index(), index)
+        self.assertEqual(len(index.query_box(30, -10, 70, 10)), 0)
+
+        Sound.objects.only('id', 'num_comments').get(id=sounds[1].id).save()
+        self.assertIsNot(get_geotags_index(), index)
+        clear_geotags_index()
+
+    @override_geotags_tiles_path_with_temp_directory
+    def test_geotags_tiles(self):
+        sounds = self.create_geotagged_sounds()
+        not_public_sound = Sound.objects.exclude(id__in=[sound.id for sound in sounds]).first()
+        not_public_sound.geotag = GeoTag.objects.create(user=not_public_sound.user, lat=10.0, lon=10.0, zoom=9)
+        not_public_sound.moderation_state = 'PE'
+        not_public_sound.save()
+
+        # Without tiles, geotags are loaded from the database and only public sounds are included as in the tiles
+        self.assertEqual(self.get_barray_sound_ids(reverse('geotags-barray')), sorted(sound.id for sound in sounds))
+        call_command('update_geotags_tiles')
+        cache.clear()
+        self.assertEqual(self.get_barray_sound_ids(reverse('geotags-barray')), sorted(sound.id for sound in sounds))
+
+        # The tile is only rewritten when geotags change
+        tiles = GeotagTiles()
+        self.assertFalse(tiles.update(get_public_geotags_points()))
+        sounds[0].moderation_state = 'PE'
+        sounds[0].save()
+        self.assertTrue(tiles.update(get_public_geotags_points()))
+        self.assertEqual(sorted(tiles.get_tile_points()[:, 0]), sorted(sound.id for sound in sounds[1:]))
+
@@ -0,0 +1,125 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import os
+
+import numpy as np
+from django.conf import settings
+
+from sounds.models import Sound
+
+# Geotags are packed as 3 int32 values per sound: id, latitude and longitude (both in millionths of degree)
+POINT_DTYPE = np.dtype('<i4')
+
+
+def pack_geotags(ids, lats, lons):
+    """Returns an (N, 3) int32 array with the ids, latitudes and longitudes (in millionths of degree) of the given
+    geotags. Geotags with NaN coordinates are skipped."""
+    ids = np.asarray(ids, dtype=np.int64)
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    valid = ~(np.isnan(lats) | np.isnan(lons))
+    points = np.empty((int(valid.sum()), 3), dtype=POINT_DTYPE)
+    points[:, 0] = ids[valid]
+    points[:, 1] = (lats[valid] * 1000000).astype(np.int64)  # Truncates like int()
+    points[:, 2] = (lons[valid] * 1000000).astype(np.int64)
+    return points
+
+
+def get_geotags_points(sound_queryset):
+    """Returns the packed geotags (see pack_geotags) of the sounds of sound_queryset. Only the needed fields are loaded
+    from the database (no Sound objects are created). Sounds without geotag are skipped."""
+    values = list(sound_queryset.values_list('id', 'geotag__lat', 'geotag__lon'))
+    if not values:
+        return np.zeros((0, 3), dtype=POINT_DTYPE)
+    ids, lats, lons = zip(*values)
+    return pack_geotags(ids, lats, lons)
+
+
+def get_public_geotags_points():
+    return get_geotags_points(Sound.public.exclude(geotag=None))
+
+
+def box_intervals(box_min, box_max, lower_limit, upper_limit):
+    """Returns the list of (min, max) intervals covered by a box side. If box_min > box_max the box wraps around and
+    covers the values lower than box_max and the values greater than box_min."""
+    if box_min <= box_max:
+        return [(box_min, box_max)]
+    return [(lower_limit, box_max), (box_min, upper_limit)]
+
+
+def box_mask(points, min_lat, min_lon, max_lat, max_lon):
+    """Returns a boolean mask with the points (see pack_geotags) which are inside the given box. Coordinates of the box
+    are in degrees and, as with geotags_box_barray, boxes where min > max wrap around."""
+    lats = points[:, 1]
+    lons = points[:, 2]
+    min_lat, min_lon, max_lat, max_lon = [coordinate * 1000000 for coordinate in (min_lat, min_lon, max_lat, max_lon)]
+    if min_lat <= max_lat:
+        mask = (lats >= min_lat) & (lats <= max_lat)
+    else:
+        mask = (lats > min_lat) | (lats < max_lat)
+    if min_lon <= max_lon:
+        mask &= (lons >= min_lon) & (lons <= max_lon)
+    else:
+        mask &= (lons > min_lon) | (lons < max_lon)
+    return mask
+
+
+class GeotagTiles(object):
+    """
+    Store of the precomputed tile with the packed geotags of all public sounds (see pack_geotags), which is served as
+    is by geotags_barray so that the geotags of the map page are a single file read. The tile is stored in path as
+    world.bin and is only updated with update(), which rewrites the file if its contents changed.
+    """
+
+    def __init__(self, path=None):
+        self.path = path if path is not None else settings.GEOTAGS_TILES_PATH
+
+    def tile_path(self):
+        return os.path.join(self.path, 'world.bin')
+
+    def is_built(self):
+        return os.path.exists(self.tile_path())
+
+    def get_tile(self):
+        """Returns the packed geotags of the tile as a byte string."""
+        try:
+            with open(self.tile_path(), 'rb') as f:
+                return f.read()
+        except IOError:
+            return ''
+
+    def get_tile_points(self):
+        return np.frombuffer(self.get_tile(), dtype=POINT_DTYPE).reshape(-1, 3)
+
+    def update(self, points):
+        """Updates the tile with the given packed geotags (all the geotags to be included in the store). Returns True
+        if the tile file was written."""
+        # Sort by id so that the contents of the tile do not depend on the order of the points
+        content = points[np.argsort(points[:, 0], kind='mergesort')].tobytes()
+        if self.is_built() and self.get_tile() == content:
+            return False
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        tmp_path = self.tile_path() + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.rename(tmp_path, self.tile_path())  # Atomic, the tile being read is never incomplete
+        return True
@@ -18,14 +18,12 @@
 #     See AUTHORS file.
 #
 
-import cStringIO
-import math
-import struct
-
 from django.conf import settings
 from django.http import Http404, HttpResponse
 from django.views.decorators.cache import cache_page
 
+from geotags.spatial_index import get_geotags_index, query_box_from_database
+from geotags.tiles import GeotagTiles, get_geotags_points
 from sounds.models import Sound
 from utils.frontend_handling import render
 from utils.username import redirect_if_old_username_or_404, raise_404_if_user_is_deleted
@@ -33,49 +31,42 @@ from utils.username import redirect_if_old_username_or_404, raise_404_if_user_is
 
 def generate_bytearray(sound_queryset):
     # sounds as bytearray
-    packed_sounds = cStringIO.StringIO()
-    for s in sound_queryset:
-        if not math.isnan(s.geotag.lat) and not math.isnan(s.geotag.lon):
-            packed_sounds.write(struct.pack("i", s.id))
-            packed_sounds.write(struct.pack("i", int(s.geotag.lat*1000000)))
-            packed_sounds.write(struct.pack("i", int(s.geotag.lon*1000000)))
-
-    return HttpResponse(packed_sounds.getvalue(), content_type='application/octet-stream')
+    return HttpResponse(get_geotags_points(sound_queryset).tobytes(), content_type='application/octet-stream')
 
 
 @cache_page(60 * 15)
 def geotags_barray(request, tag=None):
-    sounds = Sound.objects.select_related('geotag')
+    if not tag:
+        tiles = GeotagTiles()
+        if tiles.is_built():
+            return HttpResponse(tiles.get_tile(), content_type='application/octet-stream')
+    sounds = Sound.public.all()
     if tag:
         sounds = sounds.filter(tags__tag__name__iexact=tag)
-    return generate_bytearray(sounds.exclude(geotag=None).all())
+    return generate_bytearray(sounds.exclude(geotag=None))
 
 
 def geotags_box_barray(request):
     box = request.GET.get("box", "-180,-90,180,90")
     try:
-        min_lat, min_lon, max_lat, max_lon = box.split(",")
-        qs = Sound.objects.select_related("geotag").exclude(geotag=None).filter(moderation_state="OK", processing_state="OK")
-        sounds = []
-        if min_lat <= max_lat and min_lon <= max_lon:
-            sounds = qs.filter(geotag__lat__range=(min_lat, max_lat)).filter(geotag__lon__range=(min_lon, max_lon))
-        elif min_lat > max_lat and min_lon <= max_lon:
-            sounds = qs.exclude(geotag__lat__range=(max_lat, min_lat)).filter(geotag__lon__range=(min_lon, max_lon))
-        elif min_lat <= max_lat and min_lon > max_lon:
-            sounds = qs.filter(geotag__lat__range=(min_lat, max_lat)).exclude(geotag__lon__range=(max_lon, min_lon))
-        elif min_lat > max_lat and min_lon > max_lon:
-            sounds = qs.exclude(geotag__lat__range=(max_lat, min_lat)).exclude(geotag__lon__range=(max_lon, min_lon))
-
-        return generate_bytearray(sounds)
+        min_lat, min_lon, max_lat, max_lon = [float(coordinate) for coordinate in box.split(",")]
     except ValueError:
         raise Http404
 
+    index = get_geotags_index()
+    if index is not None:
+        points = index.query_box(min_lat, min_lon, max_lat, max_lon)
+    else:
+        # The index is being built by another request
+        points = query_box_from_database(min_lat, min_lon, max_lat, max_lon)
+    return HttpResponse(points.tobytes(), content_type='application/octet-stream')
+
 
 @redirect_if_old_username_or_404
 @raise_404_if_user_is_deleted
 @cache_page(60 * 15)
 def geotags_for_user_barray(request, username):
-    sounds = Sound.public.select_related('geotag').filter(user__username__iexact=username).exclude(geotag=None)
+    sounds = Sound.public.filter(user__username__iexact=username).exclude(geotag=None)
     return generate_bytearray(sounds)
 
 
@@ -87,7 +78,7 @@ def geotags_for_user_latest_barray(request, username):
 
 
 def geotags_for_pack_barray(request, pack_id):
-    sounds = Sound.public.select_related('geotag').filter(pack__id=pack_id).exclude(geotag=None)
+    sounds = Sound.public.filter(pack__id=pack_id).exclude(geotag=None)
     return generate_bytearray(sounds)
 
 
@@ -36,6 +36,9 @@ from django.urls import reverse
 import tickets
 from sounds.models import Sound
 from tickets import TICKET_STATUS_CLOSED
+from utils.search.query_cache import get_solr_query_cache_stats
+from utils.search.solr import get_connection_pools_stats
+from utils.similarity_utilities import get_sounds_descriptors_cache_stats
 
 
 @login_required
@@ -188,6 +191,23 @@ def totals_stats_ajax(request):
     return JsonResponse(totals_stats or {})
 
 
+@login_required
+@user_passes_test(lambda u: u.is_staff, login_url='/')
+def solr_client_stats_ajax(request):
+    # NOTE: stats are kept in memory so these are only the stats of the process serving the request
+    return JsonResponse({
+        'query_cache': get_solr_query_cache_stats(),
+        'connection_pools': get_connection_pools_stats(),
+    })
+
+
+@login_required
+@user_passes_test(lambda u: u.is_staff, login_url='/')
+def similarity_client_stats_ajax(request):
+    # NOTE: stats are kept in memory so these are only the stats of the process serving the request
+    return JsonResponse({'descriptors_cache': get_sounds_descriptors_cache_stats()})
+
+
 @login_required
 @user_passes_test(lambda u: u.is_staff, login_url='/')
 def process_sounds(request):
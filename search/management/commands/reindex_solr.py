@@ -23,7 +23,7 @@ import logging
 from django.core.management.base import BaseCommand
 
 from sounds.models import Sound
-from utils.search.search_general import add_all_sounds_to_solr, delete_sounds_from_solr, get_all_sound_ids_from_solr
+from utils.search.search_general import add_all_sounds_to_solr, delete_sounds_from_solr, get_solr_index_diff
 
 console_logger = logging.getLogger("console")
 
@@ -37,16 +37,41 @@ class Command(BaseCommand):
            'case there is a specific need of re-indexing all sounds without marking them as is_index_dirty and ' \
            'using the "post_dirty_sounds_to_solr" command.'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--num-converters',
+            action='store',
+            dest='num_converters',
+            type=int,
+            default=2,
+            help='Number of threads converting sounds to Solr documents (default: 2)')
+
+        parser.add_argument(
+            '--num-posters',
+            action='store',
+            dest='num_posters',
+            type=int,
+            default=2,
+            help='Number of threads posting documents to Solr (default: 2)')
+
+        parser.add_argument(
+            '--checkpoint',
+            action='store',
+            dest='checkpoint',
+            default=None,
+            help='Path of a file where to save the progress of the re-indexing. If the file exists (e.g. because a '
+                 'previous run failed), re-indexing continues after the last sound saved in the file.')
+
     def handle(self, *args, **options):
 
         # Get all sounds moderated and processed ok and add them to solr (also delete them before re-indexing)
         sounds_to_index = Sound.objects.filter(processing_state="OK", moderation_state="OK")
         console_logger.info("Re-indexing %d sounds to solr", sounds_to_index.count())
-        add_all_sounds_to_solr(sounds_to_index, mark_index_clean=True, delete_if_existing=True)
+        add_all_sounds_to_solr(sounds_to_index, mark_index_clean=True, delete_if_existing=True,
+                               num_converters=options['num_converters'], num_posters=options['num_posters'],
+                               checkpoint_filename=options['checkpoint'])
 
         # Delete all sounds in solr which are not found in the Freesound DB
-        solr_ids = get_all_sound_ids_from_solr()
-        indexed_sound_ids = sounds_to_index.values_list('id', flat=True)
-        sound_ids_to_delete = list(set(solr_ids).difference(indexed_sound_ids))
+        sound_ids_to_delete, _, _, _ = get_solr_index_diff(sounds_to_index)
         console_logger.info("Deleting %d non-existing sounds form solr", len(sound_ids_to_delete))
         delete_sounds_from_solr(sound_ids=sound_ids_to_delete)
@@ -262,6 +262,17 @@ class SearchResultClustering(TestCase):
             (1, 2, u'tag1 tag2 tag3', self.sound_id_preview_urls[2:])
         ])
 
+    @mock.patch('search.views.cluster_sound_results')
+    def test_coarse_search_result_clustering_view(self, cluster_sound_results):
+        cluster_sound_results.return_value = dict(self.successful_clustering_results, coarse=True)
+        resp = self.client.get(reverse('clustering-facet'))
+
+        # 200 status code & coarse results marked in the clustering facets template
+        self.assertEqual(resp.status_code, 200)
+        self.assertTemplateUsed(resp, 'search/clustering_facet.html')
+        self.assertTrue(resp.context['coarse'])
+        self.assertContains(resp, 'clustering-coarse')
+
     @mock.patch('search.views.cluster_sound_results')
     def test_pending_search_result_clustering_view(self, cluster_sound_results):
         cluster_sound_results.return_value = self.pending_clustering_results
@@ -243,6 +243,7 @@ def clustering_facet(request):
 
     return render(request, 'search/clustering_facet.html', {
             'results': partition,
+            'coarse': result.get('coarse', False),
             'url_query_params_string': url_query_params_string,
             'cluster_id_num_results_tags_sound_examples': zip(
                 range(num_clusters),
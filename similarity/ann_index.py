@@ -0,0 +1,196 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import logging
+import os
+import time
+
+import numpy as np
+
+logger = logging.getLogger('similarity')
+
+
+class IVFIndex(object):
+    """
+    Approximate nearest neighbour index using an inverted file (IVF) over euclidean distance.
+
+    Points are assigned to the closest of num_lists centroids (computed with k-means when the index is built). To
+    search, distances from the query to the centroids are computed and only the points assigned to the num_probes
+    closest centroids are compared with the query. Centroids are not updated when points are added or deleted, so the
+    index should be rebuilt from time to time if the distribution of the points changes a lot (this happens every time
+    the similarity server is restarted, see GaiaWrapper).
+    Vectors are stored as rows of a single float32 matrix which grows as points are added. When a point is deleted the
+    last row is moved to its position so that the matrix has no holes.
+    """
+
+    def __init__(self, dimension, num_probes=8):
+        self.dimension = dimension
+        self.num_probes = num_probes
+        self.centroids = np.zeros((0, dimension), dtype=np.float32)
+        self.vectors = np.zeros((1024, dimension), dtype=np.float32)
+        self.names = []  # row -> point name
+        self.rows = {}  # point name -> row
+        self.assignments = np.zeros(1024, dtype=np.int32)  # row -> list (centroid) number
+        self.lists = []  # list number -> list of rows
+
+    def size(self):
+        return len(self.names)
+
+    def contains(self, name):
+        return name in self.rows
+
+    def build(self, names, vectors, num_lists=0, num_iterations=10, max_training_points=100000):
+        """
+        Builds the index with the given point names and vectors (a numpy array with one row per point). If num_lists
+        is 0, the number of lists is set to the square root of the number of points. Centroids are computed with
+        k-means using at most max_training_points randomly chosen points.
+        """
+        tic = time.time()
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not num_lists:
+            num_lists = max(1, int(np.sqrt(len(names))))
+        num_lists = min(num_lists, len(names))
+
+        random_state = np.random.RandomState(0)
+        training_vectors = vectors
+        if len(vectors) > max_training_points:
+            training_vectors = vectors[random_state.choice(len(vectors), max_training_points, replace=False)]
+        centroids = training_vectors[random_state.choice(len(training_vectors), num_lists, replace=False)].copy()
+        for _ in range(num_iterations):
+            assignments = self._closest_centroids(training_vectors, centroids)
+            sums = np.zeros_like(centroids, dtype=np.float64)
+            np.add.at(sums, assignments, training_vectors)
+            counts = np.bincount(assignments, minlength=num_lists)
+            non_empty = counts > 0
+            # Empty lists keep their centroid
+            centroids[non_empty] = (sums[non_empty] / counts[non_empty][:, np.newaxis]).astype(np.float32)
+        self.centroids = centroids
+
+        self.vectors = vectors.copy()
+        self.names = list(names)
+        self.rows = dict((name, row) for row, name in enumerate(self.names))
+        self.assignments = self._closest_centroids(self.vectors, self.centroids).astype(np.int32)
+        self._build_lists()
+        logger.info('Built IVF index with %i points and %i lists (done in %.2f seconds)' %
+                    (len(self.names), num_lists, time.time() - tic))
+
+    def _build_lists(self):
+        order = np.argsort(self.assignments[:len(self.names)], kind='mergesort')
+        counts = np.bincount(self.assignments[:len(self.names)], minlength=len(self.centroids))
+        self.lists = [rows.tolist() for rows in np.split(order, np.cumsum(counts)[:-1])]
+
+    @staticmethod
+    def _closest_centroids(vectors, centroids, batch_size=10000):
+        # |v - c|^2 = |v|^2 - 2 v.c + |c|^2, and |v|^2 does not change the closest centroid
+        centroids_norms = (centroids.astype(np.float64) ** 2).sum(axis=1)
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), batch_size):
+            batch = vectors[start:start + batch_size]
+            distances = centroids_norms - 2 * np.dot(batch, centroids.T)
+            assignments[start:start + batch_size] = np.argmin(distances, axis=1)
+        return assignments
+
+    def add_point(self, name, vector):
+        """Adds a point to the index (or replaces its vector if the index already contains it)."""
+        if name in self.rows:
+            self.delete_point(name)
+        vector = np.asarray(vector, dtype=np.float32)
+        row = len(self.names)
+        if row == len(self.vectors):
+            # Double the capacity of the matrix
+            extra_rows = max(len(self.vectors), 1024)
+            self.vectors = np.concatenate([self.vectors, np.zeros((extra_rows, self.dimension), dtype=np.float32)])
+            self.assignments = np.concatenate([self.assignments, np.zeros(extra_rows, dtype=np.int32)])
+        list_number = int(self._closest_centroids(vector[np.newaxis, :], self.centroids)[0])
+        self.vectors[row] = vector
+        self.assignments[row] = list_number
+        self.lists[list_number].append(row)
+        self.names.append(name)
+        self.rows[name] = row
+
+    def delete_point(self, name):
+        """Deletes a point from the index, returns False if the index does not contain it."""
+        if name not in self.rows:
+            return False
+        row = self.rows.pop(name)
+        self.lists[self.assignments[row]].remove(row)
+        last_row = len(self.names) - 1
+        last_name = self.names.pop()
+        if row != last_row:
+            # Move the last point to the position of the deleted one
+            last_list = self.lists[self.assignments[last_row]]
+            last_list[last_list.index(last_row)] = row
+            self.vectors[row] = self.vectors[last_row]
+            self.assignments[row] = self.assignments[last_row]
+            self.names[row] = last_name
+            self.rows[last_name] = row
+        return True
+
+    def get_vector(self, name):
+        return self.vectors[self.rows[name]]
+
+    def search(self, vector, num_results, offset=0, num_probes=None):
+        """
+        Returns a list of (point name, distance) tuples with the approximate nearest neighbours of vector sorted by
+        distance (as returned by Gaia searches). If num_probes is not smaller than the number of lists, all points are
+        compared with the query and results are exact.
+        """
+        if not self.names:
+            return []
+        vector = np.asarray(vector, dtype=np.float32)
+        num_probes = num_probes or self.num_probes
+        if num_probes >= len(self.centroids):
+            rows = np.arange(len(self.names))
+        else:
+            centroid_distances = ((self.centroids - vector) ** 2).sum(axis=1)
+            probes = np.argpartition(centroid_distances, num_probes - 1)[:num_probes]
+            rows = np.fromiter((row for list_number in probes for row in self.lists[list_number]), dtype=np.int64)
+            if not len(rows):
+                return []
+
+        distances = ((self.vectors[rows] - vector) ** 2).sum(axis=1)
+        num_candidates = min(offset + num_results, len(rows))
+        if num_candidates < len(rows):
+            closest = np.argpartition(distances, num_candidates - 1)[:num_candidates]
+        else:
+            closest = np.arange(len(rows))
+        closest = closest[np.argsort(distances[closest], kind='mergesort')][offset:]
+        return [(self.names[rows[i]], float(np.sqrt(distances[i]))) for i in closest]
+
+    def save(self, path):
+        tic = time.time()
+        tmp_path = path + '.tmp.npz'
+        n = len(self.names)
+        np.savez(tmp_path, centroids=self.centroids, vectors=self.vectors[:n], assignments=self.assignments[:n],
+                 names=np.array(self.names, dtype=str), num_probes=self.num_probes)
+        os.rename(tmp_path, path)
+        logger.info('Saved IVF index to %s (done in %.2f seconds)' % (path, time.time() - tic))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        index = cls(data['vectors'].shape[1], num_probes=int(data['num_probes']))
+        index.centroids = data['centroids']
+        index.vectors = data['vectors']
+        index.assignments = data['assignments']
+        index.names = [str(name) for name in data['names']]
+        index.rows = dict((name, row) for row, name in enumerate(index.names))
+        index._build_lists()
+        return index
@@ -0,0 +1,94 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+"""
+Compares the results and latency of the approximate nearest neighbours index (see ann_index.IVFIndex) with the exact
+results of Gaia for the 'pca' preset. The similarity index configured in similarity_settings is loaded, an IVF index is
+built from its PCA vectors and a random sample of its points is used as queries.
+
+Usage: python ann_index_benchmark.py [--num-queries 500] [--num-results 15] [--num-lists 0] [--num-probes 1,2,4,8,16]
+"""
+
+from __future__ import print_function
+
+import argparse
+import logging
+import random
+import time
+
+import numpy as np
+
+import similarity_settings as sim_settings
+from ann_index import IVFIndex
+from gaia_wrapper import GaiaWrapper
+
+
+def percentile_ms(latencies, percentile):
+    return np.percentile(latencies, percentile) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the ANN index against exact Gaia searches.')
+    parser.add_argument('--num-queries', type=int, default=500, help='number of random points used as queries')
+    parser.add_argument('--num-results', type=int, default=15, help='number of neighbours requested per query')
+    parser.add_argument('--num-lists', type=int, default=sim_settings.ANN_INDEX_NUM_LISTS,
+                        help='number of lists of the IVF index (0 to use the square root of the number of points)')
+    parser.add_argument('--num-probes', default='1,2,4,8,16,32',
+                        help='comma separated list of numbers of probes to evaluate')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    gaia = GaiaWrapper()
+    if gaia.view_pca is None:
+        raise SystemExit('The similarity index has not enough points to be used for similarity search.')
+
+    point_names = gaia.pca_dataset.pointNames()
+    vectors = np.array([gaia.pca_dataset.point(name).value('.pca') for name in point_names], dtype=np.float32)
+    ann_index = IVFIndex(vectors.shape[1])
+    ann_index.build(point_names, vectors, num_lists=args.num_lists)
+
+    random.seed(0)
+    query_names = random.sample(point_names, min(args.num_queries, len(point_names)))
+
+    exact_results = {}
+    latencies = []
+    for name in query_names:
+        tic = time.time()
+        search = gaia.view_pca.nnSearch(name, gaia.metrics['pca'])
+        exact_results[name] = set(result[0] for result in search.get(args.num_results))
+        latencies.append(time.time() - tic)
+    print('Dataset size: %i points, %i queries, %i results per query' %
+          (len(point_names), len(query_names), args.num_results))
+    print('%-12s %10s %12s %12s' % ('engine', 'recall', 'mean (ms)', 'p95 (ms)'))
+    print('%-12s %10.4f %12.2f %12.2f' %
+          ('gaia', 1.0, np.mean(latencies) * 1000, percentile_ms(latencies, 95)))
+
+    for num_probes in [int(value) for value in args.num_probes.split(',')]:
+        latencies = []
+        recall = 0.0
+        for name in query_names:
+            tic = time.time()
+            results = ann_index.search(ann_index.get_vector(name), args.num_results, num_probes=num_probes)
+            latencies.append(time.time() - tic)
+            recall += len(exact_results[name].intersection(result[0] for result in results)) / \
+                float(len(exact_results[name]))
+        print('%-12s %10.4f %12.2f %12.2f' % ('ivf (%i)' % num_probes, recall / len(query_names),
+                                              np.mean(latencies) * 1000, percentile_ms(latencies, 95)))
@@ -20,11 +20,13 @@
 
 from django.conf import settings
 import json
+import urllib
 import urllib2
 
 _BASE_URL                     = 'http://%s:%i/similarity/' % (settings.SIMILARITY_ADDRESS, settings.SIMILARITY_PORT)
 _BASE_INDEXING_SERVER_URL     = 'http://%s:%i/similarity/' % (settings.SIMILARITY_ADDRESS, settings.SIMILARITY_INDEXING_SERVER_PORT)
 _URL_ADD_POINT                = 'add_point/'
+_URL_ADD_POINTS               = 'add_points/'
 _URL_DELETE_POINT             = 'delete_point/'
 _URL_GET_DESCRIPTOR_NAMES     = 'get_descriptor_names/'
 _URL_GET_ALL_SOUND_IDS        = 'get_all_point_names/'
@@ -116,6 +118,19 @@ class Similarity():
         url = _BASE_INDEXING_SERVER_URL + _URL_ADD_POINT + '?' + 'sound_id=' + str(sound_id) + '&location=' + str(yaml_path)
         return _result_or_exception(_get_url_as_json(url))
 
+    @classmethod
+    def add_points(cls, points):
+        """Adds several sounds at once, points is a list of (sound_id, yaml_path) pairs"""
+        data = urllib.urlencode({'points': json.dumps([[str(yaml_path), sound_id] for sound_id, yaml_path in points])})
+        return _result_or_exception(_get_url_as_json(_BASE_URL + _URL_ADD_POINTS, data=data, timeout=60 * 5))
+
+    @classmethod
+    def add_points_to_indexing_server(cls, points):
+        """Adds several sounds at once to the indexing server, points is a list of (sound_id, yaml_path) pairs"""
+        data = urllib.urlencode({'points': json.dumps([[str(yaml_path), sound_id] for sound_id, yaml_path in points])})
+        return _result_or_exception(_get_url_as_json(_BASE_INDEXING_SERVER_URL + _URL_ADD_POINTS, data=data,
+                                                     timeout=60 * 5))
+
     @classmethod
     def get_all_sound_ids(cls):
         url = _BASE_URL + _URL_GET_ALL_SOUND_IDS
@@ -23,10 +23,12 @@ import logging
 import os
 import time
 
+import numpy as np
 import yaml
 from gaia2 import DataSet, transform, DistanceFunctionFactory, View, Point, VariableLength
 
 import similarity_settings as sim_settings
+from ann_index import IVFIndex
 from similarity_server_utils import generate_structured_dict_from_layout, get_nested_dictionary_value, \
     get_nested_descriptor_names, set_nested_dictionary_value, parse_filter_list
 
@@ -64,6 +66,7 @@ class GaiaWrapper:
         self.metrics = {}
         self.view = None
         self.view_pca = None
+        self.ann_index = None
         self.transformations_history = None
 
         self.__load_dataset()
@@ -71,6 +74,10 @@ class GaiaWrapper:
     def __get_dataset_path(self, ds_name):
         return os.path.join(sim_settings.INDEX_DIR, ds_name + '.db')
 
+    @staticmethod
+    def __get_ann_index_path(dataset_path):
+        return os.path.splitext(dataset_path)[0] + '.ivf.npz'
+
     def __load_dataset(self):
         """
         Loads the dataset, does all the necessary steps to make it available for similarity queries and creates the PCA
@@ -107,6 +114,7 @@ class GaiaWrapper:
                 self.pca_dataset.setReferenceDataSet(self.original_dataset)
                 self.view_pca = View(self.pca_dataset)
                 self.__build_pca_metric()
+                self.__build_ann_index()
 
             if self.original_dataset.history().size() <= 0:
                 logger.info('Dataset loaded, size: %s points' % (self.original_dataset.size()))
@@ -203,38 +211,89 @@ class GaiaWrapper:
         search_metric = DistanceFunctionFactory.create(str(distance), self.pca_dataset.layout(), parameters)
         self.metrics['pca'] = search_metric
 
-    def add_point(self, point_location, point_name):
+    def __build_ann_index(self):
+        """
+        Loads the approximate nearest neighbours index saved next to the dataset or builds it from the PCA vectors if
+        it does not exist or does not contain the same points as the PCA dataset.
+        """
+        if 'pca' not in sim_settings.ANN_INDEX_PRESETS:
+            return
+        point_names = self.pca_dataset.pointNames()
+        ann_index_path = self.__get_ann_index_path(self.original_dataset_path)
+        if os.path.exists(ann_index_path):
+            logger.info('Loading ANN index from %s' % ann_index_path)
+            ann_index = IVFIndex.load(ann_index_path)
+            if ann_index.dimension == sim_settings.PCA_DIMENSIONS and set(ann_index.names) == set(point_names):
+                ann_index.num_probes = sim_settings.ANN_INDEX_NUM_PROBES
+                self.ann_index = ann_index
+                return
+            logger.info('ANN index does not match the dataset, it will be rebuilt')
+
+        logger.info('Bulding ANN index for preset pca')
+        vectors = np.array([self.pca_dataset.point(name).value('.pca') for name in point_names], dtype=np.float32)
+        self.ann_index = IVFIndex(sim_settings.PCA_DIMENSIONS, num_probes=sim_settings.ANN_INDEX_NUM_PROBES)
+        self.ann_index.build(point_names, vectors, num_lists=sim_settings.ANN_INDEX_NUM_LISTS)
+        self.ann_index.save(ann_index_path)
+
+    def __use_ann_index(self, preset_name, point_name=None):
+        if self.ann_index is None or preset_name not in sim_settings.ANN_INDEX_PRESETS:
+            return False
+        return point_name is None or self.ann_index.contains(point_name)
 
-        if self.original_dataset.contains(str(point_name)):
-                self.original_dataset.removePoint(str(point_name))
+    def add_point(self, point_location, point_name):
+        point, error = self.load_point(point_location, point_name)
+        if error is not None:
+            return error
+        return self.insert_point(point, point_name)
 
+    def load_point(self, point_location, point_name):
+        """
+        Loads the point of an analysis file. Returns a (point, None) tuple, or a (None, error response) tuple if the
+        point can not be loaded. Loading does not access the datasets, so it can be done while queries are running.
+        """
         p = Point()
         if os.path.exists(str(point_location)):
             try:
                 p.load(str(point_location))
                 p.setName(str(point_name))
-                if self.original_dataset.size() <= sim_settings.SIMILARITY_MINIMUM_POINTS:
-                    # Add point to original_dataset because PCA dataset has not been created yet
-                    self.original_dataset.addPoint(p)
-                    msg = 'Added point with name %s. Index has now %i points.' % \
-                          (str(point_name), self.original_dataset.size())
-                    logger.info(msg)
-                else:
-                    # Add point to PCA dataset because it has been already created.
-                    # PCA dataset will take care of adding the point to the original dataset as well.
-                    self.pca_dataset.addPoint(p)
-                    msg = 'Added point with name %s. Index has now %i points (pca index has %i points).' % \
-                          (str(point_name), self.original_dataset.size(), self.pca_dataset.size())
-                    logger.info(msg)
-
+                return p, None
             except Exception as e:
                 msg = 'Point with name %s could NOT be added (%s).' % (str(point_name), str(e))
                 logger.info(msg)
-                return {'error': True, 'result': msg, 'status_code': sim_settings.SERVER_ERROR_CODE}
+                return None, {'error': True, 'result': msg, 'status_code': sim_settings.SERVER_ERROR_CODE}
         else:
             msg = 'Point with name %s could NOT be added because analysis file does not exist (%s).' % \
                   (str(point_name), str(point_location))
             logger.info(msg)
+            return None, {'error': True, 'result': msg, 'status_code': sim_settings.SERVER_ERROR_CODE}
+
+    def insert_point(self, p, point_name):
+        """
+        Adds a point loaded with load_point to the datasets (replacing the point with the same name if there is one).
+        """
+        if self.original_dataset.contains(str(point_name)):
+                self.original_dataset.removePoint(str(point_name))
+
+        try:
+            if self.original_dataset.size() <= sim_settings.SIMILARITY_MINIMUM_POINTS:
+                # Add point to original_dataset because PCA dataset has not been created yet
+                self.original_dataset.addPoint(p)
+                msg = 'Added point with name %s. Index has now %i points.' % \
+                      (str(point_name), self.original_dataset.size())
+                logger.info(msg)
+            else:
+                # Add point to PCA dataset because it has been already created.
+                # PCA dataset will take care of adding the point to the original dataset as well.
+                self.pca_dataset.addPoint(p)
+                if self.ann_index is not None:
+                    self.ann_index.add_point(str(point_name), self.pca_dataset.point(str(point_name)).value('.pca'))
+                msg = 'Added point with name %s. Index has now %i points (pca index has %i points).' % \
+                      (str(point_name), self.original_dataset.size(), self.pca_dataset.size())
+                logger.info(msg)
+
+        except Exception as e:
+            msg = 'Point with name %s could NOT be added (%s).' % (str(point_name), str(e))
+            logger.info(msg)
             return {'error': True, 'result': msg, 'status_code': sim_settings.SERVER_ERROR_CODE}
 
         if self.original_dataset.size() == sim_settings.SIMILARITY_MINIMUM_POINTS:
@@ -270,9 +329,48 @@ class GaiaWrapper:
             self.pca_dataset.setReferenceDataSet(self.original_dataset)
             self.view_pca = View(self.pca_dataset)
             self.__build_pca_metric()
+            self.__build_ann_index()
 
         return {'error': False, 'result': msg}
 
+    def add_points(self, points):
+        """
+        Adds several points at once. points is a list of (point location, point name) pairs.
+        Returns the names of the points that were added and the error messages of the points that could not be added.
+        """
+        return self.insert_points(self.load_points(points))
+
+    def load_points(self, points):
+        """
+        Loads the points of a list of (point location, point name) pairs (see load_point). Returns a list of
+        (point name, point, error response) tuples to be passed to insert_points.
+        """
+        tic = time.time()
+        loaded_points = []
+        for point_location, point_name in points:
+            point, error = self.load_point(point_location, point_name)
+            loaded_points.append((point_name, point, error))
+        logger.info('Loaded %i points (done in %.2f seconds)' % (len(points), time.time() - tic))
+        return loaded_points
+
+    def insert_points(self, loaded_points):
+        """
+        Adds the points returned by load_points to the datasets. Returns the names of the points that were added and
+        the error messages of the points that could not be added.
+        """
+        tic = time.time()
+        added = []
+        failed = {}
+        for point_name, point, error in loaded_points:
+            result = error if error is not None else self.insert_point(point, point_name)
+            if result['error']:
+                failed[str(point_name)] = result['result']
+            else:
+                added.append(str(point_name))
+        logger.info('Added %i points in a batch of %i (done in %.2f seconds)' %
+                    (len(added), len(loaded_points), time.time() - tic))
+        return {'error': False, 'result': {'added': added, 'failed': failed}}
+
     def delete_point(self, point_name):
         if self.original_dataset.contains(str(point_name)):
             if self.original_dataset.size() <= sim_settings.SIMILARITY_MINIMUM_POINTS:
@@ -281,6 +379,8 @@ class GaiaWrapper:
             else:
                 # Remove from pca dataset (pca dataset will take care of removing from original dataset too)
                 self.pca_dataset.removePoint(str(point_name))
+                if self.ann_index is not None:
+                    self.ann_index.delete_point(str(point_name))
             logger.info('Deleted point with name %s. Index has now %i points (pca index has %i points).' %
                         (str(point_name), self.original_dataset.size(), self.pca_dataset.size()))
             return {'error': False, 'result': True}
@@ -306,6 +406,8 @@ class GaiaWrapper:
             path = sim_settings.INDEX_DIR + filename + ".db"
         logger.info('Saving index to (%s)...' % path + msg)
         self.original_dataset.save(path)
+        if self.ann_index is not None:
+            self.ann_index.save(self.__get_ann_index_path(path))
         toc = time.time()
         logger.info('Finished saving index (done in %.2f seconds, index has now %i points).' %
                     ((toc - tic), self.original_dataset.size()))
@@ -339,9 +441,17 @@ class GaiaWrapper:
         if type(required_descriptor_names) == dict:
             return required_descriptor_names  # There has been an error
 
+        points = []
         for point_name in point_names:
-            sound_descriptors = self.__get_point_descriptors(point_name, required_descriptor_names, normalization)
-            if 'error' not in sound_descriptors:
+            try:
+                points.append((point_name, self.original_dataset.point(str(point_name))))
+            except:  # Sounds which do not exist in gaia index are not returned
+                pass
+
+        if points:
+            points_descriptors = self.__get_points_descriptors([p for _, p in points], required_descriptor_names,
+                                                               normalization)
+            for (point_name, _), sound_descriptors in zip(points, points_descriptors):
                 data[point_name] = sound_descriptors
 
         return {'error': False, 'result': data}
@@ -376,49 +486,122 @@ class GaiaWrapper:
                     'result': 'Wrong descriptor names, unable to create layout.',
                     'status_code': sim_settings.BAD_REQUEST_CODE}
 
-    def __get_point_descriptors(self, point_name, required_descriptor_names, normalization=True):
+    def __get_normalization_coeffs(self):
         """
         Get normalization coefficients to transform the input data (get info from the last transformation which has
         been a normalization)
         """
+        normalization_coeffs = None
+        trans_hist = self.transformations_history
+        for i in range(0, len(trans_hist)):
+            if trans_hist[-(i+1)]['Analyzer name'] == 'normalize':
+                normalization_coeffs = trans_hist[-(i+1)]['Applier parameters']['coeffs']
+        return normalization_coeffs
 
+    def __get_points_descriptors(self, points, required_descriptor_names, normalization=True):
+        """
+        Returns a list with the nested dictionaries of descriptor values of the given gaia points.
+        Descriptor types, dimensions and normalization coefficients are resolved once for all points. Values of
+        fixed-length numerical descriptors are copied into a matrix (one row per point) which is denormalized at once if
+        normalization is False. Other descriptors (strings and variable-length descriptors) are read one by one.
+        """
         normalization_coeffs = None
         if not normalization:
-            trans_hist = self.transformations_history
-            for i in range(0, len(trans_hist)):
-                if trans_hist[-(i+1)]['Analyzer name'] == 'normalize':
-                    normalization_coeffs = trans_hist[-(i+1)]['Applier parameters']['coeffs']
-
-        required_layout = generate_structured_dict_from_layout(required_descriptor_names)
-        try:
-            p = self.original_dataset.point(str(point_name))
-        except:
-            return {'error': True, 'result': 'Sound does not exist in gaia index.', 'status_code': sim_settings.NOT_FOUND_CODE}
+            normalization_coeffs = self.__get_normalization_coeffs()
 
+        # Find out which descriptors are numerical and their dimension by reading them from the first point
+        variable_length_descriptor_names = set(self.descriptor_names['variable-length'])
+        numerical_descriptors = []  # (name, column, dimension) tuples, dimension is 0 for scalar descriptors
+        other_descriptor_names = []
+        n_columns = 0
         for descriptor_name in required_descriptor_names:
+            if descriptor_name in variable_length_descriptor_names:
+                other_descriptor_names.append(descriptor_name)
+                continue
             try:
-                value = p.value(str(descriptor_name))
-                if normalization_coeffs:
-                    if descriptor_name in normalization_coeffs:
-                        a = normalization_coeffs[descriptor_name]['a']
-                        b = normalization_coeffs[descriptor_name]['b']
-                        if len(a) == 1:
-                            value = float(value - b[0]) / a[0]
-                        else:
-                            normalized_value = []
-                            for i in range(0, len(a)):
-                                normalized_value.append(float(value[i]-b[i]) / a[i])
-                            value = normalized_value
+                value = points[0].value(str(descriptor_name))
             except:
-                try:
-                    value = p.label(str(descriptor_name))
-                except:
-                    value = None
-
+                other_descriptor_names.append(descriptor_name)
+                continue
+            dimension = len(value) if hasattr(value, '__len__') else 0
+            numerical_descriptors.append((str(descriptor_name), n_columns, dimension))
+            n_columns += max(dimension, 1)
+
+        values = np.zeros((len(points), n_columns))
+        failed_rows = set()
+        for row, p in enumerate(points):
+            try:
+                for descriptor_name, column, dimension in numerical_descriptors:
+                    if dimension:
+                        values[row, column:column + dimension] = p.value(descriptor_name)
+                    else:
+                        values[row, column] = p.value(descriptor_name)
+            except:
+                # Descriptors of this point will be read one by one
+                failed_rows.add(row)
+
+        if normalization_coeffs:
+            a = np.ones(n_columns)
+            b = np.zeros(n_columns)
+            for descriptor_name, column, dimension in numerical_descriptors:
+                if descriptor_name in normalization_coeffs:
+                    a[column:column + max(dimension, 1)] = normalization_coeffs[descriptor_name]['a']
+                    b[column:column + max(dimension, 1)] = normalization_coeffs[descriptor_name]['b']
+            values = (values - b) / a
+
+        # Build nested dictionaries
+        def split_name(descriptor_name):
             if descriptor_name[0] == '.':
                 descriptor_name = descriptor_name[1:]
-            set_nested_dictionary_value(descriptor_name.split('.'), required_layout, value)
-        return required_layout
+            keys = descriptor_name.split('.')
+            return keys[:-1], keys[-1]
+
+        numerical_paths = [split_name(descriptor_name) for descriptor_name, _, _ in numerical_descriptors]
+        other_paths = [split_name(descriptor_name) for descriptor_name in other_descriptor_names]
+        points_descriptors = []
+        for row, (p, row_values) in enumerate(zip(points, values.tolist())):
+            descriptors = dict()
+            for (parent_keys, key), (descriptor_name, column, dimension) in zip(numerical_paths, numerical_descriptors):
+                if row in failed_rows:
+                    value = self.__get_point_descriptor_value(p, descriptor_name, normalization_coeffs)
+                elif dimension:
+                    value = row_values[column:column + dimension]
+                else:
+                    value = row_values[column]
+                self.__get_nested_parent(descriptors, parent_keys)[key] = value
+            for (parent_keys, key), descriptor_name in zip(other_paths, other_descriptor_names):
+                self.__get_nested_parent(descriptors, parent_keys)[key] = \
+                    self.__get_point_descriptor_value(p, descriptor_name, normalization_coeffs)
+            points_descriptors.append(descriptors)
+        return points_descriptors
+
+    @staticmethod
+    def __get_nested_parent(descriptors, parent_keys):
+        for key in parent_keys:
+            descriptors = descriptors.setdefault(key, dict())
+        return descriptors
+
+    @staticmethod
+    def __get_point_descriptor_value(p, descriptor_name, normalization_coeffs):
+        try:
+            value = p.value(str(descriptor_name))
+            if normalization_coeffs:
+                if descriptor_name in normalization_coeffs:
+                    a = normalization_coeffs[descriptor_name]['a']
+                    b = normalization_coeffs[descriptor_name]['b']
+                    if len(a) == 1:
+                        value = float(value - b[0]) / a[0]
+                    else:
+                        normalized_value = []
+                        for i in range(0, len(a)):
+                            normalized_value.append(float(value[i]-b[i]) / a[i])
+                        value = normalized_value
+        except:
+            try:
+                value = p.label(str(descriptor_name))
+            except:
+                value = None
+        return value
 
     # SIMILARITY SEARCH and CONTENT SEARCH
 
@@ -440,14 +623,20 @@ class GaiaWrapper:
             msg = "Sound with id %s doesn't exist in the dataset." % query_point
             logger.info(msg)
             return {'error': True, 'result': msg, 'status_code': sim_settings.NOT_FOUND_CODE}
-        if preset_name == 'pca':
-            # Search on PCA view
-            search = self.view_pca.nnSearch(query_point, self.metrics[preset_name])
+        if self.__use_ann_index(preset_name, query_point):
+            # Search on the approximate nearest neighbours index
+            results = self.ann_index.search(self.ann_index.get_vector(query_point), int(number_of_results),
+                                            offset=int(offset))
+            count = self.ann_index.size()
         else:
-            # Search on original dataset view
-            search = self.view.nnSearch(query_point, self.metrics[preset_name])
-        results = search.get(int(number_of_results), offset=int(offset))
-        count = search.size()
+            if preset_name == 'pca':
+                # Search on PCA view
+                search = self.view_pca.nnSearch(query_point, self.metrics[preset_name])
+            else:
+                # Search on original dataset view
+                search = self.view.nnSearch(query_point, self.metrics[preset_name])
+            results = search.get(int(number_of_results), offset=int(offset))
+            count = search.size()
 
         return {'error': False, 'result': {'results': results, 'count': count}}
 
@@ -619,15 +808,26 @@ class GaiaWrapper:
 
         # Do query!
         try:
-            if target_type == 'descriptor_values' and target:
+            if target_type in ['sound_id', 'file'] and target and not filter and not metric_descriptor_names \
+                    and self.__use_ann_index(preset_name, query if target_type == 'sound_id' else None):
+                # Searches without filter can use the approximate nearest neighbours index
+                if target_type == 'sound_id':
+                    query_vector = self.ann_index.get_vector(query)
+                else:
+                    query_vector = query.value('.pca')
+                results = self.ann_index.search(query_vector, num_results, offset=offset)
+                count = self.ann_index.size()
+            elif target_type == 'descriptor_values' and target:
                 search = self.view.nnSearch(query, metric, str(filter))
+                results = search.get(num_results, offset=offset)
+                count = search.size()
             else:
                 if preset_name == 'pca':
                     search = self.view_pca.nnSearch(query, metric, str(filter))
                 else:
                     search = self.view.nnSearch(query, metric, str(filter))
-            results = search.get(num_results, offset=offset)
-            count = search.size()
+                results = search.get(num_results, offset=offset)
+                count = search.size()
         except Exception as e:
             return {'error': True, 'result': 'Similarity server error', 'status_code': sim_settings.SERVER_ERROR_CODE}
 
@@ -0,0 +1,176 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import threading
+import time
+from contextlib import contextmanager
+
+from twisted.internet import threads
+from twisted.python.threadpool import ThreadPool
+
+
+class ReadWriteLock(object):
+    """
+    Lock which can be held by several readers at the same time or by a single writer. Writers have preference: once a
+    writer is waiting, new readers wait until it has finished so that writes are not starved by a continuous flow of
+    queries.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    def acquire_read(self):
+        with self.condition:
+            while self.writer or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.condition:
+            self.readers -= 1
+            if not self.readers:
+                self.condition.notify_all()
+
+    def acquire_write(self):
+        with self.condition:
+            self.waiting_writers += 1
+            while self.writer or self.readers:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+
+    def release_write(self):
+        with self.condition:
+            self.writer = False
+            self.condition.notify_all()
+
+
+class QueryExecutor(object):
+    """
+    Runs the methods of the similarity server in thread pools so that the Twisted reactor is never blocked.
+
+    Read-only methods run concurrently in bounded thread pools (one pool per group of methods, so that cheap methods
+    are not queued behind slow searches), while methods that modify the index run one at a time in their own thread.
+    A ReadWriteLock makes sure that no query runs while the index is being modified, so every query sees the index
+    either before or after each modification.
+    Per method stats (queue depth, number of running calls and latency) are kept and can be obtained with get_stats().
+    """
+
+    def __init__(self, reactor, read_pools, write_methods, self_locking_methods=()):
+        """
+        read_pools: dictionary with pool names as keys and (number of threads, list of method names) tuples as values
+        write_methods: list of names of the methods which modify the index
+        self_locking_methods: names of write methods which take the write lock themselves (see write_lock) only while
+        they modify the index, so that queries can run during the rest of the method (write methods still run one at
+        a time)
+        """
+        self.reactor = reactor
+        self.lock = ReadWriteLock()
+        self.pools = {}
+        self.method_pools = {}
+        for pool_name, (num_threads, method_names) in read_pools.items():
+            self.pools[pool_name] = ThreadPool(minthreads=1, maxthreads=num_threads, name='similarity-%s' % pool_name)
+            for method_name in method_names:
+                self.method_pools[method_name] = self.pools[pool_name]
+        self.pools['write'] = ThreadPool(minthreads=1, maxthreads=1, name='similarity-write')
+        self.write_methods = set(write_methods)
+        self.self_locking_methods = set(self_locking_methods)
+        for method_name in write_methods:
+            self.method_pools[method_name] = self.pools['write']
+        self.stats_lock = threading.Lock()
+        self.stats = {}
+
+    def start(self):
+        for pool in self.pools.values():
+            pool.start()
+            self.reactor.addSystemEventTrigger('during', 'shutdown', pool.stop)
+
+    def handles(self, method_name):
+        return method_name in self.method_pools
+
+    def run(self, method_name, method, *args, **kwargs):
+        """Runs method in the pool of method_name and returns a Deferred which fires with its result."""
+        queued_time = time.time()
+        self._update_stats(method_name, queued=1)
+        return threads.deferToThreadPool(self.reactor, self.method_pools[method_name], self._run_locked,
+                                         method_name, queued_time, method, *args, **kwargs)
+
+    @contextmanager
+    def write_lock(self):
+        """Holds the write lock, to be used by self locking methods while they modify the index."""
+        self.lock.acquire_write()
+        try:
+            yield
+        finally:
+            self.lock.release_write()
+
+    def _run_locked(self, method_name, queued_time, method, *args, **kwargs):
+        is_write = method_name in self.write_methods
+        locked = method_name not in self.self_locking_methods
+        if locked:
+            if is_write:
+                self.lock.acquire_write()
+            else:
+                self.lock.acquire_read()
+        start_time = time.time()
+        self._update_stats(method_name, queued=-1, running=1, wait_time=start_time - queued_time)
+        error = True
+        try:
+            result = method(*args, **kwargs)
+            error = False
+            return result
+        finally:
+            if locked:
+                if is_write:
+                    self.lock.release_write()
+                else:
+                    self.lock.release_read()
+            self._update_stats(method_name, running=-1, run_time=time.time() - start_time, error=error)
+
+    def _update_stats(self, method_name, queued=0, running=0, wait_time=None, run_time=None, error=False):
+        with self.stats_lock:
+            if method_name not in self.stats:
+                self.stats[method_name] = {'queued': 0, 'running': 0, 'completed': 0, 'errors': 0,
+                                           'total_wait_time': 0.0, 'total_run_time': 0.0, 'max_run_time': 0.0}
+            stats = self.stats[method_name]
+            stats['queued'] += queued
+            stats['running'] += running
+            if wait_time is not None:
+                stats['total_wait_time'] += wait_time
+            if run_time is not None:
+                stats['completed'] += 1
+                stats['total_run_time'] += run_time
+                stats['max_run_time'] = max(stats['max_run_time'], run_time)
+                if error:
+                    stats['errors'] += 1
+
+    def get_stats(self):
+        """Returns a dictionary with the stats of every method (times are in seconds)."""
+        with self.stats_lock:
+            stats = dict((method_name, dict(method_stats)) for method_name, method_stats in self.stats.items())
+        for method_stats in stats.values():
+            started = method_stats['completed'] + method_stats['running']
+            completed = method_stats['completed']
+            method_stats['mean_wait_time'] = method_stats['total_wait_time'] / started if started else 0.0
+            method_stats['mean_run_time'] = method_stats['total_run_time'] / completed if completed else 0.0
+        return stats
@@ -24,11 +24,12 @@ from twisted.internet import reactor
 from gaia_wrapper import GaiaWrapper
 from similarity_settings import LISTEN_PORT, LOGFILE, DEFAULT_PRESET, DEFAULT_NUMBER_OF_RESULTS, INDEX_NAME, PRESETS, \
     BAD_REQUEST_CODE, NOT_FOUND_CODE, SERVER_ERROR_CODE, LOGSERVER_IP_ADDRESS, LOGSERVER_PORT, LOG_TO_STDOUT, \
-    LOG_TO_GRAYLOG, LOG_TO_FILE
+    LOG_TO_GRAYLOG, LOG_TO_FILE, QUERY_THREADS, LIGHT_QUERY_THREADS
 import logging
 import graypy
 from logging.handlers import RotatingFileHandler
 from similarity_server_utils import parse_filter, parse_target, parse_metric_descriptors
+from query_executor import QueryExecutor
 import json
 import yaml
 import cloghandler
@@ -37,6 +38,7 @@ import cloghandler
 def server_interface(resource):
     return {
         'add_point': resource.add_point,  # location, sound_id
+        'add_points': resource.add_points,  # points (json list of [location, sound_id] pairs)
         'delete_point': resource.delete_point, # sound_id
         'get_all_point_names': resource.get_all_point_names,
         'get_descriptor_names': resource.get_descriptor_names,
@@ -45,9 +47,18 @@ def server_interface(resource):
         'nnsearch': resource.nnsearch,  # sound_id, num_results (optional), preset (optional)
         'api_search': resource.api_search,
         'save': resource.save,  # filename (optional)
+        'get_stats': resource.get_stats,
     }
 
 
+SEARCH_METHODS = ['nnsearch', 'api_search', 'get_sounds_descriptors']
+LIGHT_METHODS = ['contains', 'get_descriptor_names', 'get_all_point_names']
+WRITE_METHODS = ['add_point', 'add_points', 'delete_point', 'save']
+SELF_LOCKING_METHODS = ['add_points']  # Methods which only take the write lock while they modify the index
+
+logger = logging.getLogger('similarity')
+
+
 class SimilarityServer(resource.Resource):
     def __init__(self):
         resource.Resource.__init__(self)
@@ -55,6 +66,14 @@ class SimilarityServer(resource.Resource):
         self.isLeaf = False
         self.gaia = GaiaWrapper()
         self.request = None
+        self.executor = None
+        if QUERY_THREADS:
+            self.executor = QueryExecutor(reactor,
+                                          read_pools={'search': (QUERY_THREADS, SEARCH_METHODS),
+                                                      'light': (LIGHT_QUERY_THREADS, LIGHT_METHODS)},
+                                          write_methods=WRITE_METHODS,
+                                          self_locking_methods=SELF_LOCKING_METHODS)
+            self.executor.start()
 
     def error(self,message):
         return json.dumps({'Error':message})
@@ -63,14 +82,49 @@ class SimilarityServer(resource.Resource):
         return self
 
     def render_GET(self, request):
-        return self.methods[request.prepath[1]](request=request, **request.args)
+        return self.render_method(request)
 
     def render_POST(self, request):
-        return self.methods[request.prepath[1]](request=request, **request.args)
+        return self.render_method(request)
+
+    def render_method(self, request):
+        method_name = request.prepath[1]
+        method = self.methods[method_name]
+        if self.executor is None or not self.executor.handles(method_name):
+            return method(request=request, **request.args)
+
+        # Run the method in the thread pools of the executor and write the response when it finishes
+        connection_lost = []
+        request.notifyFinish().addErrback(lambda _: connection_lost.append(True))
+        d = self.executor.run(method_name, method, request=request, **request.args)
+        d.addCallback(self.write_response, request, connection_lost)
+        d.addErrback(self.write_error, request, connection_lost, method_name)
+        return server.NOT_DONE_YET
+
+    def write_response(self, response, request, connection_lost):
+        if not connection_lost:
+            request.write(response)
+            request.finish()
+
+    def write_error(self, failure, request, connection_lost, method_name):
+        logger.error('Error in %s: %s' % (method_name, failure.getTraceback()))
+        if not connection_lost:
+            request.setResponseCode(SERVER_ERROR_CODE)
+            request.write(json.dumps({'error': True, 'result': 'Similarity server error',
+                                      'status_code': SERVER_ERROR_CODE}))
+            request.finish()
 
     def add_point(self, request, location, sound_id):
         return json.dumps( self.gaia.add_point(location[0],sound_id[0]))
 
+    def add_points(self, request, points):
+        # Analysis files are loaded before taking the write lock, so queries only wait while points are inserted
+        loaded_points = self.gaia.load_points(json.loads(points[0]))
+        if self.executor is None:
+            return json.dumps(self.gaia.insert_points(loaded_points))
+        with self.executor.write_lock():
+            return json.dumps(self.gaia.insert_points(loaded_points))
+
     def delete_point(self, request, sound_id):
         return json.dumps(self.gaia.delete_point(sound_id[0]))
 
@@ -226,12 +280,17 @@ class SimilarityServer(resource.Resource):
 
         return json.dumps(self.gaia.save_index(filename[0]))
 
+    def get_stats(self, request):
+        if self.executor is None:
+            return json.dumps({'error': True, 'result': 'Stats are only available when QUERY_THREADS > 0',
+                               'status_code': NOT_FOUND_CODE})
+        return json.dumps({'error': False, 'result': self.executor.get_stats()})
+
 
 if __name__ == '__main__':
     # Set up logging
     if not LOG_TO_STDOUT:
         print("LOG_TO_STDOUT is False, will not log")
-    logger = logging.getLogger('similarity')
     logger.setLevel(logging.DEBUG)
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     if LOG_TO_FILE:
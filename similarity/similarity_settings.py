@@ -33,6 +33,11 @@ LOGFILE = '/var/log/freesound/similarity.log'
 LOGFILE_INDEXING_SERVER = '/var/log/freesound/similarity_indexing.log'
 LISTEN_PORT = 8008
 INDEXING_SERVER_LISTEN_PORT = 8009
+# Number of threads used to run search queries (nnsearch, api_search, get_sounds_descriptors) and cheap queries
+# (contains, get_descriptor_names, get_all_point_names) concurrently. Requests which modify the index are run one at a
+# time in a separate thread. Set QUERY_THREADS to 0 to run all requests in the reactor thread, one after the other.
+QUERY_THREADS = 4
+LIGHT_QUERY_THREADS = 2
 PCA_DIMENSIONS = 100
 PCA_DESCRIPTORS = [
    "*lowlevel*mean",
@@ -43,6 +48,14 @@ PCA_DESCRIPTORS = [
    "*lowlevel*dvar2"
 ]
 
+# Presets for which searches without filters use an approximate nearest neighbours index (see ann_index.IVFIndex)
+# instead of Gaia's exhaustive search. For the moment only 'pca' preset is supported (the index is built from the PCA
+# vectors). The index is saved next to the Gaia index file (with .ivf.npz extension) and rebuilt if it does not match
+# the loaded dataset.
+ANN_INDEX_PRESETS = []
+ANN_INDEX_NUM_LISTS = 0  # Number of k-means clusters, 0 to use the square root of the number of points
+ANN_INDEX_NUM_PROBES = 8  # Number of clusters visited at search time (higher means slower but more accurate)
+
 # OTHER
 SIMILAR_SOUNDS_TO_CACHE = 100
 SIMILARITY_CACHE_TIME = 60*60*1
@@ -0,0 +1,206 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import threading
+import time
+from unittest import skipIf
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from similarity.ann_index import IVFIndex
+
+try:
+    from similarity.query_executor import QueryExecutor, ReadWriteLock
+except ImportError:
+    # Twisted is only installed in the similarity server
+    QueryExecutor = ReadWriteLock = None
+
+
+def brute_force_search(names, vectors, vector, num_results):
+    distances = np.sqrt(((vectors - vector) ** 2).sum(axis=1))
+    closest = np.argsort(distances, kind='mergesort')[:num_results]
+    return [(names[i], distances[i]) for i in closest]
+
+
+class IVFIndexTest(SimpleTestCase):
+
+    def setUp(self):
+        # Points around 30 random centers, like the PCA vectors of similar sounds
+        random_state = np.random.RandomState(0)
+        centers = random_state.normal(0, 10, (30, 20))
+        self.vectors = (centers[random_state.randint(0, 30, 3000)] +
+                        random_state.normal(0, 2, (3000, 20))).astype(np.float32)
+        self.names = ['%i' % i for i in range(len(self.vectors))]
+        self.index = IVFIndex(20)
+        self.index.build(self.names, self.vectors, num_lists=30)
+        self.queries = random_state.choice(len(self.vectors), 100, replace=False)
+
+    def test_recall(self):
+        recall = 0.0
+        for query in self.queries:
+            exact_names = set(name for name, _ in brute_force_search(self.names, self.vectors, self.vectors[query], 10))
+            results = self.index.search(self.vectors[query], 10, num_probes=4)
+            self.assertEqual(len(results), 10)
+            self.assertEqual([distance for _, distance in results], sorted(distance for _, distance in results))
+            recall += len(exact_names.intersection(name for name, _ in results)) / 10.0
+        self.assertGreater(recall / len(self.queries), 0.9)
+
+    def test_exact_search_when_probing_all_lists(self):
+        for num_probes in [30, 100]:
+            for query in self.queries[:20]:
+                exact_results = brute_force_search(self.names, self.vectors, self.vectors[query], 10)
+                results = self.index.search(self.vectors[query], 10, num_probes=num_probes)
+                self.assertEqual([name for name, _ in results], [name for name, _ in exact_results])
+                np.testing.assert_allclose([distance for _, distance in results],
+                                           [distance for _, distance in exact_results], rtol=1e-4, atol=1e-4)
+
+    def test_add_and_delete_points(self):
+        self.assertTrue(self.index.delete_point('0'))
+        self.assertFalse(self.index.delete_point('0'))
+        self.index.add_point('new', self.vectors[1] + 0.001)
+        self.assertEqual(self.index.size(), len(self.names))
+
+        results = self.index.search(self.vectors[1], 3, num_probes=30)
+        self.assertEqual([name for name, _ in results[:2]], ['1', 'new'])
+        self.assertNotIn('0', [name for name, _ in self.index.search(self.vectors[0], 10, num_probes=30)])
+
+
+def wait_until(condition, timeout=5):
+    end_time = time.time() + timeout
+    while not condition() and time.time() < end_time:
+        time.sleep(0.001)
+    return condition()
+
+
+@skipIf(ReadWriteLock is None, "Twisted is not installed")
+class ReadWriteLockTest(SimpleTestCase):
+
+    def setUp(self):
+        self.lock = ReadWriteLock()
+        self.events = []
+
+    def start_thread(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def read(self, name, inside=None, leave=None):
+        self.lock.acquire_read()
+        self.events.append(name)
+        if inside is not None:
+            inside.set()
+        if leave is not None:
+            leave.wait(5)
+        self.lock.release_read()
+
+    def write(self, name):
+        self.lock.acquire_write()
+        self.events.append(name)
+        self.lock.release_write()
+
+    def test_readers_run_concurrently(self):
+        inside = [threading.Event(), threading.Event()]
+        leave = threading.Event()
+        threads = [self.start_thread(lambda i=i: self.read('reader%i' % i, inside[i], leave)) for i in range(2)]
+        # Both readers hold the lock at the same time
+        self.assertTrue(inside[0].wait(5))
+        self.assertTrue(inside[1].wait(5))
+        self.assertEqual(self.lock.readers, 2)
+        leave.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(self.lock.readers, 0)
+
+    def test_writer_excludes_readers(self):
+        self.lock.acquire_write()
+        reader = self.start_thread(lambda: self.read('reader'))
+        writer = self.start_thread(lambda: self.write('writer'))
+        time.sleep(0.05)
+        self.assertEqual(self.events, [])
+        self.lock.release_write()
+        reader.join(5)
+        writer.join(5)
+        self.assertEqual(sorted(self.events), ['reader', 'writer'])
+
+    def test_writers_are_not_starved(self):
+        self.lock.acquire_read()
+        writer = self.start_thread(lambda: self.write('writer'))
+        self.assertTrue(wait_until(lambda: self.lock.waiting_writers == 1))
+
+        # New readers wait for the waiting writer even if the lock is held by other readers
+        reader = self.start_thread(lambda: self.read('reader'))
+        time.sleep(0.05)
+        self.assertEqual(self.events, [])
+        self.lock.release_read()
+        writer.join(5)
+        reader.join(5)
+        self.assertEqual(self.events, ['writer', 'reader'])
+
+
+@skipIf(QueryExecutor is None, "Twisted is not installed")
+class QueryExecutorTest(SimpleTestCase):
+
+    def test_stats(self):
+        executor = QueryExecutor(None, {'search': (2, ['nnsearch'])}, ['add_point'])
+        self.assertTrue(executor.handles('nnsearch'))
+        self.assertTrue(executor.handles('add_point'))
+        self.assertFalse(executor.handles('get_stats'))
+
+        executor._update_stats('nnsearch', queued=1)
+        self.assertEqual(executor._run_locked('nnsearch', time.time(), lambda x: x * 2, 21), 42)
+
+        def fail():
+            raise ValueError()
+        executor._update_stats('add_point', queued=1)
+        with self.assertRaises(ValueError):
+            executor._run_locked('add_point', time.time(), fail)
+        self.assertEqual(executor.lock.writer, False)
+
+        stats = executor.get_stats()
+        self.assertEqual((stats['nnsearch']['queued'], stats['nnsearch']['running']), (0, 0))
+        self.assertEqual((stats['nnsearch']['completed'], stats['nnsearch']['errors']), (1, 0))
+        self.assertEqual((stats['add_point']['completed'], stats['add_point']['errors']), (1, 1))
+
+    def test_self_locking_methods(self):
+        executor = QueryExecutor(None, {'search': (2, ['nnsearch'])}, ['add_points'],
+                                 self_locking_methods=['add_points'])
+        lock_states = []
+
+        def add_points():
+            # Queries can run while points are loaded
+            lock_states.append((executor.lock.writer, executor.lock.readers))
+            with executor.write_lock():
+                lock_states.append((executor.lock.writer, executor.lock.readers))
+            return 'added'
+
+        executor.lock.acquire_read()
+        executor._update_stats('add_points', queued=1)
+        thread = threading.Thread(target=lambda: lock_states.append(
+            executor._run_locked('add_points', time.time(), add_points)))
+        thread.daemon = True
+        thread.start()
+        self.assertTrue(wait_until(lambda: executor.lock.waiting_writers == 1))
+        self.assertEqual(lock_states, [(False, 1)])
+        executor.lock.release_read()
+        thread.join(5)
+        self.assertEqual(lock_states, [(False, 1), (True, 0), 'added'])
+        self.assertEqual(executor.lock.writer, False)
@@ -20,7 +20,10 @@
 
 import json
 import logging
+import multiprocessing
 import os
+import Queue
+import resource
 import signal
 import sys
 import time
@@ -28,6 +31,7 @@ import time
 import gearman
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import connections
 
 from utils.audioprocessing.freesound_audio_analysis import FreesoundAudioAnalyzer
 from utils.audioprocessing.freesound_audio_processing import FreesoundAudioProcessor
@@ -82,6 +86,27 @@ def check_if_free_space(directory=settings.PROCESSING_TEMP_DIR,
                               "aborting task as there might not be enough space for temp files")
 
 
+def get_max_memory_usage():
+    """
+    Returns the peak memory usage (resident set size) of the current process in megabytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # ru_maxrss is in kilobytes in Linux
+
+
+class RecyclableGearmanWorker(gearman.GearmanWorker):
+    """
+    Gearman worker that stops its work loop once the given function returns True. This is used by child workers of
+    the supervisor mode so that they exit after a number of jobs or when memory usage grows too much.
+    """
+
+    def __init__(self, host_list, should_stop):
+        super(RecyclableGearmanWorker, self).__init__(host_list)
+        self.should_stop = should_stop
+
+    def after_poll(self, any_activity):
+        return not self.should_stop()
+
+
 class Command(BaseCommand):
     help = 'Run the sound processing worker'
 
@@ -93,17 +118,170 @@ class Command(BaseCommand):
             default='process_sound',
             help='Register this function (default: process_sound)')
 
+        parser.add_argument(
+            '--num-workers',
+            action='store',
+            dest='num_workers',
+            type=int,
+            default=0,
+            help='Run in supervisor mode with this number of child workers. Django is only set up once in the '
+                 'supervisor and children are forked from it. Use 0 to run a single worker in the current process '
+                 '(default: 0)')
+
+        parser.add_argument(
+            '--max-jobs',
+            action='store',
+            dest='max_jobs',
+            type=int,
+            default=0,
+            help='In supervisor mode, replace child workers after they have run this number of jobs. Use 0 to never '
+                 'replace children because of the number of jobs (default: 0)')
+
+        parser.add_argument(
+            '--max-memory',
+            action='store',
+            dest='max_memory',
+            type=int,
+            default=0,
+            help='In supervisor mode, replace child workers after a job if their peak memory usage is above this '
+                 'number of megabytes. Use 0 to never replace children because of memory usage (default: 0)')
+
+        parser.add_argument(
+            '--report-interval',
+            action='store',
+            dest='report_interval',
+            type=int,
+            default=300,
+            help='In supervisor mode, log the throughput of each child worker every this number of seconds '
+                 '(default: 300)')
+
+    # Queue used by child workers to report finished jobs to the supervisor (None if not in supervisor mode)
+    jobs_queue = None
+
     def handle(self, *args, **options):
         task_name = 'task_%s' % options['queue']
         if task_name not in dir(self):
             sys.exit(1)
 
-        task_func = lambda x, y: getattr(Command, task_name)(self, x, y)
-        gm_worker = gearman.GearmanWorker(settings.GEARMAN_JOB_SERVERS)
-        gm_worker.register_task(options['queue'], task_func)
-        workers_logger.info('Started worker with tasks: %s' % task_name)
+        if options['num_workers'] > 0:
+            self.run_supervisor(options['queue'], options['num_workers'], options['max_jobs'], options['max_memory'],
+                                options['report_interval'])
+        else:
+            task_func = lambda x, y: getattr(Command, task_name)(self, x, y)
+            gm_worker = gearman.GearmanWorker(settings.GEARMAN_JOB_SERVERS)
+            gm_worker.register_task(options['queue'], task_func)
+            workers_logger.info('Started worker with tasks: %s' % task_name)
+            gm_worker.work()
+
+    def run_child_worker(self, queue, max_jobs, max_memory):
+        """
+        Runs the work loop of a child worker of the supervisor mode. Each child is a separate process so the timeout
+        alarm set for every job works as in the single worker mode. The loop exits after max_jobs jobs or when peak
+        memory usage is above max_memory megabytes so that the supervisor can replace the child with a fresh one.
+        """
+        task_name = 'task_%s' % queue
+        jobs_done = [0]
+
+        def task_func(gearman_worker, gearman_job):
+            result = getattr(Command, task_name)(self, gearman_worker, gearman_job)
+            jobs_done[0] += 1
+            return result
+
+        def should_stop():
+            if max_jobs and jobs_done[0] >= max_jobs:
+                workers_logger.info('Child worker %i recycled after %i jobs' % (os.getpid(), jobs_done[0]))
+                return True
+            if max_memory and get_max_memory_usage() > max_memory:
+                workers_logger.info('Child worker %i recycled after %i jobs because memory usage reached %.1f MB' % (
+                    os.getpid(), jobs_done[0], get_max_memory_usage()))
+                return True
+            return False
+
+        # Let the supervisor handle SIGINT, children are terminated by the supervisor with SIGTERM
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        gm_worker = RecyclableGearmanWorker(settings.GEARMAN_JOB_SERVERS, should_stop)
+        gm_worker.register_task(queue, task_func)
+        workers_logger.info('Started child worker %i with tasks: %s' % (os.getpid(), task_name))
         gm_worker.work()
 
+    def run_supervisor(self, queue, num_workers, max_jobs, max_memory, report_interval):
+        """
+        Runs num_workers child workers and replaces them when they exit (because they reached max_jobs, max_memory or
+        crashed). Children report every finished job to the supervisor through a queue and the supervisor
+        periodically logs the throughput of each child.
+        """
+        self.jobs_queue = multiprocessing.Queue()
+        children = {}  # Maps child pid to its multiprocessing.Process object
+        stats = {}  # Maps child pid to a dictionary with its number of jobs, failures and work time
+        running = [True]
+
+        def stop_supervisor(signum, frame):
+            running[0] = False
+
+        signal.signal(signal.SIGTERM, stop_supervisor)
+        signal.signal(signal.SIGINT, stop_supervisor)
+
+        def start_child():
+            # Close DB connections so that children do not share the connection sockets of the supervisor
+            connections.close_all()
+            child = multiprocessing.Process(target=self.run_child_worker, args=(queue, max_jobs, max_memory))
+            child.start()
+            children[child.pid] = child
+            stats[child.pid] = {'jobs': 0, 'failures': 0, 'work_time': 0.0, 'start_time': time.time()}
+
+        def log_child_stats(pid, message):
+            child_stats = stats[pid]
+            elapsed_time = time.time() - child_stats['start_time']
+            workers_logger.info("%s (%s)" % (message, json.dumps({
+                'task_name': queue, 'pid': pid, 'jobs': child_stats['jobs'], 'failures': child_stats['failures'],
+                'work_time': round(child_stats['work_time']),
+                'jobs_per_minute': round(child_stats['jobs'] * 60.0 / elapsed_time, 2) if elapsed_time else 0})))
+
+        workers_logger.info('Started supervisor with %i child workers with tasks: task_%s' % (num_workers, queue))
+        for _ in range(num_workers):
+            start_child()
+
+        last_report_time = time.time()
+        while running[0]:
+            try:
+                pid, result, work_time = self.jobs_queue.get(timeout=1)
+                if pid in stats:
+                    stats[pid]['jobs'] += 1
+                    stats[pid]['failures'] += 0 if result == 'success' else 1
+                    stats[pid]['work_time'] += work_time
+            except Queue.Empty:
+                pass
+            except IOError:
+                # Can happen when get is interrupted by a signal
+                pass
+
+            for pid, child in children.items():
+                if not child.is_alive():
+                    log_child_stats(pid, 'Child worker %i exited with code %s' % (pid, child.exitcode))
+                    del children[pid]
+                    del stats[pid]
+                    if running[0]:
+                        start_child()
+
+            if time.time() - last_report_time > report_interval:
+                for pid in children:
+                    log_child_stats(pid, 'Child worker %i throughput' % pid)
+                last_report_time = time.time()
+
+        workers_logger.info('Stopping supervisor and its %i child workers' % len(children))
+        for child in children.values():
+            child.terminate()
+        for child in children.values():
+            child.join()
+
+    def report_job(self, result, work_time):
+        """
+        Reports a finished job to the supervisor (if running as a child worker of the supervisor mode).
+        """
+        if self.jobs_queue is not None:
+            self.jobs_queue.put((os.getpid(), result, work_time))
+
     def task_analyze_sound(self, gearman_worker, gearman_job):
         task_name = 'analyze_sound'
         job_data = json.loads(gearman_job.data)
@@ -113,10 +291,12 @@ class Command(BaseCommand):
         workers_logger.info("Starting analysis of sound (%s)" % json.dumps(
             {'task_name': task_name, 'sound_id': sound_id}))
         start_time = time.time()
+        job_result = 'failure'
         try:
             check_if_free_space()
             result = FreesoundAudioAnalyzer(sound_id=sound_id).analyze()
             if result:
+                job_result = 'success'
                 workers_logger.info("Finished analysis of sound (%s)" % json.dumps(
                     {'task_name': task_name, 'sound_id': sound_id, 'result': 'success',
                      'work_time': round(time.time() - start_time)}))
@@ -136,6 +316,7 @@ class Command(BaseCommand):
                  'work_time': round(time.time() - start_time)}))
 
         cancel_timeout_alarm()
+        self.report_job(job_result, time.time() - start_time)
         return ''  # Gearman requires return value to be a string
 
     def task_process_sound(self, gearman_worker, gearman_job):
@@ -149,11 +330,13 @@ class Command(BaseCommand):
         workers_logger.info("Starting processing of sound (%s)" % json.dumps({
             'task_name': task_name, 'sound_id': sound_id}))
         start_time = time.time()
+        job_result = 'failure'
         try:
             check_if_free_space()
             result = FreesoundAudioProcessor(sound_id=sound_id)\
                 .process(skip_displays=skip_displays, skip_previews=skip_previews)
             if result:
+                job_result = 'success'
                 workers_logger .info("Finished processing of sound (%s)" % json.dumps(
                     {'task_name': task_name, 'sound_id': sound_id, 'result': 'success',
                      'work_time': round(time.time() - start_time)}))
@@ -173,4 +356,5 @@ class Command(BaseCommand):
                  'work_time': round(time.time() - start_time)}))
 
         cancel_timeout_alarm()
+        self.report_job(job_result, time.time() - start_time)
         return ''  # Gearman requires return value to be a string
@@ -0,0 +1,120 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import Queue
+import signal
+from itertools import count
+
+import mock
+from django.test import SimpleTestCase
+
+from sounds.management.commands.gm_worker_processing import Command, RecyclableGearmanWorker
+
+
+class FakeProcess(object):
+    """Replaces multiprocessing.Process in the supervisor, children are alive until they are told to exit"""
+
+    pids = count(1000)
+
+    def __init__(self, target, args):
+        self.pid = None
+        self.alive = False
+        self.exitcode = None
+        self.terminated = False
+
+    def start(self):
+        self.pid = next(self.pids)
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    def exit(self, exitcode):
+        self.alive = False
+        self.exitcode = exitcode
+
+    def terminate(self):
+        self.terminated = True
+        self.exit(-signal.SIGTERM)
+
+    def join(self):
+        pass
+
+
+@mock.patch('sounds.management.commands.gm_worker_processing.signal.signal')
+class GearmanWorkerSupervisorTest(SimpleTestCase):
+
+    def run_child_worker(self, max_jobs, max_memory):
+        """Runs a child worker without its work loop and returns the worker and its task function"""
+        with mock.patch.object(RecyclableGearmanWorker, 'work', autospec=True) as work:
+            Command().run_child_worker('process_sound', max_jobs, max_memory)
+        gm_worker = work.call_args[0][0]
+        return gm_worker, gm_worker.worker_abilities['process_sound']
+
+    @mock.patch.object(Command, 'task_process_sound', return_value='')
+    def test_child_worker_max_jobs(self, task_process_sound, signal_signal):
+        gm_worker, task_func = self.run_child_worker(max_jobs=2, max_memory=0)
+        self.assertTrue(gm_worker.after_poll(False))
+        task_func(gm_worker, mock.Mock())
+        self.assertTrue(gm_worker.after_poll(True))
+        task_func(gm_worker, mock.Mock())
+        self.assertFalse(gm_worker.after_poll(True))
+        self.assertEqual(task_process_sound.call_count, 2)
+
+    @mock.patch('sounds.management.commands.gm_worker_processing.get_max_memory_usage')
+    @mock.patch.object(Command, 'task_process_sound', return_value='')
+    def test_child_worker_max_memory(self, task_process_sound, get_max_memory_usage, signal_signal):
+        gm_worker, task_func = self.run_child_worker(max_jobs=0, max_memory=500)
+        get_max_memory_usage.return_value = 400.0
+        task_func(gm_worker, mock.Mock())
+        self.assertTrue(gm_worker.after_poll(True))
+        get_max_memory_usage.return_value = 600.0
+        self.assertFalse(gm_worker.after_poll(True))
+
+    @mock.patch('sounds.management.commands.gm_worker_processing.connections')
+    @mock.patch('sounds.management.commands.gm_worker_processing.multiprocessing')
+    def test_supervisor_replaces_children(self, multiprocessing, connections, signal_signal):
+        children = []
+
+        def create_process(target, args):
+            children.append(FakeProcess(target, args))
+            return children[-1]
+
+        def get_job(timeout):
+            if len(children) == 2:
+                # A child exits and it is replaced by a new one
+                children[0].exit(0)
+            else:
+                # Stop the supervisor with the SIGTERM handler it installed
+                handlers = dict(call[0] for call in signal_signal.call_args_list)
+                handlers[signal.SIGTERM](signal.SIGTERM, None)
+            raise Queue.Empty
+
+        multiprocessing.Process.side_effect = create_process
+        multiprocessing.Queue.return_value.get.side_effect = get_job
+        Command().run_supervisor('process_sound', num_workers=2, max_jobs=10, max_memory=0, report_interval=300)
+
+        self.assertEqual(len(children), 3)
+        multiprocessing.Process.assert_called_with(target=mock.ANY, args=('process_sound', 10, 0))
+        self.assertFalse(children[0].terminated)
+        self.assertEqual(children[0].exitcode, 0)
+        self.assertTrue(children[1].terminated)
+        self.assertTrue(children[2].terminated)
+        self.assertEqual(connections.close_all.call_count, 3)
@@ -769,8 +769,8 @@ class SoundTemplateCacheTests(TestCase):
         self.assertInHTML('1 download', resp.content)
 
     # Similarity link (cached in display and view)
-    @mock.patch('general.management.commands.similarity_update.Similarity.add', return_value='Dummy response')
-    def _test_similarity_update(self, cache_keys, check_present, similarity_add):
+    @mock.patch('general.management.commands.similarity_update.Similarity.add_points')
+    def _test_similarity_update(self, cache_keys, check_present, similarity_add_points):
         # Default analysis_state is 'PE', but for similarity update it should be 'OK', otherwise sound gets ignored
         self.sound.analysis_state = 'OK'
         self.sound.save()
@@ -785,8 +785,10 @@ class SoundTemplateCacheTests(TestCase):
         self._assertCachePresent(cache_keys)
 
         # Update similarity
+        similarity_add_points.return_value = {'added': [str(self.sound.id)], 'failed': {}}
         call_command('similarity_update', freesound_extractor_version=None)
-        similarity_add.assert_called_once_with(self.sound.id, self.sound.locations('analysis.statistics.path'))
+        similarity_add_points.assert_called_once_with(
+            [(self.sound.id, self.sound.locations('analysis.statistics.path'))])
         self._assertCacheAbsent(cache_keys)
 
         # Check similarity icon
@@ -20,6 +20,7 @@
 
 from django.conf import settings
 import json
+import urllib
 import urllib2
 
 _BASE_URL                     = 'http://%s:%i/tagrecommendation/' % (settings.TAGRECOMMENDATION_ADDRESS, settings.TAGRECOMMENDATION_PORT)
@@ -28,8 +29,8 @@ _URL_LAST_INDEXED_ID          = 'last_indexed_id/'
 _URL_ADD_TO_INDEX             = 'add_to_index/'
 
 
-def _get_url_as_json(url):
-    f = urllib2.urlopen(url.replace(" ","%20"), timeout=settings.TAGRECOMMENDATION_TIMEOUT)
+def _get_url_as_json(url, data=None, timeout=settings.TAGRECOMMENDATION_TIMEOUT):
+    f = urllib2.urlopen(url.replace(" ","%20"), data=data, timeout=timeout)
     resp = f.read()
     return json.loads(resp)
 
@@ -57,5 +58,6 @@ class TagRecommendation():
 
     @classmethod
     def add_to_index(cls, sound_ids, sound_tagss):
-        url = _BASE_URL + _URL_ADD_TO_INDEX + '?' + 'sound_ids=' + ",".join([str(sid) for sid in sound_ids]) + '&sound_tagss=' + "-!-!-".join([",".join(stags) for stags in sound_tagss])
-        return _result_or_exception(_get_url_as_json(url))
+        """Adds several sounds at once (data is sent in a POST request so batches can be big)"""
+        data = urllib.urlencode({'sounds': json.dumps([[str(sid), list(stags)] for sid, stags in zip(sound_ids, sound_tagss)])})
+        return _result_or_exception(_get_url_as_json(_BASE_URL + _URL_ADD_TO_INDEX, data=data, timeout=60 * 5))
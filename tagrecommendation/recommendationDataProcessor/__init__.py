@@ -20,10 +20,10 @@
 
 from tagrecommendation_settings import RECOMMENDATION_TMP_DATA_DIR, RECOMMENDATION_DATA_DIR
 import fileinput, sys, os
-from utils import saveToJson, mtx2npy, loadFromJson
-from numpy import save, load, where, in1d
-from math import sqrt
-from pysparse import spmatrix
+from utils import saveToJson, loadFromJson
+from tag_index import TagIndex
+from numpy import save, load, where, in1d, array, bincount, concatenate, ones, sqrt, int32, float32, float64
+from scipy import sparse
 from communityDetection import CommunityDetector
 from datetime import datetime
 import urllib
@@ -32,7 +32,8 @@ import urllib
 class RecommendationDataProcessor:
     '''
     This class has methods to generate all the files that the tag recommendation systems needs to recommend tags.
-    To generate these files the data processor needs the Index.json file with the tag association information from freesound.
+    To generate these files the data processor needs the Index.json file with the tag association information from freesound
+    (and the Index.log.jsonl file with the sounds added since it was last compacted, see TagIndex).
     The Index.json file must have the following form:
 
     {
@@ -66,18 +67,28 @@ class RecommendationDataProcessor:
 
     def tas_to_association_matrix(self, tag_threshold=0, line_limit=1000000000):
 
-        index = loadFromJson(RECOMMENDATION_DATA_DIR + "Index.json")
-        # Get tags from file
-        ts = []
+        # Read the index file entry by entry (without loading the whole file) and map tags to integer ids
+        if self.verbose:
+            print "Reading index file...",
+            sys.stdout.flush()
+        tag_ids_map = dict()
+        unique_ts = []
+        sound_ids = []
+        sound_tags = []  # list of arrays of tag ids (one array per sound)
         idx = 0
         n_original_associations = 0
-        sound_ids = []
-        if self.verbose:
-            print "Reading index file (%i entries)..." % len(index.items()),
-        for sid, tags in index.items():
-            ts += tags
-            n_original_associations += len(tags)
+        for sid, tags in TagIndex(RECOMMENDATION_DATA_DIR + "Index.json").iter_items():
+            ids = []
+            for t in tags:
+                t_id = tag_ids_map.get(t, None)
+                if t_id is None:
+                    t_id = len(unique_ts)
+                    tag_ids_map[t] = t_id
+                    unique_ts.append(t)
+                ids.append(t_id)
             sound_ids.append(sid)
+            sound_tags.append(array(ids, dtype=int32))
+            n_original_associations += len(tags)
 
             idx += 1
             if idx > line_limit:
@@ -89,100 +100,57 @@ class RecommendationDataProcessor:
         }
         saveToJson(RECOMMENDATION_TMP_DATA_DIR + 'Current_index_stats.json', stats)
         if self.verbose:
-            print "done!"
-
-        # Compute tag ocurrences after loading the file
-        tag_occurrences = dict()
-        unique_ts = list(set(ts))
-        for id, t in enumerate(unique_ts):
-            tag_occurrences[t] = ts.count(t)
-
-            if self.verbose:
-                sys.stdout.write("\rComputing tag occurrences %.2f%%"%(float(100*(id+1))/len(unique_ts)))
-                sys.stdout.flush()
-        print ""
-        tags = []
-        tags_ids = []
-        for id, t in enumerate(unique_ts):
-
-            if tag_occurrences[t] >= tag_threshold:
-                tags.append(t)
-                tags_ids.append(id)
-
-            if self.verbose:
-                sys.stdout.write("\rFiltering tags %.2f%%"%(float(100*(id+1))/len(unique_ts)))
-                sys.stdout.flush()
+            print "done! (%i entries)" % len(sound_ids)
 
+        # Compute tag ocurrences and filter tags
+        all_tag_ids = concatenate(sound_tags) if sound_tags else array([], dtype=int32)
+        tag_occurrences = bincount(all_tag_ids, minlength=len(unique_ts))
+        tags_ids = where(tag_occurrences >= tag_threshold)[0]
+        tags = [unique_ts[t_id] for t_id in tags_ids]
         nTags = len(tags)
         if self.verbose:
-            print ""
             print "\tOriginal number of tags: " + str(len(unique_ts))
             print "\tTags after filtering: " + str(nTags)
 
-        # Generate resource-tags dictionary only with filtered tags
-        if self.verbose:
-            print "Reading file for resources...",
-        sys.stdout.flush()
+        # Generate resource-tags data only with filtered tags. Columns of the association matrix follow the order of
+        # filtered tags.
+        column_of_tag_id = -ones(len(unique_ts), dtype=int32)
+        column_of_tag_id[tags_ids] = range(nTags)
         res_tags = {}
-        res_user = {}
-        res_tags_no_filt = {}
-        idx = 0
-        n_filtered_associations = 0
-        for sid, stags in index.items():
-            resource = sid
-            user = None
-            assigned_tags = stags
-            assigned_tags_filt = list(set(assigned_tags).intersection(set(tags)))
-            res_tags_no_filt[resource] = assigned_tags
-            res_user[resource] = user
-            if len(assigned_tags_filt) > 0:
-                res_tags[resource] = assigned_tags_filt
-                n_filtered_associations += len(assigned_tags_filt)
-
-            idx += 1
-            if idx > line_limit:
-                break
-
-        resources = res_tags.keys()
+        resources = []
+        rows = []
+        columns = []
+        for sid, ids in zip(sound_ids, sound_tags):
+            assigned_columns = set(column_of_tag_id[ids].tolist())
+            assigned_columns.discard(-1)
+            if len(assigned_columns) > 0:
+                res_tags[sid] = [tags[column] for column in assigned_columns]
+                rows += [len(resources)] * len(assigned_columns)
+                columns += assigned_columns
+                resources.append(sid)
         nResources = len(resources)
-        resources_ids = range(0,nResources)
-        if self.verbose:
-            print "done!"
+        n_filtered_associations = len(rows)
 
-        # Generate assocoation matrix
+        # Generate association matrix
         if self.verbose:
             print "\tOriginal number of associations: " + str(n_original_associations)
             print "\tAssociations after filtering: " + str(n_filtered_associations)
-
-        if self.verbose:
-            print 'Creating empty array of ' + str(nResources) + ' x ' + str(nTags) + '...',
-        M = spmatrix.ll_mat(nResources, nTags)
+            print 'Creating association matrix of ' + str(nResources) + ' x ' + str(nTags) + '...',
+        M = sparse.csr_matrix((ones(n_filtered_associations, dtype=float32), (rows, columns)),
+                              shape=(nResources, nTags))
         if self.verbose:
             print 'done!'
 
-        done = 0
-        for r_id in resources:
-            for t in res_tags[r_id]:
-                M[resources.index(r_id),tags.index(t)] = 1
-                done += 1
-                if self.verbose:
-                    sys.stdout.write("\rGenerating association matrix %.2f%%" % (float(100*done)/n_filtered_associations))
-                    sys.stdout.flush()
-        if self.verbose:
-            print ""
-
         # Save data
         if self.verbose:
             print "Saving association matrix, resource ids, tag ids and tag names"
 
         filename = "FS%.4i%.2i%.2i" % (datetime.today().year, datetime.today().month, datetime.today().day)
-        M.export_mtx(RECOMMENDATION_TMP_DATA_DIR + filename + '_ASSOCIATION_MATRIX.mtx')
+        sparse.save_npz(RECOMMENDATION_TMP_DATA_DIR + filename + '_ASSOCIATION_MATRIX.npz', M)
         save(RECOMMENDATION_TMP_DATA_DIR + filename + '_RESOURCE_IDS.npy',resources)
         save(RECOMMENDATION_TMP_DATA_DIR + filename + '_TAG_IDS.npy',tags_ids)
         save(RECOMMENDATION_TMP_DATA_DIR + filename + '_TAG_NAMES.npy',tags)
         saveToJson(RECOMMENDATION_TMP_DATA_DIR + filename + '_RESOURCES_TAGS.json',res_tags, verbose = self.verbose)
-        #saveToJson(RECOMMENDATION_TMP_DATA_DIR + filename + '_RESOURCES_TAGS_NO_FILTER.json',res_tags_no_filt, verbose = self.verbose)
-        #saveToJson(RECOMMENDATION_TMP_DATA_DIR + filename + '_RESOURCES_USER.json',res_user, verbose = self.verbose)
 
         return filename
 
@@ -193,16 +161,12 @@ class RecommendationDataProcessor:
                                                 save_sim=False,
                                                 training_set=None,
                                                 out_name_prefix="",
-                                                is_general_recommender=False):
+                                                is_general_recommender=False,
+                                                association_data=None):
 
-        if self.verbose:
-            print "Loading association matrix and tag names, ids files..."
-        try:
-            M = spmatrix.ll_mat_from_mtx(RECOMMENDATION_TMP_DATA_DIR + dataset + "_ASSOCIATION_MATRIX.mtx")
-            resource_ids = load(RECOMMENDATION_TMP_DATA_DIR + dataset + "_RESOURCE_IDS.npy")
-            tag_names = load(RECOMMENDATION_TMP_DATA_DIR + dataset + "_TAG_NAMES.npy")
-        except Exception:
-            raise Exception("Error loading association matrix and tag names, ids data")
+        if association_data is None:
+            association_data = self.load_association_matrix(dataset)
+        M, resource_ids, tag_names = association_data
 
         if metric not in ['cosine', 'binary', 'coocurrence', 'jaccard']:
             raise Exception("Wrong similarity metric specified")
@@ -213,29 +177,23 @@ class RecommendationDataProcessor:
         resource_id_positions = where(in1d(resource_ids, training_set, assume_unique=True))[0]
 
         # Matrix multiplication (only taking in account resources in training set and ALL tags)
-        MM = spmatrix.dot(M[resource_id_positions, :], M[resource_id_positions, :])
-
-        # Get similarity matrix
-        sim_matrix = spmatrix.ll_mat(MM.shape[0],MM.shape[0])
-        non_zero_index = MM.keys()
-        for index in non_zero_index:
-            if metric == 'cosine':
-                sim_matrix[index[0], index[1]] = MM[index[0], index[1]] * (1 / (sqrt(MM[index[0], index[0]]) * sqrt(MM[index[1], index[1]])))
-            elif metric == 'coocurrence':
-                sim_matrix[index[0], index[1]] = MM[index[0], index[1]]
-            elif metric == 'binary':
-                sim_matrix[index[0], index[1]] = MM[index[0], index[1]]/MM[index[0], index[1]]
-            elif metric == 'jaccard':
-                sim_matrix[index[0], index[1]] = MM[index[0], index[1]] * (1 / (MM[index[0], index[0]] + MM[index[1], index[1]] - MM[index[0], index[1]]))
-
-        # Clean out similarity matrix (clean tags that are not used)
-        tag_positions = []
-        for i in range(0, sim_matrix.shape[0]):
-            if sim_matrix[i, i] != 0.0:
-                tag_positions.append(i)
+        M_subset = M[resource_id_positions, :]
+        MM = (M_subset.T * M_subset).tocoo()
+
+        # Get similarity matrix (only tags used in the training set, which have non zero diagonal, are kept)
+        diagonal = MM.diagonal().astype(float64)
+        tag_positions = where(diagonal != 0.0)[0]
+        row, col, value = MM.row, MM.col, MM.data.astype(float64)
+        if metric == 'cosine':
+            value = value * (1 / (sqrt(diagonal[row]) * sqrt(diagonal[col])))
+        elif metric == 'binary':
+            value = value / value
+        elif metric == 'jaccard':
+            value = value * (1 / (diagonal[row] + diagonal[col] - value))
+        sim_matrix = sparse.csr_matrix((value, (row, col)), shape=MM.shape)
 
         # Transform sparse similarity matrix to npy format
-        sim_matrix_npy = mtx2npy(sim_matrix[tag_positions,tag_positions])
+        sim_matrix_npy = sim_matrix[tag_positions, :][:, tag_positions].toarray().astype(float32)
         tag_names_sim_matrix = tag_names[tag_positions]
 
         if save_sim:
@@ -266,6 +224,17 @@ class RecommendationDataProcessor:
 
         return {'SIMILARITY_MATRIX': sim_matrix_npy, 'TAG_NAMES': tag_names_sim_matrix}
 
+    def load_association_matrix(self, dataset):
+        if self.verbose:
+            print "Loading association matrix and tag names, ids files..."
+        try:
+            M = sparse.load_npz(RECOMMENDATION_TMP_DATA_DIR + dataset + "_ASSOCIATION_MATRIX.npz").tocsr()
+            resource_ids = load(RECOMMENDATION_TMP_DATA_DIR + dataset + "_RESOURCE_IDS.npy")
+            tag_names = load(RECOMMENDATION_TMP_DATA_DIR + dataset + "_TAG_NAMES.npy")
+        except Exception:
+            raise Exception("Error loading association matrix and tag names, ids data")
+        return M, resource_ids, tag_names
+
     def process_tag_recommendation_data(self,
                                         resources_limit=None,
                                         tag_threshold=10,
@@ -303,9 +272,12 @@ class RecommendationDataProcessor:
         saveToJson(RECOMMENDATION_DATA_DIR + 'Classifier_classified_resources.json', resource_class)
         print ""
 
+        association_data = self.load_association_matrix(database_name)
+
         print "\nComputing data for general recommender..."
         self.association_matrix_to_similarity_matrix(
             dataset=database_name,
+            association_data=association_data,
             training_set=instances_ids[0:resources_limit],
             save_sim=True,
             is_general_recommender=True,
@@ -341,6 +313,7 @@ class RecommendationDataProcessor:
 
             self.association_matrix_to_similarity_matrix(
                 dataset=database_name,
+                association_data=association_data,
                 training_set=training_ids,
                 save_sim=True,
                 out_name_prefix=collection_id,
@@ -26,6 +26,7 @@ class TagRecommender:
 
     heuristic = None
     data = None
+    index = None
     dataset = None
     metric = None
 
@@ -48,11 +49,20 @@ class TagRecommender:
             self.heuristic = heuristic
         else:
             raise Exception("Wrong heuristic given")
+        self.build_index()
 
     def load_data(self, dataset=None, metric=None, data=None):
         self.data = data
         self.dataset = dataset
         self.metric = metric
+        self.build_index()
+
+    def build_index(self):
+        # Precompute the data used by the choose algorithm of the heuristic (if it defines an index function) so that
+        # it does not need to be computed for every recommendation
+        self.index = None
+        if self.heuristic and self.data and 'c_index' in self.heuristic:
+            self.index = self.heuristic['c_index'](self.data['TAG_NAMES'], self.data['SIMILARITY_MATRIX'], self.heuristic['options'])
 
     def recommend_tags(self, input_tags=None):
 
@@ -69,7 +79,10 @@ class TagRecommender:
         selectAlgorithm = self.heuristic['s']
 
         # CHOOSE candidate tags
-        candidate_tags = chooseAlgorithm(input_tags, self.data['TAG_NAMES'], self.data['SIMILARITY_MATRIX'], self.heuristic['options'])
+        if self.index is not None:
+            candidate_tags = chooseAlgorithm(input_tags, self.data['TAG_NAMES'], self.data['SIMILARITY_MATRIX'], self.heuristic['options'], index=self.index)
+        else:
+            candidate_tags = chooseAlgorithm(input_tags, self.data['TAG_NAMES'], self.data['SIMILARITY_MATRIX'], self.heuristic['options'])
 
         # AGGREGATE candidate tags
         aggregated_candiate_tags, aggregated_candiate_tags_list = aggregateAlgorithm(candidate_tags, input_tags, self.heuristic['options'])
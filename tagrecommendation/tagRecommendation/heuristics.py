@@ -21,5 +21,5 @@
 from tag_recommendation_utils import *
 
 heuristics = {
-    'hRankPercentage015': {'name':'RankP@0.15','c':cNMostSimilar, 'a':aNormalizedRankSum,'s':sPercentage, 'options':{'cNMostSimilar_N':100, 'aNormalizedRankSum_factor':1.0, 'sPercentage_percentage': 0.15}},
+    'hRankPercentage015': {'name':'RankP@0.15','c':cNMostSimilar, 'c_index':cNMostSimilarIndex, 'a':aNormalizedRankSum,'s':sPercentage, 'options':{'cNMostSimilar_N':100, 'aNormalizedRankSum_factor':1.0, 'sPercentage_percentage': 0.15}},
 }
\ No newline at end of file
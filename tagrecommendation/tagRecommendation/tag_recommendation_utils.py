@@ -23,24 +23,66 @@ import operator
 from numpy import *
 
 
-def cNMostSimilar(input_tags, tag_names, similarity_matrix, options):
+def nMostSimilarInRow(similarity_matrix, idx, N):
+    """Returns the indices and similarities of the N most similar tags of row idx, sorted by decreasing similarity."""
+
+    row_idx = nonzero(similarity_matrix[idx,:])
+    row_idx = row_idx[0]
+    row = similarity_matrix[idx,row_idx]
+    most_similar_idx = row.argsort()[-N-1:-1][::-1] # We pick the first N most similar tags (practically the same as no threshold but more efficient)
+    return row_idx[most_similar_idx], row[most_similar_idx]
+
+
+def cNMostSimilarIndex(tag_names, similarity_matrix, options):
+    """Precomputes the data needed by cNMostSimilar: a dictionary with the row of each tag in the similarity matrix
+    and a compact table with the N most similar tags of every row (CSR-like, the most similar tags of row i are
+    indices[indptr[i]:indptr[i + 1]] with similarities[indptr[i]:indptr[i + 1]], sorted by decreasing similarity)."""
+
+    N = options['cNMostSimilar_N']
+    tag_rows = dict()
+    for idx, name in enumerate(tag_names):
+        tag_rows.setdefault(name.decode('utf-8'), idx)
+
+    indptr = [0]
+    indices = []
+    similarities = []
+    for idx in range(similarity_matrix.shape[0]):
+        row_indices, row_similarities = nMostSimilarInRow(similarity_matrix, idx, N)
+        indices.append(row_indices)
+        similarities.append(row_similarities)
+        indptr.append(indptr[-1] + len(row_indices))
+
+    return {
+        'tag_rows': tag_rows,
+        'indptr': array(indptr),
+        'indices': concatenate(indices) if indices else array([], dtype=int),
+        'similarities': concatenate(similarities) if similarities else array([], dtype=similarity_matrix.dtype),
+    }
+
+
+def cNMostSimilar(input_tags, tag_names, similarity_matrix, options, index=None):
+    """If index (computed with cNMostSimilarIndex) is not given, the most similar tags of each input tag are computed
+    from its row of the similarity matrix."""
 
     N = options['cNMostSimilar_N']
-    unicode_tag_names = [t.decode('utf-8') for t in tag_names]
+    if index is not None:
+        tag_rows = index['tag_rows']
+    else:
+        tag_rows = dict()
+        for idx, name in enumerate(tag_names):
+            tag_rows.setdefault(name.decode('utf-8'), idx)
     candidate_tags = []
     for tag in input_tags:
         # Check that tag exists in the tag matrix, if it does not exist we cannot recommend similar tags
-        if tag in unicode_tag_names:
-            # Find N most similar tags in the row
-            idx = unicode_tag_names.index(tag)
-            #where(tag_names == tag)[0][0]
-            row_idx = nonzero(similarity_matrix[idx,:])
-            row_idx = row_idx[0]
-            row = similarity_matrix[idx,row_idx]
-            MAX = N
-            most_similar_idx = row.argsort()[-MAX-1:-1][::-1] # We pick the first N most similar tags (practically the same as no threshold but more efficient)
-            most_similar_dist = row[most_similar_idx]
-            most_similar_tags = tag_names[row_idx[most_similar_idx]]
+        idx = tag_rows.get(tag, None)
+        if idx is not None:
+            if index is not None:
+                # Get N most similar tags from the precomputed table
+                start, end = index['indptr'][idx], index['indptr'][idx + 1]
+                most_similar_idx, most_similar_dist = index['indices'][start:end], index['similarities'][start:end]
+            else:
+                most_similar_idx, most_similar_dist = nMostSimilarInRow(similarity_matrix, idx, N)
+            most_similar_tags = tag_names[most_similar_idx]
 
             rank = N
             for count,item in enumerate(most_similar_tags):
@@ -0,0 +1,133 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import json
+import os
+
+from utils import iterItemsFromJson
+
+
+class TagIndex(object):
+    """
+    Index with the tags of every sound, used to compute the tag recommendation data. It is stored as a JSON file with
+    sound ids as keys and lists of tags as values (the Index.json file, see RecommendationDataProcessor) plus an
+    append-only log with one JSON line per added sound. Adding sounds only appends lines to the log, and every
+    compaction_threshold added sounds the log is merged into the JSON file. The last indexed id and the number of
+    sounds in the index are tracked without reading the index again.
+    """
+
+    def __init__(self, path, compaction_threshold=100000):
+        self.path = path
+        self.log_path = os.path.splitext(path)[0] + '.log.jsonl'
+        self.compaction_threshold = compaction_threshold
+        self.sound_ids = set()
+        self.biggest_id = 0
+        self.log_size = 0
+
+    def __len__(self):
+        return len(self.sound_ids)
+
+    def load(self):
+        """Reads the sound ids from the index files (tags are not kept in memory)."""
+        self.sound_ids = set()
+        if os.path.exists(self.path):
+            for sid, _ in iterItemsFromJson(self.path):
+                self.sound_ids.add(int(sid))
+        self.truncate_log()
+        log = self.read_log()
+        self.sound_ids.update(int(sid) for sid in log)
+        self.log_size = len(log)
+        self.biggest_id = max(self.sound_ids) if self.sound_ids else 0
+
+    def truncate_log(self):
+        """Removes the incomplete last line left in the log by an interrupted add, so that new lines are not appended
+        to it."""
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, 'r+b') as f:
+            f.seek(0, os.SEEK_END)
+            size = end = f.tell()
+            # Search the last newline reading the file backwards
+            while end > 0:
+                start = max(end - 4096, 0)
+                f.seek(start)
+                newline = f.read(end - start).rfind('\n')
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end < size:
+                f.truncate(end)
+
+    def read_log(self):
+        """Returns a dictionary with the sounds in the log (the last entry of each sound is kept)."""
+        log = dict()
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'r') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        # The last line is being written
+                        break
+                    sid, tags = json.loads(line)
+                    log[sid] = tags
+        return log
+
+    def add(self, sounds):
+        """Adds a list of (sound id, list of tags) pairs to the index (tags of sounds already in the index are
+        replaced). Compacts the index if the log is bigger than compaction_threshold."""
+        lines = [json.dumps([str(sid), list(tags)]) + '\n' for sid, tags in sounds]
+        with open(self.log_path, 'a') as f:
+            f.write(''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+        for sid, _ in sounds:
+            sid = int(sid)
+            self.sound_ids.add(sid)
+            if sid > self.biggest_id:
+                self.biggest_id = sid
+        self.log_size += len(lines)
+
+        if self.log_size >= self.compaction_threshold:
+            self.compact()
+
+    def iter_items(self):
+        """Iterates over the (sound id, list of tags) pairs of the index, including the sounds in the log."""
+        log = self.read_log()
+        if os.path.exists(self.path):
+            for sid, tags in iterItemsFromJson(self.path):
+                if sid in log:
+                    yield sid, log.pop(sid)
+                else:
+                    yield sid, tags
+        for sid, tags in log.items():
+            yield sid, tags
+
+    def compact(self):
+        """Merges the log into the JSON file. The new JSON file is written to a temporary file which replaces the old
+        one, so readers never see an incomplete file."""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('{')
+            for count, (sid, tags) in enumerate(self.iter_items()):
+                f.write('%s\n    %s: %s' % (',' if count else '', json.dumps(sid), json.dumps(tags)))
+            f.write('\n}')
+        os.rename(tmp_path, self.path)
+        open(self.log_path, 'w').close()
+        self.log_size = 0
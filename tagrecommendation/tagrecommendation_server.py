@@ -35,7 +35,8 @@ from twisted.web import server, resource
 
 from communityBasedTagRecommendation import CommunityBasedTagRecommender
 import tagrecommendation_settings as tr_settings
-from utils import loadFromJson, saveToJson
+from tag_index import TagIndex
+from utils import loadFromJson
 
 
 def server_interface(resource):
@@ -43,7 +44,7 @@ def server_interface(resource):
         'recommend_tags': resource.recommend_tags,  # input_tags (tags separated by commas), max_number_of_tags (optional)
         'reload': resource.reload,
         'last_indexed_id': resource.last_indexed_id,
-        'add_to_index': resource.add_to_index,  # sound_ids (str separated by commas), sound_tagss (sets of tags separated by #)
+        'add_to_index': resource.add_to_index,  # sounds (JSON list of [sound_id, list of tags]), or sound_ids (str separated by commas) and sound_tagss (sets of tags separated by -!-!-)
     }
 
 
@@ -80,14 +81,15 @@ class TagRecommendationServer(resource.Resource):
             }
 
         try:
-            self.index = loadFromJson(tr_settings.RECOMMENDATION_DATA_DIR, 'Index.json')
-            self.index_stats['biggest_id_in_index'] = max([int(key) for key in self.index.keys()])
-            self.index_stats['n_sounds_in_index'] = len(self.index.keys())
+            self.index = TagIndex(tr_settings.RECOMMENDATION_DATA_DIR + 'Index.json',
+                                  compaction_threshold=tr_settings.INDEX_COMPACTION_THRESHOLD)
+            self.index.load()
         except Exception as e:
-            logger.error("Index file not present. Listening for indexing data from appservers.")
-            self.index_stats['biggest_id_in_index'] = 0
-            self.index_stats['n_sounds_in_index'] = 0
-            self.index = dict()
+            logger.error("Index file could not be loaded (%s). Listening for indexing data from appservers." % e)
+            self.index.sound_ids = set()
+            self.index.biggest_id = 0
+        self.index_stats['biggest_id_in_index'] = self.index.biggest_id
+        self.index_stats['n_sounds_in_index'] = len(self.index)
 
     def error(self,message):
         return json.dumps({'Error': message})
@@ -98,6 +100,9 @@ class TagRecommendationServer(resource.Resource):
     def render_GET(self, request):
         return self.methods[request.prepath[1]](**request.args)
 
+    def render_POST(self, request):
+        return self.methods[request.prepath[1]](**request.args)
+
     def recommend_tags(self, input_tags, max_number_of_tags=None):
 
         try:
@@ -129,22 +134,25 @@ class TagRecommendationServer(resource.Resource):
                        self.index_stats['n_sounds_in_matrix']))
         return json.dumps(result)
 
-    def add_to_index(self, sound_ids, sound_tagss):
-        sound_ids = sound_ids[0].split(",")
-        sound_tags = [stags.split(",") for stags in sound_tagss[0].split("-!-!-")]
-        logger.info('Adding %i sounds to recommendation index' % len(sound_ids))
-
-        for count, sound_id in enumerate(sound_ids):
-            sid = sound_id
-            stags = sound_tags[count]
-            self.index[sid] = stags
-
-        if len(self.index.keys()) % 1000 == 0:
-            # Every 1000 indexed sounds, save the index
-            logger.info('Saving tagrecommendation index...')
-            saveToJson(tr_settings.RECOMMENDATION_DATA_DIR + 'Index.json', self.index, verbose=False)
-            self.index_stats['biggest_id_in_index'] = max([int(key) for key in self.index.keys()])
-            self.index_stats['n_sounds_in_index'] = len(self.index.keys())
+    def add_to_index(self, sound_ids=None, sound_tagss=None, sounds=None):
+        if sounds is not None:
+            sounds = [(str(sid), stags) for sid, stags in json.loads(sounds[0])]
+        else:
+            sound_ids = sound_ids[0].split(",")
+            sound_tags = [stags.split(",") for stags in sound_tagss[0].split("-!-!-")]
+            sounds = zip(sound_ids, sound_tags)
+        logger.info('Adding %i sounds to recommendation index' % len(sounds))
+
+        try:
+            log_size = self.index.log_size
+            self.index.add(sounds)
+            if self.index.log_size < log_size:
+                logger.info('Compacted tagrecommendation index (%i sounds)' % len(self.index))
+        except Exception as e:
+            logger.error('Errors occurred while adding sounds to the index: %s' % e)
+            return json.dumps({'error': True, 'result': str(e)})
+        self.index_stats['biggest_id_in_index'] = self.index.biggest_id
+        self.index_stats['n_sounds_in_index'] = len(self.index)
 
         result = {'error': False, 'result': True}
         return json.dumps(result)
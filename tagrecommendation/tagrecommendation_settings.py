@@ -27,6 +27,9 @@ LISTEN_PORT = 8010
 RECOMMENDATION_DATA_DIR = '/freesound-data/tag_recommendation_models/'
 RECOMMENDATION_TMP_DATA_DIR = os.path.join(RECOMMENDATION_DATA_DIR, 'tmp')
 
+# Number of sounds added to the index log (Index.log.jsonl) before it is merged into Index.json
+INDEX_COMPACTION_THRESHOLD = 100000
+
 # Graylog GELF endpoint
 LOGSERVER_IP_ADDRESS = 'IP_ADDRESS'
 LOGSERVER_PORT = 0000
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+from __future__ import absolute_import
+
+import json
+import os
+
+from django.test import SimpleTestCase
+
+from tagrecommendation.tag_index import TagIndex
+from tagrecommendation.utils import iterItemsFromJson
+from utils.filesystem import TemporaryDirectory
+
+
+class TagIndexTest(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.index = TagIndex(os.path.join(self.tmp_dir.name, 'Index.json'), compaction_threshold=3)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_add_and_compact(self):
+        self.index.load()
+        self.index.add([(1, ['a', 'b']), (2, ['c'])])
+        self.assertFalse(os.path.exists(self.index.path))
+        self.index.add([(3, ['d']), (1, ['e'])])  # Compacts the index
+        self.assertTrue(os.path.exists(self.index.path))
+        self.assertEqual(os.path.getsize(self.index.log_path), 0)
+        self.index.add([(4, ['f'])])
+
+        index = TagIndex(self.index.path)
+        index.load()
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.biggest_id, 4)
+        self.assertEqual(dict(index.iter_items()), {'1': ['e'], '2': ['c'], '3': ['d'], '4': ['f']})
+
+    def test_load_after_interrupted_add(self):
+        self.index.load()
+        self.index.add([(1, ['a'])])
+        with open(self.index.log_path, 'a') as f:
+            f.write('["2", ["b"')
+
+        index = TagIndex(self.index.path, compaction_threshold=3)
+        index.load()
+        self.assertEqual(len(index), 1)
+        index.add([(3, ['c'])])
+        index.load()
+        self.assertEqual(len(index), 2)
+        self.assertEqual(dict(index.iter_items()), {'1': ['a'], '3': ['c']})
+        index.add([(4, ['d'])])  # Compacts the index
+        self.assertEqual(dict(index.iter_items()), {'1': ['a'], '3': ['c'], '4': ['d']})
+
+
+class IterItemsFromJsonTest(SimpleTestCase):
+
+    def test_chunk_boundaries(self):
+        tmp_dir = TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        path = os.path.join(tmp_dir.name, 'Index.json')
+        with open(path, 'w') as f:
+            f.write('{"1": ["a", "b"], "2" : -3.5e2, "3": 12345, "4": {"x": [1.5, null]},\n'
+                    ' "5": "\\u00e9t\\u00e9", "6": true, "7": []\n}')
+        with open(path) as f:
+            expected = sorted(json.load(f).items())
+        for chunk_size in range(1, 20):
+            self.assertEqual(sorted(iterItemsFromJson(path, chunk_size=chunk_size)), expected)
@@ -18,9 +18,12 @@
 #     See AUTHORS file.
 #
 
+import io
 import json
-from numpy import zeros
-import sys
+import re
+
+JSON_WHITESPACE = re.compile(r'\s*')
+JSON_NUMBER_CHARS = re.compile(r'[0-9.eE+-]*')
 
 
 def loadFromJson(path, verbose=False):
@@ -35,25 +38,57 @@ def saveToJson(path="", data="", verbose=True):
             print "Saving data to '" + path + "'"
         json.dump(data,f,indent=4)
 
-def mtx2npy(M, verbose = True):
-    n = M.shape[0]
-    m = M.shape[1]
-    npy = zeros((n, m) , 'float32')
-    #non_zero_index = M.keys()
-    items = M.items()
-    nItems = len(M.items())
-    done = 0
-    #for index in non_zero_index :
-    for index, value in items:
-        npy[ index[0] ][ index[1] ] = value #M[ index[0] , index[1] ]
-
-        done += 1
-        if verbose:
-            sys.stdout.write("\rConverting to npy... " + '%.2f'%((float(done)*100)/float(nItems)) + "% ")
-            sys.stdout.flush()
+def iterItemsFromJson(path, chunk_size=1024 * 1024):
+    """Iterates over the (key, value) pairs of the JSON object stored in path (e.g. the Index.json file) without
+    loading the whole file in memory. The file is read in chunks and values are decoded one at a time."""
+    decoder = json.JSONDecoder()
+    with io.open(path, 'r', encoding='utf-8') as f:
+        buf = f.read(chunk_size)
+        pos = 0
+        eof = not buf
+
+        def refill(buf, pos):
+            chunk = f.read(chunk_size)
+            return buf[pos:] + chunk, 0, not chunk
+
+        def expect(buf, pos, eof, chars):
+            # Skips whitespace and returns the position of the next character, which must be one of chars
+            while True:
+                pos = JSON_WHITESPACE.match(buf, pos).end()
+                if pos < len(buf):
+                    break
+                if eof:
+                    raise ValueError("Unexpected end of file in %s" % path)
+                buf, pos, eof = refill(buf, pos)
+            if buf[pos] not in chars:
+                raise ValueError("Expected one of '%s' in %s but found '%s'" % (chars, path, buf[pos]))
+            return buf, pos, eof
 
-    if verbose:
-        sys.stdout.write("\n")
-        sys.stdout.flush()
-    return npy
+        def decode(buf, pos, eof):
+            # Decodes the value starting at pos, reading more data if the value is not complete in the buffer. If only
+            # characters of numbers follow the value, it might be an incomplete number (e.g. '-3.' of '-3.5e2', which
+            # is decoded as -3) so more data is read as well.
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                    if JSON_NUMBER_CHARS.match(buf, end).end() < len(buf) or eof:
+                        return value, buf, end, eof
+                except ValueError:
+                    if eof:
+                        raise
+                buf, pos, eof = refill(buf, pos)
 
+        buf, pos, eof = expect(buf, pos, eof, '{')
+        pos += 1
+        buf, pos, eof = expect(buf, pos, eof, '"}')
+        while buf[pos] != '}':
+            key, buf, pos, eof = decode(buf, pos, eof)
+            buf, pos, eof = expect(buf, pos, eof, ':')
+            pos += 1
+            buf, pos, eof = expect(buf, pos, eof, '"{[-0123456789tfn')
+            value, buf, pos, eof = decode(buf, pos, eof)
+            yield key, value
+            buf, pos, eof = expect(buf, pos, eof, ',}')
+            if buf[pos] == ',':
+                pos += 1
+                buf, pos, eof = expect(buf, pos, eof, '"')
@@ -21,6 +21,7 @@
 import logging
 import os
 import tempfile
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
 
@@ -130,6 +131,62 @@ class FreesoundAudioProcessor(FreesoundAudioProcessorBase):
         self.sound.set_processing_ongoing_state("FI")
         self.sound.change_processing_state("FA", processing_log=self.work_log)
 
+    def start_previews(self, wavefile):
+        """
+        Starts the generation of MP3 and OGG previews from the given PCM file. Encoders run in a pool of threads (at
+        most settings.PROCESSING_MAX_CONCURRENT_ENCODERS at a time), as most of the work is done by the external
+        encoder processes. The pool is kept in self.previews_pool until wait_for_previews joins it.
+        :param wavefile: path of the PCM file to encode
+        :return: list of (preview_format, preview_path, async_result) tuples to pass to wait_for_previews
+        """
+        self.previews_pool = ThreadPool(processes=settings.PROCESSING_MAX_CONCURRENT_ENCODERS)
+        previews = []
+        for preview_format, convert_function, preview_path, quality in [
+            ('mp3', audioprocessing.convert_to_mp3, self.sound.locations("preview.LQ.mp3.path"), 70),
+            ('mp3', audioprocessing.convert_to_mp3, self.sound.locations("preview.HQ.mp3.path"), 192),
+            ('ogg', audioprocessing.convert_to_ogg, self.sound.locations("preview.LQ.ogg.path"), 1),
+            ('ogg', audioprocessing.convert_to_ogg, self.sound.locations("preview.HQ.ogg.path"), 6),
+        ]:
+            previews.append((preview_format, preview_path,
+                             self.previews_pool.apply_async(convert_function, (wavefile, preview_path, quality))))
+        self.previews_pool.close()
+        return previews
+
+    def wait_for_previews(self, previews):
+        """
+        Waits for the previews started with start_previews to finish and logs the result of each one. If any of the
+        previews failed, processing is marked as failed with the error of the first failed preview (in the order
+        they were started) and the errors of the other failed previews are added to the log. The threads of the pool
+        are joined before returning.
+        :param previews: list of (preview_format, preview_path, async_result) tuples returned by start_previews
+        :return: True if all previews were generated, False otherwise
+        """
+        executables = {'mp3': 'lame', 'ogg': 'oggenc'}
+        failures = []
+        try:
+            for preview_format, preview_path, result in previews:
+                try:
+                    result.get()
+                except OSError as e:
+                    failures.append(("conversion to %s (preview) has failed, make sure that %s executable exists: %s"
+                                     % (preview_format, executables[preview_format], e), None))
+                except AudioProcessingException as e:
+                    failures.append(("conversion to %s (preview) has failed" % preview_format, e))
+                except Exception as e:
+                    failures.append(("unhandled exception generating %s previews" % preview_format.upper(), e))
+                else:
+                    self.log_info("created %s: %s" % (preview_format, preview_path))
+        finally:
+            self.previews_pool.join()
+            self.previews_pool = None
+
+        if failures:
+            for message, error in failures[1:]:
+                self.log_error("%s%s" % (message, ": %s" % error if error else ""))
+            self.set_failure(*failures[0])
+            return False
+        return True
+
     def process(self, skip_previews=False, skip_displays=False):
 
         with TemporaryDirectory(
@@ -197,6 +254,9 @@ class FreesoundAudioProcessor(FreesoundAudioProcessorBase):
                 return False
 
             # Generate MP3 and OGG previews
+            # Encoders run in background threads so that they run concurrently with each other and with the
+            # generation of display images below. Results are collected once displays have been generated.
+            previews = None
             if not skip_previews:
 
                 # Create directory to store previews (if it does not exist)
@@ -207,42 +267,10 @@ class FreesoundAudioProcessor(FreesoundAudioProcessorBase):
                     self.set_failure("could not create directory for previews")
                     return False
 
-                # Generate MP3 previews
-                for mp3_path, quality in [(self.sound.locations("preview.LQ.mp3.path"), 70),
-                                          (self.sound.locations("preview.HQ.mp3.path"), 192)]:
-                    try:
-                        audioprocessing.convert_to_mp3(tmp_wavefile2, mp3_path, quality)
-                    except OSError as e:
-                        self.set_failure("conversion to mp3 (preview) has failed, "
-                                         "make sure that lame executable exists: %s" % e)
-                        return False
-
-                    except AudioProcessingException as e:
-                        self.set_failure("conversion to mp3 (preview) has failed", e)
-                        return False
-                    except Exception as e:
-                        self.set_failure("unhandled exception generating MP3 previews", e)
-                        return False
-                    self.log_info("created mp3: " + mp3_path)
-
-                # Generate OGG previews
-                for ogg_path, quality in [(self.sound.locations("preview.LQ.ogg.path"), 1),
-                                          (self.sound.locations("preview.HQ.ogg.path"), 6)]:
-                    try:
-                        audioprocessing.convert_to_ogg(tmp_wavefile2, ogg_path, quality)
-                    except OSError as e:
-                        self.set_failure("conversion to ogg (preview) has failed, "
-                                         "make sure that oggenc executable exists: %s" % e)
-                        return False
-                    except AudioProcessingException as e:
-                        self.set_failure("conversion to ogg (preview) has failed", e)
-                        return False
-                    except Exception as e:
-                        self.set_failure("unhandled exception generating OGG previews", e)
-                        return False
-                    self.log_info("created ogg: " + ogg_path)
+                previews = self.start_previews(tmp_wavefile2)
 
             # Generate display images for different sizes and colour scheme front-ends
+            displays_failure = None
             if not skip_displays:
 
                 # Create directory to store display images (if it does not exist)
@@ -250,31 +278,41 @@ class FreesoundAudioProcessor(FreesoundAudioProcessorBase):
                 try:
                     create_directories(os.path.dirname(self.sound.locations("display.wave.M.path")))
                 except OSError:
-                    self.set_failure("could not create directory for displays")
-                    return False
+                    displays_failure = ("could not create directory for displays", None)
 
                 # Generate display images, M and L sizes for NG and BW front-ends
-                for width, height, color_scheme, waveform_path, spectral_path in [
-                    (120, 71, color_schemes.FREESOUND2_COLOR_SCHEME,
-                     self.sound.locations("display.wave.M.path"), self.sound.locations("display.spectral.M.path")),
-                    (900, 201, color_schemes.FREESOUND2_COLOR_SCHEME,
-                     self.sound.locations("display.wave.L.path"), self.sound.locations("display.spectral.L.path")),
-                    (195, 101, color_schemes.BEASTWHOOSH_COLOR_SCHEME,
-                     self.sound.locations("display.wave_bw.M.path"), self.sound.locations("display.spectral_bw.M.path")),
-                    (780, 301, color_schemes.BEASTWHOOSH_COLOR_SCHEME,
-                     self.sound.locations("display.wave_bw.L.path"), self.sound.locations("display.spectral_bw.L.path")),
-                ]:
+                # All images are rendered in a single pass so that the PCM file is only decoded once
+                displays = [
+                    (self.sound.locations("display.wave.M.path"), self.sound.locations("display.spectral.M.path"),
+                     120, 71, color_schemes.FREESOUND2_COLOR_SCHEME),
+                    (self.sound.locations("display.wave.L.path"), self.sound.locations("display.spectral.L.path"),
+                     900, 201, color_schemes.FREESOUND2_COLOR_SCHEME),
+                    (self.sound.locations("display.wave_bw.M.path"), self.sound.locations("display.spectral_bw.M.path"),
+                     195, 101, color_schemes.BEASTWHOOSH_COLOR_SCHEME),
+                    (self.sound.locations("display.wave_bw.L.path"), self.sound.locations("display.spectral_bw.L.path"),
+                     780, 301, color_schemes.BEASTWHOOSH_COLOR_SCHEME),
+                ]
+                if displays_failure is None:
                     try:
                         fft_size = 2048
-                        audioprocessing.create_wave_images(tmp_wavefile2, waveform_path, spectral_path, width, height,
-                                                           fft_size, color_scheme=color_scheme)
-                        self.log_info("created wave and spectrogram images: %s, %s" % (waveform_path, spectral_path))
+                        audioprocessing.create_display_images(
+                            tmp_wavefile2, displays, fft_size,
+                            max_in_memory_frames=settings.PROCESSING_DISPLAYS_MAX_IN_MEMORY_FRAMES)
                     except AudioProcessingException as e:
-                        self.set_failure("creation of display images has failed", e)
-                        return False
+                        displays_failure = ("creation of display images has failed", e)
                     except Exception as e:
-                        self.set_failure("unhandled exception while generating displays", e)
-                        return False
+                        displays_failure = ("unhandled exception while generating displays", e)
+
+            # Wait for previews to finish (preview failures are reported before display failures)
+            if previews is not None and not self.wait_for_previews(previews):
+                return False
+
+            if not skip_displays:
+                if displays_failure is not None:
+                    self.set_failure(*displays_failure)
+                    return False
+                for waveform_path, spectral_path, _, _, _ in displays:
+                    self.log_info("created wave and spectrogram images: %s, %s" % (waveform_path, spectral_path))
 
         # Change processing state and processing ongoing state in Sound model
         self.sound.set_processing_ongoing_state("FI")
@@ -29,7 +29,7 @@ import subprocess
 
 import numpy
 import pysndfile
-from PIL import Image, ImageDraw
+from PIL import Image
 
 from color_schemes import COLOR_SCHEMES, DEFAULT_COLOR_SCHEME_KEY
 from utils.audioprocessing import get_sound_type
@@ -64,54 +64,104 @@ class TestAudioFile(object):
         return numpy.random.random(will_read) * 2 - 1
 
 
-def get_max_level(filename):
-    max_value = 0
-    buffer_size = 4096
+def read_mono_samples(filename, pad_start=0, pad_end=0, buffer_size=65536):
+    """
+    Reads the whole audio file into memory and returns a tuple with the (mono) samples and the sample rate of the file.
+    Multichannel files are converted to mono by selecting the left channel only. If the file has a broken header and
+    reading fails at some point, the samples that could not be read are left as zeros. The returned buffer is padded
+    with pad_start zeros at the beginning and pad_end zeros at the end.
+    """
     audio_file = pysndfile.PySndfile(filename, 'r')
-    n_samples_left = audio_file.frames()
+    nframes = audio_file.frames()
+    channels = audio_file.channels()
+    samplerate = audio_file.samplerate()
+    samples = numpy.zeros(pad_start + nframes + pad_end)
+    position = 0
 
-    while n_samples_left:
-        to_read = min(buffer_size, n_samples_left)
+    while position < nframes:
+        to_read = min(buffer_size, nframes - position)
 
         try:
-            samples = audio_file.read_frames(to_read)
+            block = audio_file.read_frames(to_read)
         except RuntimeError:
             # this can happen with a broken header
             break
 
-        # convert to mono by selecting left channel only
-        if audio_file.channels() > 1:
-            samples = samples[:, 0]
+        if channels > 1:
+            block = block[:, 0]
+
+        samples[pad_start + position:pad_start + position + len(block)] = block
+        position += to_read
+
+    audio_file.close()
 
-        max_value = max(max_value, numpy.abs(samples).max())
+    return samples, samplerate
 
-        n_samples_left -= to_read
 
+def get_num_frames(filename):
+    """
+    Returns the number of frames of an audio file without reading its samples.
+    """
+    audio_file = pysndfile.PySndfile(filename, 'r')
+    nframes = audio_file.frames()
     audio_file.close()
+    return nframes
+
 
-    return max_value
+def range_peaks(samples, starts):
+    """
+    Finds the minimum and maximum peaks of the consecutive ranges of samples that begin at the given starts (the last
+    range ends at the end of samples). An empty range (a start equal to the next one) takes the sample at its start.
+    Returns a (min_values, max_values, min_positions, max_positions) tuple of arrays, where positions are the indices
+    in samples at which each minimum and maximum is found for the first time.
+    """
+    lengths = numpy.diff(numpy.append(starts, len(samples)))
+    positions = numpy.arange(len(samples))
+
+    min_values = numpy.minimum.reduceat(samples, starts)
+    max_values = numpy.maximum.reduceat(samples, starts)
+    min_positions = numpy.minimum.reduceat(
+        numpy.where(samples == numpy.repeat(min_values, lengths), positions, len(samples)), starts)
+    max_positions = numpy.minimum.reduceat(
+        numpy.where(samples == numpy.repeat(max_values, lengths), positions, len(samples)), starts)
+
+    return min_values, max_values, min_positions, max_positions
+
+
+def ordered_peaks(min_values, max_values, min_positions, max_positions):
+    """
+    Returns a (len(min_values), 2) array with the pairs of peaks in the order they were found. So if min was found
+    first, the row is (min, max) else the other way around.
+    """
+    min_first = min_positions < max_positions
+    return numpy.column_stack((numpy.where(min_first, min_values, max_values),
+                               numpy.where(min_first, max_values, min_values)))
 
 
 class AudioProcessor(object):
     """
-    The audio processor processes chunks of audio an calculates the spectrac centroid and the peak
-    samples in that chunk of audio.
+    The audio processor calculates the spectral centroid, the spectrum and the peak samples of all the chunks of audio
+    that correspond to the columns of an image. The input file is decoded only once and kept in memory, so a single
+    AudioProcessor can be used to render several images of different sizes. All columns are computed at once using
+    NumPy arrays.
     """
 
     def __init__(self, input_filename, fft_size, window_function=numpy.hanning):
-        max_level = get_max_level(input_filename)
-
-        self.audio_file = pysndfile.PySndfile(input_filename, 'r')
-        self.nframes = self.audio_file.frames()
-        self.samplerate = self.audio_file.samplerate()
+        # the buffer is padded with zeros so that FFT windows centered at the first and last samples can be read
+        # as views of the buffer (see frames)
+        self.buffer, self.samplerate = read_mono_samples(input_filename, pad_start=fft_size / 2, pad_end=fft_size)
+        self.samples = self.buffer[fft_size / 2:len(self.buffer) - fft_size]
+        self.nframes = len(self.samples)
+        max_level = numpy.abs(self.samples).max() if self.nframes > 0 else 0
+        self.set_fft_parameters(fft_size, window_function, max_level)
+
+    def set_fft_parameters(self, fft_size, window_function, max_level):
         self.fft_size = fft_size
         self.window = window_function(self.fft_size)
-        self.spectrum_range = None
         self.lower = 100
         self.higher = 22050
         self.lower_log = math.log10(self.lower)
         self.higher_log = math.log10(self.higher)
-        self.clip = lambda val, low, high: min(high, max(low, val))
 
         # figure out what the maximum value is for an FFT doing the FFT of a DC signal
         fft = numpy.fft.rfft(numpy.ones(fft_size) * self.window)
@@ -119,130 +169,231 @@ class AudioProcessor(object):
         # set the scale to normalized audio and normalized FFT
         self.scale = 1.0 / max_level / max_fft if max_level > 0 else 1
 
-    def read(self, start, size, resize_if_less=False):
-        """ read size samples starting at start, if resize_if_less is True and less than size
-        samples are read, resize the array to size and fill with zeros """
-
-        # number of zeros to add to start and end of the buffer
-        add_to_start = 0
-        add_to_end = 0
-
-        if start < 0:
-            # the first FFT window starts centered around zero
-            if size + start <= 0:
-                return numpy.zeros(size) if resize_if_less else numpy.array([])
-            else:
-                self.audio_file.seek(0)
-
-                add_to_start = -start  # remember: start is negative!
-                to_read = size + start
-
-                if to_read > self.nframes:
-                    add_to_end = to_read - self.nframes
-                    to_read = self.nframes
-        else:
-            self.audio_file.seek(start)
-
-            to_read = size
-            if start + to_read >= self.nframes:
-                to_read = self.nframes - start
-                add_to_end = size - to_read
-
-        try:
-            samples = self.audio_file.read_frames(to_read)
-        except RuntimeError:
-            # this can happen for wave files with broken headers...
-            return numpy.zeros(size) if resize_if_less else numpy.zeros(2)
-
-        # convert to mono by selecting left channel only
-        if self.audio_file.channels() > 1:
-            samples = samples[:, 0]
-
-        if resize_if_less and (add_to_start > 0 or add_to_end > 0):
-            if add_to_start > 0:
-                samples = numpy.concatenate((numpy.zeros(add_to_start), samples), axis=0)
-
-            if add_to_end > 0:
-                samples = numpy.resize(samples, size)
-                samples[size - add_to_end:] = 0
-
-        return samples
-
-    def spectral_centroid(self, seek_point, spec_range=110.0):
-        """ starting at seek_point read fft_size samples, and calculate the spectral centroid """
-
-        samples = self.read(seek_point - self.fft_size / 2, self.fft_size, True)
-
-        samples *= self.window
-        fft = numpy.fft.rfft(samples)
-        spectrum = self.scale * numpy.abs(fft)  # normalized abs(FFT) between 0 and 1
-        length = numpy.float64(spectrum.shape[0])
+    def seek_points(self, image_width):
+        """ returns the image_width + 1 sample positions at which each column of an image of the given width starts
+        (the last one being the end of the file) """
+        samples_per_pixel = self.nframes / float(image_width)
+        return (numpy.arange(image_width + 1) * samples_per_pixel).astype(int)
+
+    def columns(self, image_width):
+        """ returns a (peaks, spectral_centroids, db_spectra) tuple with the peaks (see peaks), spectral centroids and
+        spectra (see spectral_centroids) of every column of an image of the given width """
+        seek_points = self.seek_points(image_width)
+        spectral_centroids, db_spectra = self.spectral_centroids(seek_points[:-1])
+        return self.peaks(seek_points), spectral_centroids, db_spectra
+
+    def frames(self, seek_points):
+        """ returns a (len(seek_points), fft_size) array with the fft_size samples centered around each seek point,
+        padded with zeros at the beginning and end of the file """
+        stride = self.buffer.strides[0]
+        all_frames = numpy.lib.stride_tricks.as_strided(
+            self.buffer, shape=(len(self.buffer) - self.fft_size + 1, self.fft_size), strides=(stride, stride))
+        # position i of the padded buffer is the start of the window centered around sample i
+        return all_frames[seek_points]
+
+    def spectral_centroids(self, seek_points, spec_range=110.0):
+        """ for every seek point calculate the spectral centroid and the spectrum of the fft_size samples centered around
+        it. Returns a (centroids, db_spectra) tuple of arrays where spectral centroids are log-scaled between 0 and 1
+        and spectra are dB-scaled between 0 and 1, with one row per seek point """
+        ffts = numpy.fft.rfft(self.frames(seek_points) * self.window, axis=1)
+        return self.spectral_features(numpy.abs(ffts), spec_range)
+
+    def spectral_features(self, magnitudes, spec_range=110.0):
+        """ given the abs(FFT) of a number of frames (one per row), calculate their spectral centroids and dB-scaled
+        spectra (see spectral_centroids) """
+
+        spectra = self.scale * magnitudes  # normalized abs(FFT) between 0 and 1
+        length = numpy.float64(spectra.shape[1])
 
         # scale the db spectrum from [- spec_range db ... 0 db] > [0..1]
-        db_spectrum = ((20 * (numpy.log10(spectrum + 1e-60))).clip(-spec_range, 0.0) + spec_range) / spec_range
-
-        energy = spectrum.sum()
-        spectral_centroid = 0
-
-        if energy > 1e-60:
-            # calculate the spectral centroid
-
-            if self.spectrum_range is None:
-                self.spectrum_range = numpy.arange(length)
-
-            spectral_centroid = (spectrum * self.spectrum_range).sum() / (energy * (length - 1)) * self.samplerate * 0.5
-
-            # clip > log10 > scale between 0 and 1
-            spectral_centroid = (math.log10(self.clip(spectral_centroid, self.lower, self.higher)) - self.lower_log) / (
-                        self.higher_log - self.lower_log)
-
-        return spectral_centroid, db_spectrum
-
-    def peaks(self, start_seek, end_seek):
-        """ read all samples between start_seek and end_seek, then find the minimum and maximum peak
-        in that range. Returns that pair in the order they were found. So if min was found first,
-        it returns (min, max) else the other way around. """
-
-        # larger blocksizes are faster but take more mem...
-        # Aha, Watson, a clue, a tradeof!
-        block_size = 4096
-
-        max_index = -1
-        max_value = -1
-        min_index = -1
-        min_value = 1
-
-        if start_seek < 0:
-            start_seek = 0
-
-        if end_seek > self.nframes:
-            end_seek = self.nframes
-
-        if end_seek <= start_seek:
-            samples = self.read(start_seek, 1)
-            return samples[0], samples[0]
-
-        if block_size > end_seek - start_seek:
-            block_size = end_seek - start_seek
-
-        for i in range(start_seek, end_seek, block_size):
-            samples = self.read(i, block_size)
-
-            local_max_index = numpy.argmax(samples)
-            local_max_value = samples[local_max_index]
-
-            if local_max_value > max_value:
-                max_value = local_max_value
-                max_index = local_max_index
+        db_spectra = ((20 * (numpy.log10(spectra + 1e-60))).clip(-spec_range, 0.0) + spec_range) / spec_range
+
+        energies = spectra.sum(axis=1)
+        has_energy = energies > 1e-60
+
+        # calculate the spectral centroids (for silent frames the spectral centroid is 0)
+        centroids = (spectra * numpy.arange(length)).sum(axis=1) / numpy.where(has_energy, energies, 1.0)
+        centroids *= self.samplerate * 0.5 / (length - 1)
+
+        # clip > log10 > scale between 0 and 1
+        centroids = (numpy.log10(centroids.clip(self.lower, self.higher)) - self.lower_log) / \
+            (self.higher_log - self.lower_log)
+        centroids[~has_energy] = 0
+
+        return centroids, db_spectra
+
+    def peaks(self, seek_points, max_chunk_size=2 ** 20):
+        """ for every pair of consecutive seek points find the minimum and maximum peak of the samples between them.
+        Returns a (len(seek_points) - 1, 2) array with the pair of peaks of each range in the order they were found.
+        So if min was found first, the row is (min, max) else the other way around. Empty ranges return the sample
+        at the start of the range twice. Ranges are processed in groups of about max_chunk_size samples so that the
+        temporary arrays of range_peaks do not grow with the length of the file. """
+
+        n_ranges = len(seek_points) - 1
+        if self.nframes == 0:
+            return numpy.zeros((n_ranges, 2))
+
+        starts = seek_points[:-1].clip(0, self.nframes - 1)
+        end = min(max(seek_points[-1], starts[-1] + 1), self.nframes)
+
+        peaks = []
+        first = 0
+        while first < n_ranges:
+            last = max(numpy.searchsorted(starts, starts[first] + max_chunk_size, side='right'), first + 1)
+            # the last range of the group must not be empty, an empty range takes the sample at its start
+            chunk_end = min(max(starts[last], starts[last - 1] + 1), self.nframes) if last < n_ranges else end
+            # reduceat works on consecutive ranges starting at the first start point
+            peaks.append(ordered_peaks(*range_peaks(self.samples[starts[first]:chunk_end],
+                                                    starts[first:last] - starts[first])))
+            first = last
+        return numpy.concatenate(peaks)
+
+
+class ColumnAccumulator(object):
+    """
+    Accumulates the peaks and the abs(FFT) of the columns of an image while an audio file is read sequentially in
+    chunks (see StreamingAudioProcessor). Memory usage only depends on the width of the image and the FFT size.
+    """
 
-            local_min_index = numpy.argmin(samples)
-            local_min_value = samples[local_min_index]
+    def __init__(self, seek_points, fft_size):
+        self.seek_points = seek_points
+        self.width = len(seek_points) - 1
+        self.fft_size = fft_size
 
-            if local_min_value < min_value:
-                min_value = local_min_value
-                min_index = local_min_index
+        self.min_values = numpy.full(self.width, numpy.inf)
+        self.max_values = numpy.full(self.width, -numpy.inf)
+        self.min_positions = numpy.zeros(self.width, dtype=int)
+        self.max_positions = numpy.zeros(self.width, dtype=int)
+
+        self.magnitudes = numpy.zeros((self.width, fft_size / 2 + 1))
+        self.next_column = 0  # first column whose spectrum has not been computed yet
+
+    @property
+    def next_window_start(self):
+        """ position (in padded coordinates, see add_spectra) of the first sample needed by columns whose spectrum
+        has not been computed yet, or None if all spectra have been computed """
+        return self.seek_points[self.next_column] if self.next_column < self.width else None
+
+    def add_peaks(self, block, block_start):
+        """ updates the peaks of the columns that overlap with a block of samples starting at position block_start """
+
+        block_end = block_start + len(block)
+        starts = self.seek_points[:-1]
+        ends = self.seek_points[1:]
+        overlapping = (starts < block_end) & ((ends > block_start) | ((starts == ends) & (starts >= block_start)))
+        columns = numpy.flatnonzero(overlapping)
+        if len(columns) == 0:
+            return
+
+        # columns are consecutive and the first one always starts at or before the start of the block
+        local_starts = starts[columns].clip(block_start, block_end - 1) - block_start
+        min_values, max_values, min_positions, max_positions = range_peaks(block, local_starts)
+
+        # peaks found in previous blocks were found earlier, so only replace them by strictly larger ones
+        lower = min_values < self.min_values[columns]
+        self.min_values[columns[lower]] = min_values[lower]
+        self.min_positions[columns[lower]] = min_positions[lower] + block_start
+
+        higher = max_values > self.max_values[columns]
+        self.max_values[columns[higher]] = max_values[higher]
+        self.max_positions[columns[higher]] = max_positions[higher] + block_start
+
+    def add_spectra(self, buffer, buffer_start, window):
+        """ computes the abs(FFT) of the columns whose FFT window is fully contained in buffer. Positions are in the
+        coordinates of the file padded with fft_size / 2 zeros at the beginning, so the window of each column starts
+        at its seek point and buffer_start is the position of the first sample of the buffer """
+
+        last_column = numpy.searchsorted(self.seek_points[:-1] + self.fft_size, buffer_start + len(buffer), 'right')
+        if last_column <= self.next_column:
+            return
+
+        columns = numpy.arange(self.next_column, last_column)
+        stride = buffer.strides[0]
+        all_frames = numpy.lib.stride_tricks.as_strided(
+            buffer, shape=(len(buffer) - self.fft_size + 1, self.fft_size), strides=(stride, stride))
+        frames = all_frames[self.seek_points[columns] - buffer_start]
+
+        self.magnitudes[columns] = numpy.abs(numpy.fft.rfft(frames * window, axis=1))
+        self.next_column = last_column
+
+    def peaks(self):
+        """ returns the peaks of all columns (see AudioProcessor.peaks) """
+        # columns without samples (only possible for empty files) are drawn at zero
+        return ordered_peaks(numpy.where(numpy.isinf(self.min_values), 0, self.min_values),
+                             numpy.where(numpy.isinf(self.max_values), 0, self.max_values),
+                             self.min_positions, self.max_positions)
+
+
+class StreamingAudioProcessor(AudioProcessor):
+    """
+    Same as AudioProcessor but the input file is read sequentially in chunks of chunk_size frames instead of being
+    loaded in memory. As there is no random access to the samples, the peaks and spectra of all the columns of the
+    images to be rendered (one per width in image_widths) are accumulated while the file is read, so memory usage
+    stays constant regardless of the length of the file and there are no seeks in the file.
+    """
 
-        return (min_value, max_value) if min_index < max_index else (max_value, min_value)
+    def __init__(self, input_filename, fft_size, image_widths, window_function=numpy.hanning, chunk_size=2 ** 20):
+        audio_file = pysndfile.PySndfile(input_filename, 'r')
+        self.nframes = audio_file.frames()
+        self.samplerate = audio_file.samplerate()
+        channels = audio_file.channels()
+        window = window_function(fft_size)
+
+        self.accumulators = {}
+        for image_width in image_widths:
+            self.accumulators[image_width] = ColumnAccumulator(self.seek_points(image_width), fft_size)
+
+        max_level = 0
+        broken_header = False
+        # buffer of samples needed by the spectra not yet computed, in padded coordinates (see add_spectra)
+        buffer = numpy.zeros(fft_size / 2)
+        buffer_start = 0
+        position = 0
+
+        while position < self.nframes:
+            to_read = min(chunk_size, self.nframes - position)
+
+            block = numpy.zeros(to_read)
+            if not broken_header:
+                try:
+                    samples = audio_file.read_frames(to_read)
+                    # convert to mono by selecting left channel only
+                    if channels > 1:
+                        samples = samples[:, 0]
+                    block[:len(samples)] = samples
+                except RuntimeError:
+                    # this can happen with a broken header, samples that can't be read are left as zeros
+                    broken_header = True
+
+            max_level = max(max_level, numpy.abs(block).max())
+            buffer = numpy.concatenate((buffer, block))
+
+            for accumulator in self.accumulators.values():
+                accumulator.add_peaks(block, position)
+                accumulator.add_spectra(buffer, buffer_start, window)
+
+            # drop the samples that are no longer needed by any accumulator
+            next_window_starts = [accumulator.next_window_start for accumulator in self.accumulators.values()
+                                  if accumulator.next_window_start is not None]
+            keep_from = min(next_window_starts + [buffer_start + len(buffer)])
+            buffer = buffer[keep_from - buffer_start:]
+            buffer_start = keep_from
+
+            position += to_read
+
+        audio_file.close()
+
+        # the last FFT windows go beyond the end of the file, compute them padding with zeros
+        buffer = numpy.concatenate((buffer, numpy.zeros(fft_size)))
+        for accumulator in self.accumulators.values():
+            accumulator.add_spectra(buffer, buffer_start, window)
+
+        self.set_fft_parameters(fft_size, window_function, max_level)
+
+    def columns(self, image_width):
+        accumulator = self.accumulators[image_width]
+        spectral_centroids, db_spectra = self.spectral_features(accumulator.magnitudes)
+        return accumulator.peaks(), spectral_centroids, db_spectra
 
 
 def interpolate_colors(colors, flat=False, num_colors=256):
@@ -286,73 +437,58 @@ class WaveformImage(object):
             print("WARNING: Height is not uneven, images look much better at uneven height")
 
         waveform_colors = COLOR_SCHEMES.get(color_scheme, COLOR_SCHEMES[DEFAULT_COLOR_SCHEME_KEY])['wave_colors']
-        background_color = waveform_colors[0]
+        self.background_color = numpy.array(waveform_colors[0], dtype=numpy.float64)
         colors = waveform_colors[1:]
 
-        self.image = Image.new("RGB", (image_width, image_height), background_color)
-
         self.image_width = image_width
         self.image_height = image_height
 
-        self.draw = ImageDraw.Draw(self.image)
-        self.previous_x, self.previous_y = None, None
-
-        self.color_lookup = interpolate_colors(colors)
-        self.pix = self.image.load()
-
-    def draw_peaks(self, x, peaks, spectral_centroid):
-        """ draw 2 peaks at x using the spectral_centroid for color """
-
-        y1 = self.image_height * 0.5 - peaks[0] * (self.image_height - 4) * 0.5
-        y2 = self.image_height * 0.5 - peaks[1] * (self.image_height - 4) * 0.5
-
-        line_color = self.color_lookup[int(spectral_centroid * 255.0)]
-
-        if self.previous_y is not None:
-            self.draw.line([self.previous_x, self.previous_y, x, y1, x, y2], line_color)
-        else:
-            self.draw.line([x, y1, x, y2], line_color)
-
-        self.previous_x, self.previous_y = x, y2
+        self.pixels = numpy.empty((image_height, image_width, 3))
+        self.pixels[:] = self.background_color
 
-        self.draw_anti_aliased_pixels(x, y1, y2, line_color)
+        self.color_lookup = numpy.array(interpolate_colors(colors), dtype=numpy.float64)
 
-    def draw_anti_aliased_pixels(self, x, y1, y2, color):
-        """ vertical anti-aliasing at y1 and y2 """
+    def draw_peaks(self, peaks, spectral_centroids):
+        """ draw the pairs of peaks of all columns using the spectral centroids for color. Every column is drawn
+        as a vertical line between its two peaks, joined to the lines of the neighbouring columns """
 
-        y_max = max(y1, y2)
-        y_max_int = int(y_max)
-        alpha = y_max - y_max_int
+        ys = self.image_height * 0.5 - peaks * (self.image_height - 4) * 0.5
+        y1, y2 = ys[:, 0], ys[:, 1]
+        line_colors = self.color_lookup[(spectral_centroids * 255.0).astype(int)]
 
-        if alpha > 0.0 and alpha < 1.0 and y_max_int + 1 < self.image_height:
-            current_pix = self.pix[x, y_max_int + 1]
+        # the segment joining the second peak of a column with the first peak of the next one is split between both
+        # columns at its midpoint
+        joins = (numpy.append(y1[0], y1[1:]) + numpy.append(y2[0], y2[:-1])) * 0.5
+        joins_next = numpy.append(joins[1:], y2[-1])
+        y_low = numpy.minimum(numpy.minimum(y1, y2), numpy.minimum(joins, joins_next)).astype(int)
+        y_high = numpy.maximum(numpy.maximum(y1, y2), numpy.maximum(joins, joins_next)).astype(int)
 
-            r = int((1 - alpha) * current_pix[0] + alpha * color[0])
-            g = int((1 - alpha) * current_pix[1] + alpha * color[1])
-            b = int((1 - alpha) * current_pix[2] + alpha * color[2])
+        rows = numpy.arange(self.image_height)[:, numpy.newaxis]
+        mask = (rows >= y_low) & (rows <= y_high)
+        self.pixels[mask] = numpy.broadcast_to(line_colors, self.pixels.shape)[mask]
 
-            self.pix[x, y_max_int + 1] = (r, g, b)
+        self.draw_anti_aliased_pixels(y1, y2, line_colors, mask)
 
-        y_min = min(y1, y2)
-        y_min_int = int(y_min)
-        alpha = 1.0 - (y_min - y_min_int)
+    def draw_anti_aliased_pixels(self, y1, y2, colors, mask):
+        """ vertical anti-aliasing below and above the peaks of every column, only for pixels not drawn yet """
 
-        if alpha > 0.0 and alpha < 1.0 and y_min_int - 1 >= 0:
-            current_pix = self.pix[x, y_min_int - 1]
+        columns = numpy.arange(self.image_width)
+        y_max = numpy.maximum(y1, y2)
+        y_min = numpy.minimum(y1, y2)
 
-            r = int((1 - alpha) * current_pix[0] + alpha * color[0])
-            g = int((1 - alpha) * current_pix[1] + alpha * color[1])
-            b = int((1 - alpha) * current_pix[2] + alpha * color[2])
-
-            self.pix[x, y_min_int - 1] = (r, g, b)
+        for rows, alphas in [(y_max.astype(int) + 1, y_max - y_max.astype(int)),
+                             (y_min.astype(int) - 1, 1.0 - (y_min - y_min.astype(int)))]:
+            valid = (alphas > 0.0) & (alphas < 1.0) & (rows >= 0) & (rows < self.image_height)
+            valid[valid] &= ~mask[rows[valid], columns[valid]]
+            r, c, a = rows[valid], columns[valid], alphas[valid][:, numpy.newaxis]
+            self.pixels[r, c] = ((1 - a) * self.pixels[r, c] + a * colors[valid]).astype(int)
 
     def save(self, filename):
         # draw a zero "zero" line
         a = 25
-        for x in range(self.image_width):
-            self.pix[x, self.image_height / 2] = tuple(map(lambda p: p + a, self.pix[x, self.image_height / 2]))
+        self.pixels[self.image_height / 2] += a
 
-        self.image.save(filename)
+        Image.fromarray(self.pixels.clip(0, 255).astype(numpy.uint8), "RGB").save(filename)
 
 
 class SpectrogramImage(object):
@@ -366,42 +502,32 @@ class SpectrogramImage(object):
         self.image_height = image_height
         self.fft_size = fft_size
 
-        self.image = Image.new("RGB", (image_height, image_width))
-        self.palette = interpolate_colors(COLOR_SCHEMES.get(color_scheme,
-                                                            COLOR_SCHEMES[DEFAULT_COLOR_SCHEME_KEY])['spec_colors'])
+        self.palette = numpy.array(interpolate_colors(COLOR_SCHEMES.get(
+            color_scheme, COLOR_SCHEMES[DEFAULT_COLOR_SCHEME_KEY])['spec_colors']), dtype=numpy.uint8)
 
         # generate the lookup which translates y-coordinate to fft-bin
-        self.y_to_bin = []
         f_min = 100.0
         f_max = 22050.0
         y_min = math.log10(f_min)
         y_max = math.log10(f_max)
-        for y in range(self.image_height):
-            freq = math.pow(10.0, y_min + y / (image_height - 1.0) * (y_max - y_min))
-            bin = freq / 22050.0 * (self.fft_size / 2 + 1)
-
-            if bin < self.fft_size / 2:
-                alpha = bin - int(bin)
-
-                self.y_to_bin.append((int(bin), alpha * 255))
+        freqs = numpy.power(10.0, y_min + numpy.arange(image_height) / (image_height - 1.0) * (y_max - y_min))
+        bins = freqs / 22050.0 * (self.fft_size / 2 + 1)
+        bins = bins[bins < self.fft_size / 2]
+        self.y_to_bin = bins.astype(int)
+        self.y_to_alpha = (bins - self.y_to_bin) * 255
 
-        # this is a bit strange, but using image.load()[x,y] = ... is
-        # a lot slower than using image.putadata and then rotating the image
-        # so we store all the pixels in an array and then create the image when saving
-        self.pixels = []
+        # palette indices of the image, one row per frequency (lowest frequency first) and one column per x
+        self.indices = numpy.zeros((image_height, image_width), dtype=int)
 
-    def draw_spectrum(self, x, spectrum):
-        # for all frequencies, draw the pixels
-        for (index, alpha) in self.y_to_bin:
-            self.pixels.append(self.palette[int((255.0 - alpha) * spectrum[index] + alpha * spectrum[index + 1])])
-
-        # if the FFT is too small to fill up the image, fill with black to the top
-        for y in range(len(self.y_to_bin), self.image_height):
-            self.pixels.append(self.palette[0])
+    def draw_spectra(self, spectra):
+        """ draw the spectra of all columns (spectra has one row per column). If the FFT is too small to fill up the
+        image, the top is left filled with black """
+        values = (255.0 - self.y_to_alpha) * spectra[:, self.y_to_bin] + self.y_to_alpha * spectra[:, self.y_to_bin + 1]
+        self.indices[:len(self.y_to_bin)] = values.T.astype(int)
 
     def save(self, filename, quality=80):
-        self.image.putdata(self.pixels)
-        self.image.transpose(Image.ROTATE_90).save(filename, quality=quality)
+        # flip so that low frequencies are at the bottom of the image
+        Image.fromarray(self.palette[self.indices[::-1]], "RGB").save(filename, quality=quality)
 
 
 def create_wave_images(input_filename, output_filename_w, output_filename_s, image_width, image_height, fft_size,
@@ -414,35 +540,52 @@ def create_wave_images(input_filename, output_filename_w, output_filename_s, ima
     :param image_width: width of both spectrogram and waveform images
     :param image_height: height of both spectrogram and waveform images
     :param fft_size: size of the FFT computed for the spectrogram image
-    :param progress_callback: function to iteratively call while images are being created. Will be called every 1%,
-                                with parameters (current_position, width)
+    :param progress_callback: function to call when rendering of the images starts and finishes, with parameters
+                                (current_position, width)
     :param color_scheme: color scheme to use for the generated images (defaults to Freesound2 color scheme)
     """
-    processor = AudioProcessor(input_filename, fft_size, numpy.hanning)
-    samples_per_pixel = processor.nframes / float(image_width)
-
-    waveform = WaveformImage(image_width, image_height, color_scheme)
-    spectrogram = SpectrogramImage(image_width, image_height, fft_size, color_scheme)
+    create_display_images(input_filename,
+                          [(output_filename_w, output_filename_s, image_width, image_height, color_scheme)],
+                          fft_size, progress_callback=progress_callback)
 
-    for x in range(image_width):
 
-        if progress_callback and x % (image_width / 100) == 0:
-            progress_callback(x, image_width)
+def create_display_images(input_filename, displays, fft_size, progress_callback=None, max_in_memory_frames=None):
+    """
+    Utility function for creating several pairs of wavefile and spectrum images (e.g. different sizes and color
+    schemes) from an audio input file. The input file is only decoded once and all images are rendered from the
+    same in-memory audio buffer, or in a single sequential pass over the file for files longer than
+    max_in_memory_frames.
+    :param input_filename: input audio filename (must be PCM)
+    :param displays: list of (output_filename_w, output_filename_s, image_width, image_height, color_scheme) tuples,
+                       one for each pair of waveform and spectrogram images to generate (see create_wave_images)
+    :param fft_size: size of the FFT computed for the spectrogram images
+    :param progress_callback: function to call when rendering of each pair of images starts and finishes, with
+                                parameters (current_position, width)
+    :param max_in_memory_frames: files with more frames than this are read in chunks using StreamingAudioProcessor
+                                   instead of being loaded in memory (defaults to always loading files in memory)
+    """
+    if max_in_memory_frames is not None and get_num_frames(input_filename) > max_in_memory_frames:
+        image_widths = set(image_width for _, _, image_width, _, _ in displays)
+        processor = StreamingAudioProcessor(input_filename, fft_size, image_widths, numpy.hanning)
+    else:
+        processor = AudioProcessor(input_filename, fft_size, numpy.hanning)
 
-        seek_point = int(x * samples_per_pixel)
-        next_seek_point = int((x + 1) * samples_per_pixel)
+    for output_filename_w, output_filename_s, image_width, image_height, color_scheme in displays:
+        if progress_callback:
+            progress_callback(0, image_width)
 
-        (spectral_centroid, db_spectrum) = processor.spectral_centroid(seek_point)
-        peaks = processor.peaks(seek_point, next_seek_point)
+        peaks, spectral_centroids, db_spectra = processor.columns(image_width)
 
-        waveform.draw_peaks(x, peaks, spectral_centroid)
-        spectrogram.draw_spectrum(x, db_spectrum)
+        waveform = WaveformImage(image_width, image_height, color_scheme)
+        waveform.draw_peaks(peaks, spectral_centroids)
+        waveform.save(output_filename_w)
 
-    if progress_callback:
-        progress_callback(image_width, image_width)
+        spectrogram = SpectrogramImage(image_width, image_height, fft_size, color_scheme)
+        spectrogram.draw_spectra(db_spectra)
+        spectrogram.save(output_filename_s)
 
-    waveform.save(output_filename_w)
-    spectrogram.save(output_filename_s)
+        if progress_callback:
+            progress_callback(image_width, image_width)
 
 
 class NoSpaceLeftException(Exception):
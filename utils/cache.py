@@ -18,6 +18,10 @@
 #     See AUTHORS file.
 #
 
+import threading
+import time
+from collections import OrderedDict
+
 from django.core.cache import cache
 from django.core.cache.utils import make_template_fragment_key
 
@@ -38,3 +42,43 @@ def invalidate_user_template_caches(user_id):
     invalidate_template_cache('bw_user_profile_following_count', user_id)
     invalidate_template_cache('bw_user_profile_following_tags_count', user_id)
 
+
+class LocalLRUCache(object):
+    """
+    Small thread-safe in-process cache which keeps at most max_entries items for ttl seconds, discarding the least
+    recently used items first. Useful in front of the shared cache for hot items.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (expiration time, value)
+
+    def get_many(self, keys):
+        """Returns a dictionary with the keys found in the cache and their values."""
+        found = {}
+        now = time.time()
+        with self.lock:
+            for key in keys:
+                entry = self.entries.pop(key, None)
+                if entry is not None and entry[0] > now:
+                    # re-insert so that it becomes the most recently used entry
+                    self.entries[key] = entry
+                    found[key] = entry[1]
+        return found
+
+    def set_many(self, data):
+        if self.max_entries <= 0:
+            return
+        expiration_time = time.time() + self.ttl
+        with self.lock:
+            for key, value in data.items():
+                self.entries.pop(key, None)
+                self.entries[key] = (expiration_time, value)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -45,7 +45,7 @@ def _ensure_list(item):
 
 
 def send_mail(subject, email_body, user_to=None, email_to=None, email_from=None, reply_to=None,
-              email_type_preference_check=None, extra_subject=''):
+              email_type_preference_check=None, extra_subject='', connection=None):
     """Sends email with a lot of defaults.
 
     The function will check if user's email is valid based on bounce info. The function will also check email
@@ -66,6 +66,8 @@ def send_mail(subject, email_body, user_to=None, email_to=None, email_from=None,
         extra_subject (str): extra contents for the email subject which will be appended to the 'subject' param above
             and separated by a dash (this should be used to separate parts of the subject which are not common for a
             given type of email, e.g. to pass the "topic name" in a "topic reply notification" email).
+        connection (EmailBackend): email backend connection used to send the emails. If set to None, a new connection
+            will be created. Passing an already open connection allows reusing it to send many emails.
 
     Returns:
         (bool): True if all emails were sent successfully, False otherwise.
@@ -113,7 +115,8 @@ def send_mail(subject, email_body, user_to=None, email_to=None, email_from=None,
                         for _, email in email_to))
 
         # Replicating send_mass_mail functionality and adding reply-to header if requires
-        connection = get_connection(username=None, password=None, fail_silently=False)
+        if connection is None:
+            connection = get_connection(username=None, password=None, fail_silently=False)
         headers = None
         if reply_to:
             headers = {'Reply-To': reply_to}
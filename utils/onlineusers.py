@@ -22,6 +22,7 @@ from datetime import timedelta, datetime
 from django.core.cache import cache
 
 ONLINE_MINUTES = 10
+UPDATE_MINUTES = 1  # The last seen time of online users is only updated if older than this
 CACHE_KEY = 'online_user_ids'
 
 _last_purged = datetime.now()
@@ -30,18 +31,26 @@ def get_online_users():
     user_dict = cache.get(CACHE_KEY)
     return hasattr(user_dict, 'keys') and user_dict.keys() or []
 
-def cache_online_users(request):
+def cache_online_users(request, not_shown_in_online_users_list=None):
         if request.user.is_anonymous:
             return
+        if not_shown_in_online_users_list is None:
+            not_shown_in_online_users_list = request.user.profile.not_shown_in_online_users_list
         user_dict = cache.get(CACHE_KEY)
         if not user_dict:
             user_dict = {}
         
         now = datetime.now()
+        changed = False
         
         # Check if user has marked the option for not being shown in online users list
-        if not request.user.profile.not_shown_in_online_users_list :
-            user_dict[request.user.id] = now
+        if not not_shown_in_online_users_list:
+            # The last seen time is only updated if it is older than UPDATE_MINUTES so that the dictionary is not
+            # written back to the cache on every request
+            last_seen = user_dict.get(request.user.id, None)
+            if last_seen is None or last_seen + timedelta(minutes=UPDATE_MINUTES) < now:
+                user_dict[request.user.id] = now
+                changed = True
             
         # purge
         global _last_purged
@@ -51,5 +60,7 @@ def cache_online_users(request):
                 if last_seen < purge_older_than:
                     del(user_dict[user_id])
             _last_purged = now
+            changed = True
 
-        cache.set(CACHE_KEY, user_dict, 60*60*24)
+        if changed:
+            cache.set(CACHE_KEY, user_dict, 60*60*24)
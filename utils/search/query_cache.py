@@ -0,0 +1,191 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import hashlib
+import threading
+import time
+import urllib
+import urlparse
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+GENERATION_CACHE_KEY = 'solr-index-generation'
+
+
+def normalize_query_string(query_string):
+    """Returns a normalized version of a Solr query string (as returned by unicode(SolrQuery)) so that equivalent
+    queries which only differ in the order of the parameters share the same cache entry. The relative order of
+    repeated parameters (e.g. several 'fq') is kept."""
+    if isinstance(query_string, unicode):
+        query_string = query_string.encode('utf-8')
+    params = urlparse.parse_qsl(query_string, keep_blank_values=True)
+    params.sort(key=lambda param: param[0])
+    return urllib.urlencode(params)
+
+
+class SolrQueryResultCache(object):
+    """Caches the body of Solr select responses keyed by the normalized query string.
+
+    Entries are kept in an in-process LRU dictionary and expire after ttl seconds. If shared_cache is set to the name
+    of a Django cache (see settings.CACHES), entries are also stored there so that other processes can reuse them.
+    All entries are tagged with the index generation, which is increased by invalidate() every time the index is
+    updated. The generation is kept in the shared cache (so invalidation reaches all processes) and is only re-read
+    every generation_check_interval seconds. Without a shared cache the generation is local to the process and
+    changes made to the index by other processes are only noticed when the entries expire.
+    """
+
+    def __init__(self, max_entries=500, ttl=60, shared_cache=None, generation_check_interval=5,
+                 max_body_size=1024 * 1024):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared_cache = caches[shared_cache] if shared_cache else None
+        self.generation_check_interval = generation_check_interval
+        self.max_body_size = max_body_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # normalized query string -> (expiration time, generation, body)
+        self.generation = 0
+        self.generation_checked = 0
+        self.stats = {
+            'hits': 0,  # lookups served from the in-process cache
+            'shared_hits': 0,  # lookups served from the shared cache
+            'misses': 0,  # lookups which needed a request to Solr
+            'evictions': 0,  # entries removed to keep the cache under max_entries
+            'invalidations': 0,  # number of times the index generation was increased by this process
+        }
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.max_entries > 0
+
+    def get_generation(self):
+        if self.shared_cache is None:
+            return self.generation
+        now = time.time()
+        if now - self.generation_checked >= self.generation_check_interval:
+            self.generation = self.shared_cache.get(GENERATION_CACHE_KEY, 0)
+            self.generation_checked = now
+        return self.generation
+
+    def shared_key(self, key, generation):
+        return 'solr-query:%i:%s' % (generation, hashlib.md5(key).hexdigest())
+
+    def get(self, query_string):
+        """Returns the cached response body for query_string or None if there is no valid entry."""
+        if not self.enabled:
+            return None
+        key = normalize_query_string(query_string)
+        now = time.time()
+        with self.lock:
+            generation = self.get_generation()
+            entry = self.entries.get(key, None)
+            if entry is not None:
+                expiration_time, entry_generation, body = entry
+                if expiration_time > now and entry_generation == generation:
+                    # move to the end so that the entry becomes the most recently used
+                    del self.entries[key]
+                    self.entries[key] = entry
+                    self.stats['hits'] += 1
+                    return body
+                del self.entries[key]
+
+        body = None
+        if self.shared_cache is not None:
+            body = self.shared_cache.get(self.shared_key(key, generation), None)
+
+        with self.lock:
+            if body is not None:
+                self.stats['shared_hits'] += 1
+                self._store(key, generation, body)
+            else:
+                self.stats['misses'] += 1
+        return body
+
+    def set(self, query_string, body):
+        """Stores the response body for query_string. Bodies larger than max_body_size are not stored."""
+        if not self.enabled or len(body) > self.max_body_size:
+            return
+        key = normalize_query_string(query_string)
+        with self.lock:
+            generation = self.get_generation()
+            self._store(key, generation, body)
+        if self.shared_cache is not None:
+            self.shared_cache.set(self.shared_key(key, generation), body, self.ttl)
+
+    def _store(self, key, generation, body):
+        # must be called with the lock held
+        if key in self.entries:
+            del self.entries[key]
+        self.entries[key] = (time.time() + self.ttl, generation, body)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def invalidate(self):
+        """Increases the index generation so that all existing entries (in this and other processes) become
+        invalid. Should be called after documents are added to or deleted from the index."""
+        with self.lock:
+            self.entries.clear()
+            self.stats['invalidations'] += 1
+            if self.shared_cache is None:
+                self.generation += 1
+                return
+        try:
+            generation = self.shared_cache.incr(GENERATION_CACHE_KEY)
+        except ValueError:
+            # the key does not exist yet (or has been evicted from the shared cache)
+            generation = int(time.time())
+            self.shared_cache.set(GENERATION_CACHE_KEY, generation, None)
+        with self.lock:
+            self.generation = generation
+            self.generation_checked = time.time()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self.entries)
+            stats['generation'] = self.generation
+        lookups = stats['hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_ratio'] = float(stats['hits'] + stats['shared_hits']) / lookups if lookups else 0.0
+        return stats
+
+
+_solr_query_cache = None
+_solr_query_cache_lock = threading.Lock()
+
+
+def get_solr_query_cache():
+    """Returns the process-wide Solr query result cache configured with the SOLR_QUERY_CACHE_* settings."""
+    global _solr_query_cache
+    with _solr_query_cache_lock:
+        if _solr_query_cache is None:
+            _solr_query_cache = SolrQueryResultCache(
+                max_entries=settings.SOLR_QUERY_CACHE_MAX_ENTRIES,
+                ttl=settings.SOLR_QUERY_CACHE_TTL,
+                shared_cache=settings.SOLR_QUERY_CACHE_SHARED_CACHE,
+                generation_check_interval=settings.SOLR_QUERY_CACHE_GENERATION_CHECK_INTERVAL,
+                max_body_size=settings.SOLR_QUERY_CACHE_MAX_BODY_SIZE)
+        return _solr_query_cache
+
+
+def get_solr_query_cache_stats():
+    """Returns the stats of the process-wide Solr query result cache (see SolrQueryResultCache.stats)."""
+    return get_solr_query_cache().get_stats()
@@ -18,11 +18,15 @@
 #     See AUTHORS file.
 #
 
+import Queue
+import itertools
 import logging
 import math
+import os
 import random
 import socket
 import json
+import threading
 
 import re
 from django.conf import settings
@@ -33,10 +37,11 @@ import sounds
 from search import forms
 from search.forms import SEARCH_SORT_OPTIONS_WEB
 from utils.search.solr import Solr, SolrQuery, SolrResponseInterpreter, SolrException, \
-    SolrResponseInterpreterPaginator
+    SolrResponseInterpreterPaginator, BaseSolrAddEncoder
 from utils.text import remove_control_chars
 from utils.logging_filters import get_client_ip
 from utils.search.lucene_parser import parse_query_filter_string
+from utils.search.query_cache import get_solr_query_cache
 
 search_logger = logging.getLogger("search")
 console_logger = logging.getLogger("console")
@@ -452,9 +457,17 @@ def perform_solr_query(q, current_page):
     """
     This util function performs the query to Solr and returns needed parameters to continue with the view.
     The main reason to have this util function is to facilitate mocking in unit tests for this view.
+    Responses are cached (see utils.search.query_cache) so that frequent queries (e.g. front page queries with
+    default facets) do not hit Solr every time.
     """
-    solr = Solr(settings.SOLR_URL)
-    results = SolrResponseInterpreter(solr.select(unicode(q)))
+    solr = Solr(settings.SOLR_URL, timeout=settings.SOLR_QUERY_TIMEOUT)
+    query_string = unicode(q)
+    query_cache = get_solr_query_cache()
+    body = query_cache.get(query_string)
+    if body is None:
+        body = solr.select_body(query_string)
+        query_cache.set(query_string, body)
+    results = SolrResponseInterpreter(solr.decode_body(body))
     paginator = SolrResponseInterpreterPaginator(results, settings.SOUNDS_PER_PAGE)
     page = paginator.page(current_page)
     return results.non_grouped_number_of_matches, results.facets, paginator, page, results.docs
@@ -519,60 +532,202 @@ def add_sounds_to_solr(sounds):
     console_logger.info("Adding %d sounds to solr index" % len(documents))
     search_logger.info("Adding %d sounds to solr index" % len(documents))
     solr.add(documents)
+    get_solr_query_cache().invalidate()
 
 
-def add_all_sounds_to_solr(sound_queryset, slice_size=1000, mark_index_clean=False, delete_if_existing=False):
+def add_all_sounds_to_solr(sound_queryset, slice_size=1000, mark_index_clean=False, delete_if_existing=False,
+                           num_converters=2, num_posters=2, max_pending_slices=4, checkpoint_filename=None):
     """
     Add all sounds from the sound_queryset to the Solr index.
+    Sounds are indexed in slices which go through a pipeline of stages running concurrently: the main thread fetches
+    slices of sounds from the DB (using keyset pagination over sound ids), a pool of threads converts them to Solr
+    documents and another pool of threads posts them to Solr. Stages are connected with bounded queues so at most
+    a few slices are held in memory at once. DB writes (marking sounds as clean) are also done in the main thread.
     :param QuerySet sound_queryset: queryset of Sound objects.
     :param int slice_size: sounds are indexed iteratively in chunks of this size.
     :param bool mark_index_clean: if True, set 'is_index_dirty=False' for the indexed sounds' objects.
     :param bool delete_if_existing: if True, delete sounds from Solr index before (re-)indexing them. This is used
     because our sounds include dynamic fields which otherwise might not be properly updated when adding a sound that
     already exists in the Solr index.
+    :param int num_converters: number of threads converting sounds to Solr documents.
+    :param int num_posters: number of threads posting documents to Solr.
+    :param int max_pending_slices: max number of slices waiting in the queue of each stage.
+    :param str checkpoint_filename: if set, the id of the last sound of the slices indexed so far (in order) is saved
+    in this file, and indexing starts after that id if the file exists (e.g. after a failed run). The file is deleted
+    when all sounds have been indexed.
     :return int: number of correctly indexed sounds
     """
-    num_correctly_indexed_sounds = 0
-    all_sound_ids = sound_queryset.values_list('id', flat=True).all()
-    n_slices = int(math.ceil(float(len(all_sound_ids))/slice_size))
-    for i in range(0, len(all_sound_ids), slice_size):
-        console_logger.info("Adding sounds to solr, slice %i of %i", (i/slice_size) + 1, n_slices)
-        try:
-            sound_ids = all_sound_ids[i:i+slice_size]
-            sounds_qs = sounds.models.Sound.objects.bulk_query_solr(sound_ids)
-            if delete_if_existing:
-                delete_sounds_from_solr(sound_ids=sound_ids)
-            add_sounds_to_solr(sounds_qs)
-
+    last_indexed_id = 0
+    if checkpoint_filename and os.path.exists(checkpoint_filename):
+        with open(checkpoint_filename) as checkpoint_file:
+            last_indexed_id = json.load(checkpoint_file)['last_indexed_id']
+        console_logger.info("Resuming indexing after sound with id %i", last_indexed_id)
+    sound_queryset = sound_queryset.filter(id__gt=last_indexed_id)
+    n_slices = int(math.ceil(float(sound_queryset.count()) / slice_size))
+
+    to_convert = Queue.Queue(maxsize=max_pending_slices)
+    to_post = Queue.Queue(maxsize=max_pending_slices)
+    posted = Queue.Queue()
+    errors = []
+
+    def convert_worker():
+        encoder = BaseSolrAddEncoder()
+        for slice_number, sound_ids, sounds_list in iter(to_convert.get, None):
+            if errors:
+                continue  # Keep consuming the queue so that the main thread does not block
+            try:
+                documents = [convert_to_solr_document(s) for s in sounds_list]
+                to_post.put((slice_number, sound_ids, encoder.encode(documents), len(documents)))
+            except Exception as e:
+                errors.append(e)
+
+    def post_worker():
+        solr = Solr(settings.SOLR_URL)
+        for slice_number, sound_ids, encoded_documents, n_documents in iter(to_post.get, None):
+            if errors:
+                continue  # Keep consuming the queue so that converters do not block
+            try:
+                if delete_if_existing:
+                    delete_sounds_from_solr(sound_ids=sound_ids)
+                console_logger.info("Adding %d sounds to solr index (slice %i of %i)",
+                                    n_documents, slice_number + 1, n_slices)
+                search_logger.info("Adding %d sounds to solr index" % n_documents)
+                solr.add_encoded(encoded_documents)
+                posted.put((slice_number, sound_ids))
+            except Exception as e:
+                errors.append(e)
+
+    # Slices can be posted out of order, the checkpoint is only moved forward when all previous slices are posted
+    state = {'num_correctly_indexed_sounds': 0, 'next_slice_to_checkpoint': 0, 'posted_slices': {}}
+
+    def process_posted_slices():
+        while True:
+            try:
+                slice_number, sound_ids = posted.get_nowait()
+            except Queue.Empty:
+                return
             if mark_index_clean:
                 console_logger.info("Marking sounds as clean.")
                 sounds.models.Sound.objects.filter(pk__in=sound_ids).update(is_index_dirty=False)
-            num_correctly_indexed_sounds += len(sound_ids)
-        except SolrException as e:
-            console_logger.error("failed to add sound batch to solr index, reason: %s", str(e))
-            raise
-
-    return num_correctly_indexed_sounds
+            state['num_correctly_indexed_sounds'] += len(sound_ids)
+            state['posted_slices'][slice_number] = sound_ids
+            while state['next_slice_to_checkpoint'] in state['posted_slices']:
+                last_id = state['posted_slices'].pop(state['next_slice_to_checkpoint'])[-1]
+                state['next_slice_to_checkpoint'] += 1
+                if checkpoint_filename:
+                    with open(checkpoint_filename, 'w') as checkpoint_file:
+                        json.dump({'last_indexed_id': last_id}, checkpoint_file)
+
+    workers = [threading.Thread(target=convert_worker) for _ in range(num_converters)] + \
+              [threading.Thread(target=post_worker) for _ in range(num_posters)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    last_fetched_id = last_indexed_id
+    slice_number = 0
+    while not errors:
+        sound_ids = list(sound_queryset.filter(id__gt=last_fetched_id).order_by('id')
+                         .values_list('id', flat=True)[:slice_size])
+        if not sound_ids:
+            break
+        sounds_list = list(sounds.models.Sound.objects.bulk_query_solr(sound_ids))
+        while not errors:
+            try:
+                to_convert.put((slice_number, sound_ids, sounds_list), timeout=1)
+                break
+            except Queue.Full:
+                process_posted_slices()
+        last_fetched_id = sound_ids[-1]
+        slice_number += 1
+        process_posted_slices()
+
+    # Stop workers once all queued slices have been processed
+    for _ in range(num_converters):
+        to_convert.put(None)
+    for worker in workers[:num_converters]:
+        worker.join()
+    for _ in range(num_posters):
+        to_post.put(None)
+    for worker in workers[num_converters:]:
+        worker.join()
+    process_posted_slices()
+    if state['num_correctly_indexed_sounds']:
+        get_solr_query_cache().invalidate()
+
+    if errors:
+        console_logger.error("failed to add sound batch to solr index, reason: %s", str(errors[0]))
+        raise errors[0]
+
+    if checkpoint_filename and os.path.exists(checkpoint_filename):
+        os.remove(checkpoint_filename)
+
+    return state['num_correctly_indexed_sounds']
+
+
+def iter_all_sound_ids_from_solr(page_size=2000):
+    """
+    Generator that yields the ids of all sounds in the Solr index in ascending order. Ids are requested in pages
+    sorted by id, with each page filtered by an id range starting after the last id of the previous page. This way
+    pages don't get slower as we go deeper (as with start/rows paging) and only the id field is retrieved.
+    :param int page_size: number of ids requested to Solr at once
+    """
+    solr = Solr(settings.SOLR_URL)
+    last_id = None
+    while True:
+        query = SolrQuery()
+        query.set_query('*:*')
+        query.set_query_options(start=0, rows=page_size, sort=['id asc'], field_list=['id'],
+                                filter_query='id:[%i TO *]' % (last_id + 1) if last_id is not None else None)
+        response = SolrResponseInterpreter(solr.select(unicode(query)))
+        for element in response.docs:
+            yield element['id']
+        if len(response.docs) < page_size:
+            break
+        last_id = response.docs[-1]['id']
 
 
 def get_all_sound_ids_from_solr(limit=False):
     search_logger.info("getting all sound ids from solr.")
-    if not limit:
-        limit = 99999999999999
-    solr = Solr(settings.SOLR_URL)
-    solr_ids = []
-    solr_count = None
-    PAGE_SIZE = 2000
-    current_page = 1
-    while (len(solr_ids) < solr_count or solr_count is None) and len(solr_ids) < limit:
-        response = SolrResponseInterpreter(
-            solr.select(unicode(search_prepare_query(
-                '', '', search_prepare_sort('created asc', SEARCH_SORT_OPTIONS_WEB), current_page, PAGE_SIZE,
-                include_facets=False))))
-        solr_ids += [element['id'] for element in response.docs]
-        solr_count = response.num_found
-        current_page += 1
-    return sorted(solr_ids)
+    return list(itertools.islice(iter_all_sound_ids_from_solr(), limit if limit else None))
+
+
+def get_solr_index_diff(sound_queryset, page_size=2000):
+    """
+    Compares the ids of the sounds in the Solr index with the ids of the sounds in sound_queryset. Both lists of ids
+    are streamed in ascending order (from Solr and using a DB cursor) and merged, so only the ids which are not in
+    both lists are kept in memory.
+    :param QuerySet sound_queryset: queryset of Sound objects to compare with the Solr index
+    :param int page_size: number of ids requested to Solr at once
+    :return: tuple with the list of ids in Solr but not in sound_queryset, the list of ids in sound_queryset but not
+    in Solr, the number of ids in Solr and the number of ids in sound_queryset
+    """
+    search_logger.info("comparing sound ids from solr with sound ids from db.")
+    solr_ids = iter_all_sound_ids_from_solr(page_size)
+    db_ids = sound_queryset.order_by('id').values_list('id', flat=True).iterator()
+    in_solr_not_in_db = []
+    in_db_not_in_solr = []
+    num_solr_ids = 0
+    num_db_ids = 0
+
+    solr_id = next(solr_ids, None)
+    db_id = next(db_ids, None)
+    while solr_id is not None or db_id is not None:
+        if db_id is None or (solr_id is not None and solr_id < db_id):
+            in_solr_not_in_db.append(solr_id)
+            num_solr_ids += 1
+            solr_id = next(solr_ids, None)
+        elif solr_id is None or db_id < solr_id:
+            in_db_not_in_solr.append(db_id)
+            num_db_ids += 1
+            db_id = next(db_ids, None)
+        else:
+            num_solr_ids += 1
+            num_db_ids += 1
+            solr_id = next(solr_ids, None)
+            db_id = next(db_ids, None)
+
+    return in_solr_not_in_db, in_db_not_in_solr, num_solr_ids, num_db_ids
 
 
 def check_if_sound_exists_in_solr(sound):
@@ -609,6 +764,7 @@ def delete_sound_from_solr(sound_id):
     search_logger.info("deleting sound with id %d" % sound_id)
     try:
         Solr(settings.SOLR_URL).delete_by_id(sound_id)
+        get_solr_query_cache().invalidate()
     except (SolrException, socket.error) as e:
         search_logger.error('could not delete sound with id %s (%s).' % (sound_id, e))
 
@@ -629,3 +785,5 @@ def delete_sounds_from_solr(sound_ids):
         except (SolrException, socket.error) as e:
             search_logger.error('could not delete solr sounds chunk %i of %i' %
                                 (count + 1, int(math.ceil(float(len(sound_ids)) / solr_max_boolean_clause))))
+    if sound_ids:
+        get_solr_query_cache().invalidate()
@@ -21,12 +21,17 @@
 #
 
 from datetime import datetime, date
-from time import strptime
+from time import strptime, time
 from xml.etree import cElementTree as ET
+from StringIO import StringIO
 import itertools, re, urllib
 import httplib, urlparse
+import select
+import threading
 import cjson
-from socket import error
+from socket import error, timeout as socket_timeout
+
+
 class Multidict(dict):
     """A dictionary that represents a query string. If values in the dics are tuples, they are expanded.
     None values are skipped and all values are utf-encoded. We need this because in solr, we can have multiple
@@ -383,8 +388,105 @@ class SolrException(Exception):
     pass
 
 
+class SolrConnectionPool(object):
+    """A thread-safe pool of keep-alive HTTP connections to a Solr server. Connections are returned to the pool
+    after each request (once the response has been fully read) and reused by later requests of any thread, so that
+    requests do not need to open a new TCP connection. Before being reused, idle connections are checked to make sure
+    the server has not closed them and that they have not been idle for more than max_idle_time seconds.
+    """
+
+    def __init__(self, host, port, max_idle_connections=10, max_idle_time=60):
+        self.host = host
+        self.port = port
+        self.max_idle_connections = max_idle_connections
+        self.max_idle_time = max_idle_time
+        self.lock = threading.Lock()
+        self.idle_connections = []  # list of (connection, last used time) tuples
+        self.stats = {
+            'hits': 0,  # requests that reused an idle connection
+            'misses': 0,  # requests that needed a new connection
+            'reconnects': 0,  # requests retried with a new connection after an error in a reused one
+            'discarded': 0,  # idle connections discarded because they were closed or too old
+        }
+
+    def is_healthy(self, conn, last_used):
+        if conn.sock is None or time() - last_used > self.max_idle_time:
+            return False
+        try:
+            # an idle connection should have nothing to read, if it is readable the server closed it
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (select.error, error, ValueError):
+            return False
+        return not readable
+
+    def get(self, timeout=None):
+        """Returns a (connection, reused) tuple with an idle healthy connection (reused is True) or a new one if there
+        is none (reused is False). The timeout (in seconds) is applied to all socket operations of the request.
+        """
+        conn = None
+        with self.lock:
+            while self.idle_connections:
+                candidate, last_used = self.idle_connections.pop()
+                if self.is_healthy(candidate, last_used):
+                    conn = candidate
+                    self.stats['hits'] += 1
+                    break
+                candidate.close()
+                self.stats['discarded'] += 1
+            if conn is None:
+                self.stats['misses'] += 1
+
+        if conn is None:
+            return httplib.HTTPConnection(self.host, self.port, timeout=timeout), False
+        conn.timeout = timeout
+        conn.sock.settimeout(timeout)
+        return conn, True
+
+    def put(self, conn):
+        """Returns a connection to the pool. The response of the last request must have been fully read."""
+        with self.lock:
+            if len(self.idle_connections) < self.max_idle_connections:
+                self.idle_connections.append((conn, time()))
+                return
+        conn.close()
+
+    def count_reconnect(self):
+        with self.lock:
+            self.stats['reconnects'] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['idle_connections'] = len(self.idle_connections)
+        return stats
+
+
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+
+def get_connection_pool(host, port):
+    """Returns the process-wide connection pool for the given Solr host and port, creating it if needed."""
+    with _connection_pools_lock:
+        if (host, port) not in _connection_pools:
+            _connection_pools[(host, port)] = SolrConnectionPool(host, port)
+        return _connection_pools[(host, port)]
+
+
+def get_connection_pools_stats():
+    """Returns a dictionary with the stats of every connection pool (see SolrConnectionPool.stats) keyed by
+    'host:port'."""
+    with _connection_pools_lock:
+        pools = _connection_pools.values()
+    return dict(('%s:%s' % (pool.host, pool.port), pool.get_stats()) for pool in pools)
+
+
 class Solr(object):
-    def __init__(self, url="http://localhost:8983/solr", verbose=False, persistent=False, encoder=BaseSolrAddEncoder(), decoder=SolrJsonResponseDecoder()):
+    def __init__(self, url="http://localhost:8983/solr", verbose=False, persistent=False, encoder=BaseSolrAddEncoder(), decoder=SolrJsonResponseDecoder(), timeout=None):
+        """Creates a Solr client.
+        persistent: use a single connection owned by this client instead of the process-wide connection pool
+        timeout: timeout in seconds for every request (default: no timeout)
+        """
         url_split = urlparse.urlparse(url)
 
         self.host = url_split.hostname
@@ -394,11 +496,14 @@ class Solr(object):
         self.decoder = decoder
         self.encoder = encoder
         self.verbose = verbose
+        self.timeout = timeout
 
         self.persistent = persistent
 
         if self.persistent:
-            self.conn = httplib.HTTPConnection(self.host, self.port)
+            self.conn = httplib.HTTPConnection(self.host, self.port, timeout=timeout)
+        else:
+            self.pool = get_connection_pool(self.host, self.port)
 
     def _request(self, query_string="", message=""):
         if query_string != "":
@@ -411,22 +516,43 @@ class Solr(object):
             print "\tPath:", path
             print "\tSending data:", message
 
-        if self.persistent:
-            conn = self.conn
-        else:
-            conn = httplib.HTTPConnection(self.host, self.port)
-
-        if query_string:
-            conn.request('GET', path)
-        elif message:
-            conn.request('POST', path, message, {'Content-type': 'text/xml'})
-
-        response = conn.getresponse()
+        retried = False
+        while True:
+            if self.persistent:
+                conn, reused = self.conn, False
+            else:
+                conn, reused = self.pool.get(self.timeout)
+
+            try:
+                if query_string:
+                    conn.request('GET', path)
+                elif message:
+                    conn.request('POST', path, message, {'Content-type': 'text/xml'})
+
+                response = conn.getresponse()
+                # read the whole response so that the connection can be reused
+                body = response.read()
+            except (error, httplib.HTTPException) as e:
+                conn.close()
+                # selects are idempotent so they are retried once if a reused connection fails (e.g. if the server
+                # closed it just after the health check). Failures of new connections and timeouts are not retried.
+                if query_string and reused and not retried and not isinstance(e, socket_timeout):
+                    self.pool.count_reconnect()
+                    retried = True
+                    continue
+                raise
+
+            if not self.persistent:
+                if response.will_close:
+                    conn.close()
+                else:
+                    self.pool.put(conn)
+            break
 
         if response.status != 200:
             raise SolrException, response.reason
 
-        return response
+        return StringIO(body)
 
     def select(self, query_string, raw=False):
         if raw:
@@ -434,8 +560,18 @@ class Solr(object):
         else:
             return self.decoder.decode(self._request(query_string=query_string))
 
+    def select_body(self, query_string):
+        """Returns the undecoded body of the response (useful to cache responses, see decode_body)"""
+        return self._request(query_string=query_string).read()
+
+    def decode_body(self, body):
+        return self.decoder.decode(StringIO(body))
+
     def add(self, docs):
-        encoded_docs = self.encoder.encode(docs)
+        self.add_encoded(self.encoder.encode(docs))
+
+    def add_encoded(self, encoded_docs):
+        """Adds documents already encoded with the encoder (useful to encode documents in a different thread)"""
         try:
             self._request(message=encoded_docs)
         except error as e:
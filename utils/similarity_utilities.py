@@ -19,17 +19,29 @@
 #
 
 import logging
+import threading
 import traceback
+from collections import Counter
 
 from django.conf import settings
 from django.core.cache import cache
 
 from similarity.client import Similarity
 from similarity.similarity_settings import PRESETS, DEFAULT_PRESET, SIMILARITY_CACHE_TIME
+from utils.cache import LocalLRUCache
 from utils.encryption import create_hash
 
 web_logger = logging.getLogger('web')
 
+# In-process cache used in front of the shared cache for sound descriptors
+descriptors_local_cache = LocalLRUCache(settings.SIMILARITY_DESCRIPTORS_LOCAL_CACHE_SIZE,
+                                        settings.SIMILARITY_DESCRIPTORS_LOCAL_CACHE_TIME)
+
+# Hit/miss counts of the descriptors cache for each set of requested descriptors (see get_sounds_descriptors_cache_stats)
+MAX_DESCRIPTOR_SETS_IN_STATS = 100
+descriptors_cache_stats = {}
+descriptors_cache_stats_lock = threading.Lock()
+
 
 def get_similar_sounds(sound, preset=DEFAULT_PRESET, num_results=settings.SOUNDS_PER_PAGE, offset=0):
 
@@ -126,34 +138,70 @@ def api_search(target=None, filter=None, preset=None, metric_descriptor_names=No
 
 
 def get_sounds_descriptors(sound_ids, descriptor_names, normalization=True, only_leaf_descriptors=False):
-    cache_key = "analysis-sound-id-%s-descriptors-%s-normalization-%s"
-
-    cached_data = {}
-    # Check if at least some sound analysis data is already on cache
-    not_cached_sound_ids = sound_ids[:]
-    for id in sound_ids:
-        analysis_data = cache.get(hash_cache_key(cache_key % (str(id), ",".join(sorted(descriptor_names)), str(normalization))))
-        if analysis_data:
-            cached_data[unicode(id)] = analysis_data
-            # remove id form list so it is not included in similarity request
-            not_cached_sound_ids.remove(id)
-    try:
-        returned_data = Similarity.get_sounds_descriptors(not_cached_sound_ids, descriptor_names, normalization, only_leaf_descriptors)
-    except Exception as e:
-        web_logger.error('Something wrong occurred with the "get sound descriptors" request (%s)\n\t%s' %\
-                         (e, traceback.format_exc()))
-        raise
+    # The part of the cache key which depends on the requested descriptors is computed once for all sounds
+    cache_key = "analysis-sound-id-%s%s"
+    descriptors_cache_key = "-descriptors-%s-normalization-%s" % (",".join(sorted(descriptor_names)), str(normalization))
+    cache_keys = [hash_cache_key(cache_key % (str(id), descriptors_cache_key)) for id in sound_ids]
+
+    # Check if at least some sound analysis data is already on the local cache and then on the shared cache
+    cached_data = descriptors_local_cache.get_many(cache_keys)
+    n_local_hits = len(cached_data)
+    if len(cached_data) < len(cache_keys):
+        shared_cached_data = cache.get_many([key for key in cache_keys if key not in cached_data])
+        descriptors_local_cache.set_many(shared_cached_data)
+        cached_data.update(shared_cached_data)
+
+    returned_data = {}
+    not_cached_sound_ids = []
+    for id, key in zip(sound_ids, cache_keys):
+        if key in cached_data:
+            returned_data[unicode(id)] = cached_data[key]
+        else:
+            not_cached_sound_ids.append(id)
+    update_descriptors_cache_stats(",".join(sorted(descriptor_names)), n_local_hits,
+                                   len(sound_ids) - n_local_hits - len(not_cached_sound_ids), len(not_cached_sound_ids))
 
-    # save sound analysis information in cache
-    for key, item in returned_data.items():
-        cache.set(hash_cache_key(cache_key % (key, ",".join(sorted(descriptor_names)), str(normalization))),
-                  item, SIMILARITY_CACHE_TIME)
+    if not_cached_sound_ids:
+        try:
+            similarity_data = Similarity.get_sounds_descriptors(
+                not_cached_sound_ids, descriptor_names, normalization, only_leaf_descriptors)
+        except Exception as e:
+            web_logger.error('Something wrong occurred with the "get sound descriptors" request (%s)\n\t%s' %\
+                             (e, traceback.format_exc()))
+            raise
 
-    returned_data.update(cached_data)
+        # save sound analysis information in cache
+        data_to_cache = dict((hash_cache_key(cache_key % (key, descriptors_cache_key)), item)
+                             for key, item in similarity_data.items())
+        cache.set_many(data_to_cache, SIMILARITY_CACHE_TIME)
+        descriptors_local_cache.set_many(data_to_cache)
+        returned_data.update(similarity_data)
 
     return returned_data
 
 
+def update_descriptors_cache_stats(descriptor_set, local_hits, shared_hits, misses):
+    with descriptors_cache_stats_lock:
+        if descriptor_set not in descriptors_cache_stats:
+            if len(descriptors_cache_stats) >= MAX_DESCRIPTOR_SETS_IN_STATS:
+                descriptor_set = 'other'
+            descriptors_cache_stats.setdefault(descriptor_set, Counter())
+        descriptors_cache_stats[descriptor_set].update(local_hits=local_hits, shared_hits=shared_hits, misses=misses)
+
+
+def get_sounds_descriptors_cache_stats():
+    """
+    Returns a dictionary with the hit/miss counts and hit ratio of the descriptors cache (in this process) for each
+    set of requested descriptors.
+    """
+    with descriptors_cache_stats_lock:
+        stats = dict((descriptor_set, dict(counts)) for descriptor_set, counts in descriptors_cache_stats.items())
+    for counts in stats.values():
+        lookups = counts['local_hits'] + counts['shared_hits'] + counts['misses']
+        counts['hit_ratio'] = float(counts['local_hits'] + counts['shared_hits']) / lookups if lookups else 0.0
+    return stats
+
+
 def delete_sound_from_gaia(sound_id):
     web_logger.info("Deleting sound from gaia with id %d" % sound_id)
     try:
@@ -18,6 +18,8 @@
 #     See AUTHORS file.
 #
 
+from __future__ import absolute_import
+
 import json
 import logging
 import traceback
@@ -26,10 +28,13 @@ from hashlib import md5
 from math import ceil
 
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
 from django.core.cache import cache
 from django.http import HttpResponse
 
+from sounds.models import Sound
 from tagrecommendation.client import TagRecommendation
+from tags.models import TaggedItem
 from utils.tags import clean_and_split_tags
 
 web_logger = logging.getLogger('web')
@@ -82,28 +87,26 @@ def get_id_of_last_indexed_sound():
         return -1
 
 
+def get_sounds_tags(sound_ids):
+    """Returns a dictionary with the list of tag names of each of the given sounds (using a single query)"""
+    sound_tags = {sound_id: [] for sound_id in sound_ids}
+    tagged_items = TaggedItem.objects.filter(content_type=ContentType.objects.get_for_model(Sound),
+                                             object_id__in=sound_ids).order_by().values_list('object_id', 'tag__name')
+    for sound_id, tag_name in tagged_items:
+        sound_tags[sound_id].append(tag_name)
+    return sound_tags
+
+
 def post_sounds_to_tagrecommendation_service(sound_qs):
-    data_to_post = []
-    N_SOUNDS_PER_CALL = 10
-    total_calls = int(ceil(float(len(sound_qs))/N_SOUNDS_PER_CALL))
+    N_SOUNDS_PER_CALL = 1000
+    sound_ids = list(sound_qs.values_list('id', flat=True))
+    total_calls = int(ceil(float(len(sound_ids))/N_SOUNDS_PER_CALL))
     print "Sending recommendation data..."
-    idx = 1
-    for count, sound in enumerate(sound_qs):
-        data_to_post.append(
-            (sound.id, list(sound.tags.select_related("tag").values_list('tag__name', flat=True)))
-        )
-        if (count + 1) % N_SOUNDS_PER_CALL == 0:
-            ids = [element[0] for element in data_to_post]
-            tagss = [element[1] for element in data_to_post]
-            print "\tSending group of sounds %i of %i (%i sounds)" % (idx, total_calls, len(ids))
-            idx += 1
-            TagRecommendation.add_to_index(ids, tagss)
-            data_to_post = []
-
-    if data_to_post:
-        ids = [element[0] for element in data_to_post]
-        tagss = [element[1] for element in data_to_post]
-        print "\tSending group of sounds %i of %i (%i sounds)" % (idx, total_calls, len(ids))
+    for idx, start in enumerate(range(0, len(sound_ids), N_SOUNDS_PER_CALL)):
+        ids = sound_ids[start:start + N_SOUNDS_PER_CALL]
+        sound_tags = get_sounds_tags(ids)
+        tagss = [sound_tags[sound_id] for sound_id in ids]
+        print "\tSending group of sounds %i of %i (%i sounds)" % (idx + 1, total_calls, len(ids))
         TagRecommendation.add_to_index(ids, tagss)
 
     print "Finished!"
@@ -139,6 +139,9 @@ override_analysis_path_with_temp_directory = \
 override_sounds_path_with_temp_directory = \
     partial(override_path_with_temp_directory, settings_path_name='SOUNDS_PATH')
 
+override_geotags_tiles_path_with_temp_directory = \
+    partial(override_path_with_temp_directory, settings_path_name='GEOTAGS_TILES_PATH')
+
 override_previews_path_with_temp_directory = \
     partial(override_path_with_temp_directory, settings_path_name='PREVIEWS_PATH')
 
@@ -0,0 +1,161 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import math
+import os
+import wave
+
+import mock
+import numpy
+from PIL import Image
+from django.test import SimpleTestCase
+
+from utils.audioprocessing import processing
+from utils.filesystem import TemporaryDirectory
+
+
+def create_wav_file(path, num_frames, channels=1, samplerate=44100, frequency=1000.0, noise=0.05):
+    """Writes a 16 bit PCM file with a sine of the given frequency whose amplitude grows along the file plus some noise,
+    and returns the samples of the first channel as they are read back (between -1 and 1)"""
+    random_state = numpy.random.RandomState(0)
+    t = numpy.arange(num_frames) / float(samplerate)
+    samples = numpy.linspace(0.1, 0.8, num_frames) * numpy.sin(2 * math.pi * frequency * t) + \
+        noise * random_state.uniform(-1, 1, num_frames)
+    data = (samples * 32767).astype('<i2')
+    interleaved = numpy.repeat(data, channels)
+    if channels > 1:
+        # other channels have a different signal so that only the first channel is used
+        interleaved.reshape(-1, channels)[:, 1:] = 0
+    wav = wave.open(path, 'wb')
+    wav.setnchannels(channels)
+    wav.setsampwidth(2)
+    wav.setframerate(samplerate)
+    wav.writeframes(interleaved.tobytes())
+    wav.close()
+    return data / 32768.0
+
+
+class AudioProcessorTest(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp_directory = TemporaryDirectory()
+        self.wav_path = os.path.join(self.tmp_directory.name, 'test.wav')
+
+    def tearDown(self):
+        self.tmp_directory.cleanup()
+
+    def test_peaks(self):
+        samples = create_wav_file(self.wav_path, 10000)
+        processor = processing.AudioProcessor(self.wav_path, 2048)
+        image_width = 37
+        peaks = processor.peaks(processor.seek_points(image_width))
+
+        # compare with the peaks computed separately for every column
+        seek_points = processor.seek_points(image_width)
+        for column in range(image_width):
+            column_samples = samples[seek_points[column]:seek_points[column + 1]]
+            first, second = sorted([column_samples.argmin(), column_samples.argmax()])
+            self.assertEqual(list(peaks[column]), [column_samples[first], column_samples[second]])
+
+    def test_peaks_in_chunks(self):
+        create_wav_file(self.wav_path, 10000)
+        processor = processing.AudioProcessor(self.wav_path, 2048)
+        for image_width in [1, 37, 15000]:  # 15000 columns have empty ranges
+            seek_points = processor.seek_points(image_width)
+            peaks = processor.peaks(seek_points, max_chunk_size=len(seek_points) * 10000)
+            for max_chunk_size in [1, 100, 999]:
+                numpy.testing.assert_array_equal(processor.peaks(seek_points, max_chunk_size=max_chunk_size), peaks)
+
+    def test_spectral_centroids(self):
+        create_wav_file(self.wav_path, 44100, frequency=1000.0, noise=0)
+        processor = processing.AudioProcessor(self.wav_path, 2048)
+        _, spectral_centroids, db_spectra = processor.columns(20)
+        self.assertEqual(db_spectra.shape, (20, 2048 / 2 + 1))
+        self.assertTrue(((db_spectra >= 0) & (db_spectra <= 1)).all())
+
+        # centroids are log-scaled between 100Hz and 22050Hz
+        frequencies = numpy.power(10, spectral_centroids * (processor.higher_log - processor.lower_log) +
+                                  processor.lower_log)
+        self.assertTrue((abs(frequencies[1:-1] - 1000.0) < 100.0).all())
+
+    def test_create_wave_images(self):
+        create_wav_file(self.wav_path, 20000)
+        output_filename_w = os.path.join(self.tmp_directory.name, 'wave.png')
+        output_filename_s = os.path.join(self.tmp_directory.name, 'spectral.jpg')
+        progress = []
+        processing.create_wave_images(self.wav_path, output_filename_w, output_filename_s, 120, 71, 2048,
+                                      progress_callback=lambda position, width: progress.append((position, width)))
+        self.assertEqual(Image.open(output_filename_w).size, (120, 71))
+        self.assertEqual(Image.open(output_filename_s).size, (120, 71))
+        self.assertEqual(progress, [(0, 120), (120, 120)])
+
+    def assert_same_columns(self, processor, streaming_processor, image_width):
+        peaks, spectral_centroids, db_spectra = processor.columns(image_width)
+        streaming_peaks, streaming_spectral_centroids, streaming_db_spectra = streaming_processor.columns(image_width)
+        numpy.testing.assert_array_equal(streaming_peaks, peaks)
+        numpy.testing.assert_allclose(streaming_spectral_centroids, spectral_centroids, atol=1e-9)
+        numpy.testing.assert_allclose(streaming_db_spectra, db_spectra, atol=1e-9)
+
+    def test_streaming_audio_processor(self):
+        image_widths = [120, 900, 195]
+        for num_frames, channels, chunk_size in [(50000, 1, 4096), (50000, 2, 1000), (1000, 1, 333), (500, 1, 4096)]:
+            create_wav_file(self.wav_path, num_frames, channels=channels)
+            processor = processing.AudioProcessor(self.wav_path, 2048)
+            streaming_processor = processing.StreamingAudioProcessor(self.wav_path, 2048, image_widths,
+                                                                     chunk_size=chunk_size)
+            for image_width in image_widths:
+                self.assert_same_columns(processor, streaming_processor, image_width)
+
+    def test_waveform_matches_reference(self):
+        # waveform_reference.png was rendered from this file by the renderer which drew each column with PIL lines.
+        # Joins between columns are now drawn differently, so some pixels differ slightly.
+        create_wav_file(self.wav_path, 200000)
+        output_filename_w = os.path.join(self.tmp_directory.name, 'wave.png')
+        output_filename_s = os.path.join(self.tmp_directory.name, 'spectral.jpg')
+        processing.create_wave_images(self.wav_path, output_filename_w, output_filename_s, 500, 201, 2048)
+
+        reference = numpy.asarray(Image.open(os.path.join(os.path.dirname(__file__), 'data', 'waveform_reference.png'))
+                                  .convert('RGB')).astype(int)
+        waveform = numpy.asarray(Image.open(output_filename_w).convert('RGB')).astype(int)
+        self.assertEqual(waveform.shape, reference.shape)
+        differences = numpy.abs(waveform - reference)
+        self.assertLess(differences.any(axis=2).mean(), 0.08)
+        self.assertLess(differences.mean(), 0.1)
+
+    def test_create_display_images_max_in_memory_frames(self):
+        create_wav_file(self.wav_path, 30000)
+        displays = []
+        for name in ['in_memory', 'streaming']:
+            displays.append([(os.path.join(self.tmp_directory.name, '%s_%s_w.png' % (name, image_width)),
+                              os.path.join(self.tmp_directory.name, '%s_%s_s.jpg' % (name, image_width)),
+                              image_width, 71, None) for image_width in [120, 900]])
+
+        with mock.patch('utils.audioprocessing.processing.StreamingAudioProcessor',
+                        wraps=processing.StreamingAudioProcessor) as streaming_processor:
+            processing.create_display_images(self.wav_path, displays[0], 2048, max_in_memory_frames=30000)
+            streaming_processor.assert_not_called()
+            processing.create_display_images(self.wav_path, displays[1], 2048, max_in_memory_frames=29999)
+            streaming_processor.assert_called_once_with(self.wav_path, 2048, set([120, 900]), numpy.hanning)
+
+        # both paths render the same images
+        for in_memory_display, streaming_display in zip(*displays):
+            for in_memory_filename, streaming_filename in zip(in_memory_display[:2], streaming_display[:2]):
+                numpy.testing.assert_array_equal(numpy.asarray(Image.open(streaming_filename)),
+                                                 numpy.asarray(Image.open(in_memory_filename)))
@@ -18,19 +18,33 @@
 # Authors:
 #     See AUTHORS file.
 #
-from django.test import TestCase, override_settings
+import json
+import os
+import threading
+from xml.etree import cElementTree as ET
+
+import mock
+from django.core.management import call_command
+from django.test import TestCase, SimpleTestCase, override_settings
 from django.test.client import RequestFactory
 from django.urls import reverse
 from django.conf import settings
 from django.utils.http import urlquote_plus
+from sounds.models import Sound
+from utils.filesystem import TemporaryDirectory
 from utils.search.search_general import search_prepare_parameters, split_filter_query, \
-    search_prepare_query, remove_facet_filters
+    search_prepare_query, remove_facet_filters, get_solr_index_diff, add_all_sounds_to_solr
+from utils.search.solr import SolrException
 from utils.search.lucene_parser import parse_query_filter_string
+from utils.search.query_cache import SolrQueryResultCache, normalize_query_string
+from utils.test_helpers import create_user_and_sounds
 from search.forms import SEARCH_DEFAULT_SORT, SEARCH_SORT_OPTIONS_WEB
 
 
 class SearchUtilsTest(TestCase):
 
+    fixtures = ['licenses']
+
     def setUp(self):
         self.factory = RequestFactory()
 
@@ -362,4 +376,141 @@ class SearchUtilsTest(TestCase):
 
         query = search_prepare_query(**query_params)
         self.assertEqual(query.params['fq'], "duration:[1 TO 10] is_geotagged:1 AND (id:1 OR id:2 OR id:3)")
-        
\ No newline at end of file
+        
+
+    @mock.patch('utils.search.search_general.iter_all_sound_ids_from_solr')
+    def test_get_solr_index_diff(self, iter_all_sound_ids_from_solr):
+        # we test that ids streamed from solr and db are correctly merged.
+        _, _, sounds = create_user_and_sounds(num_sounds=4)
+        sound_ids = sorted([sound.id for sound in sounds])
+        iter_all_sound_ids_from_solr.return_value = iter([sound_ids[0], sound_ids[2], sound_ids[3] + 100])
+
+        in_solr_not_in_db, in_db_not_in_solr, num_solr_ids, num_db_ids = get_solr_index_diff(Sound.objects.all())
+        self.assertEqual(in_solr_not_in_db, [sound_ids[3] + 100])
+        self.assertEqual(in_db_not_in_solr, [sound_ids[1], sound_ids[3]])
+        self.assertEqual(num_solr_ids, 3)
+        self.assertEqual(num_db_ids, 4)
+
+
+class AddAllSoundsToSolrTest(TestCase):
+
+    fixtures = ['licenses']
+
+    def setUp(self):
+        _, _, sounds = create_user_and_sounds(num_sounds=10)
+        self.sound_ids = sorted(sound.id for sound in sounds)
+        self.posted_ids = []
+        self.posted_ids_lock = threading.Lock()
+
+    def fake_add_encoded(self, encoded_documents):
+        with self.posted_ids_lock:
+            self.posted_ids += [int(field.text) for field in
+                                ET.fromstring(encoded_documents).findall("doc/field[@name='id']")]
+
+    def failing_add_encoded(self, fail_after_slices):
+        # Posts the first fail_after_slices slices and raises an exception for the rest
+        num_calls = [0]
+
+        def add_encoded(encoded_documents):
+            num_calls[0] += 1
+            if num_calls[0] > fail_after_slices:
+                raise SolrException('Solr is down')
+            self.fake_add_encoded(encoded_documents)
+        return add_encoded
+
+    @mock.patch('utils.search.search_general.Solr')
+    def test_all_sounds_posted_once(self, solr):
+        solr.return_value.add_encoded.side_effect = self.fake_add_encoded
+        num_indexed = add_all_sounds_to_solr(Sound.objects.all(), slice_size=3, mark_index_clean=True,
+                                             num_converters=2, num_posters=3, max_pending_slices=1)
+        self.assertEqual(num_indexed, 10)
+        self.assertEqual(sorted(self.posted_ids), self.sound_ids)
+        self.assertFalse(Sound.objects.filter(is_index_dirty=True).exists())
+
+    @mock.patch('utils.search.search_general.convert_to_solr_document', side_effect=ValueError('Bad sound'))
+    @mock.patch('utils.search.search_general.Solr')
+    def test_converter_exception(self, solr, convert_to_solr_document):
+        with self.assertRaises(ValueError):
+            add_all_sounds_to_solr(Sound.objects.all(), slice_size=3, max_pending_slices=1)
+        solr.return_value.add_encoded.assert_not_called()
+
+    @mock.patch('utils.search.search_general.get_solr_index_diff', return_value=([], [], 0, 0))
+    @mock.patch('utils.search.search_general.delete_sounds_from_solr')
+    @mock.patch('utils.search.search_general.Solr')
+    def test_resume_from_checkpoint(self, solr, delete_sounds_from_solr, get_solr_index_diff):
+        Sound.objects.all().update(processing_state='OK', moderation_state='OK')
+        with TemporaryDirectory() as tmp_directory:
+            checkpoint_filename = os.path.join(tmp_directory, 'checkpoint.json')
+
+            # An exception in a poster thread makes the command fail, sounds posted until then are checkpointed
+            solr.return_value.add_encoded.side_effect = self.failing_add_encoded(fail_after_slices=2)
+            with self.assertRaises(SolrException):
+                add_all_sounds_to_solr(Sound.objects.all(), slice_size=3, num_converters=1, num_posters=1,
+                                       checkpoint_filename=checkpoint_filename)
+            self.assertEqual(sorted(self.posted_ids), self.sound_ids[:6])
+            with open(checkpoint_filename) as checkpoint_file:
+                self.assertEqual(json.load(checkpoint_file), {'last_indexed_id': self.sound_ids[5]})
+
+            # Same from the reindex_solr command
+            self.posted_ids = []
+            solr.return_value.add_encoded.side_effect = self.failing_add_encoded(fail_after_slices=0)
+            with self.assertRaises(SolrException):
+                call_command('reindex_solr', checkpoint=checkpoint_filename)
+            self.assertEqual(self.posted_ids, [])
+
+            # A new run starts after the last checkpointed sound and deletes the checkpoint when it finishes
+            solr.return_value.add_encoded.side_effect = self.fake_add_encoded
+            call_command('reindex_solr', checkpoint=checkpoint_filename, num_converters=1, num_posters=1)
+            self.assertEqual(sorted(self.posted_ids), self.sound_ids[6:])
+            self.assertFalse(os.path.exists(checkpoint_filename))
+
+
+class SolrQueryResultCacheTest(SimpleTestCase):
+
+    def test_normalize_query_string(self):
+        # parameter order does not matter, but the order of repeated parameters is kept
+        self.assertEqual(normalize_query_string(u'rows=10&q=dog&fq=a&fq=b'),
+                         normalize_query_string(u'fq=a&q=dog&fq=b&rows=10'))
+        self.assertNotEqual(normalize_query_string(u'q=dog&sort=a&sort=b'),
+                            normalize_query_string(u'q=dog&sort=b&sort=a'))
+
+    def test_get_set(self):
+        query_cache = SolrQueryResultCache(max_entries=2, ttl=60)
+        self.assertIsNone(query_cache.get(u'q=dog&rows=10'))
+        query_cache.set(u'q=dog&rows=10', '{"response": {}}')
+        self.assertEqual(query_cache.get(u'rows=10&q=dog'), '{"response": {}}')
+        stats = query_cache.get_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_lru_eviction(self):
+        query_cache = SolrQueryResultCache(max_entries=2, ttl=60)
+        query_cache.set(u'q=a', 'a')
+        query_cache.set(u'q=b', 'b')
+        query_cache.get(u'q=a')  # q=a becomes the most recently used entry
+        query_cache.set(u'q=c', 'c')
+        self.assertEqual(query_cache.get(u'q=a'), 'a')
+        self.assertIsNone(query_cache.get(u'q=b'))
+        self.assertEqual(query_cache.get_stats()['evictions'], 1)
+
+    @mock.patch('utils.search.query_cache.time.time')
+    def test_ttl(self, time_mock):
+        time_mock.return_value = 1000
+        query_cache = SolrQueryResultCache(ttl=60)
+        query_cache.set(u'q=dog', 'dog')
+        time_mock.return_value = 1059
+        self.assertEqual(query_cache.get(u'q=dog'), 'dog')
+        time_mock.return_value = 1061
+        self.assertIsNone(query_cache.get(u'q=dog'))
+
+    def test_invalidate(self):
+        query_cache = SolrQueryResultCache(shared_cache='default', generation_check_interval=0)
+        other_process_cache = SolrQueryResultCache(shared_cache='default', generation_check_interval=0)
+        query_cache.set(u'q=dog', 'dog')
+        # entries are shared between processes through the shared cache
+        self.assertEqual(other_process_cache.get(u'q=dog'), 'dog')
+        self.assertEqual(other_process_cache.get_stats()['shared_hits'], 1)
+        # invalidation in one process invalidates the entries of all processes
+        query_cache.invalidate()
+        self.assertIsNone(other_process_cache.get(u'q=dog'))
+        self.assertIsNone(query_cache.get(u'q=dog'))
@@ -0,0 +1,153 @@
+#
+# Freesound is (c) MUSIC TECHNOLOGY GROUP, UNIVERSITAT POMPEU FABRA
+#
+# Freesound is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Freesound is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     See AUTHORS file.
+#
+
+import httplib
+import socket
+import time
+
+import mock
+from django.test import SimpleTestCase
+
+from utils.search.solr import Solr, SolrConnectionPool
+
+
+class SolrConnectionPoolTest(SimpleTestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.pool = SolrConnectionPool('127.0.0.1', self.server.getsockname()[1], max_idle_connections=2,
+                                       max_idle_time=60)
+
+    def tearDown(self):
+        self.server.close()
+
+    def connect(self):
+        """Returns a connection to the test server and the server side socket of the connection"""
+        conn = httplib.HTTPConnection(self.pool.host, self.pool.port)
+        conn.connect()
+        peer, _ = self.server.accept()
+        return conn, peer
+
+    def test_health_check(self):
+        conn, peer = self.connect()
+        self.assertTrue(self.pool.is_healthy(conn, time.time()))
+        self.assertFalse(self.pool.is_healthy(conn, time.time() - 61))  # Idle for too long
+        peer.close()
+        self.assertFalse(self.pool.is_healthy(conn, time.time()))  # Closed by the server
+        conn.close()
+        self.assertFalse(self.pool.is_healthy(conn, time.time()))  # Closed by the client
+
+    def test_reuse(self):
+        conn, reused = self.pool.get(timeout=5)
+        self.assertFalse(reused)
+        self.assertIsNone(conn.sock)  # New connections are opened by their first request
+        self.assertEqual(conn.timeout, 5)
+
+        conn, peer = self.connect()
+        self.pool.put(conn)
+        reused_conn, reused = self.pool.get(timeout=10)
+        self.assertTrue(reused)
+        self.assertIs(reused_conn, conn)
+        self.assertEqual(conn.sock.gettimeout(), 10)
+
+        # Connections closed by the server are discarded
+        self.pool.put(conn)
+        peer.close()
+        new_conn, reused = self.pool.get()
+        self.assertFalse(reused)
+        self.assertIsNot(new_conn, conn)
+        self.assertIsNone(conn.sock)
+
+        # Only max_idle_connections are kept
+        connections = [self.connect() for _ in range(3)]
+        for conn, _ in connections:
+            self.pool.put(conn)
+        self.assertEqual(len(self.pool.idle_connections), 2)
+        self.assertIsNone(connections[2][0].sock)
+
+        stats = self.pool.get_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['discarded'], 1)
+        self.assertEqual(stats['idle_connections'], 2)
+
+
+class SolrRequestTest(SimpleTestCase):
+
+    def setUp(self):
+        self.solr = Solr('http://fakehost:8080/fs2')
+        self.solr.pool = mock.Mock(spec=SolrConnectionPool)
+
+    def create_connection(self, will_close=False, error=None):
+        conn = mock.Mock(spec=httplib.HTTPConnection)
+        if error is not None:
+            conn.request.side_effect = error
+        else:
+            conn.getresponse.return_value.status = 200
+            conn.getresponse.return_value.will_close = will_close
+            conn.getresponse.return_value.read.return_value = '{}'
+        return conn
+
+    def test_connection_returned_to_pool(self):
+        conn = self.create_connection()
+        self.solr.pool.get.return_value = (conn, True)
+        self.assertEqual(self.solr.select_body('q=test'), '{}')
+        self.solr.pool.put.assert_called_once_with(conn)
+        conn.close.assert_not_called()
+
+    def test_connection_closed_if_response_will_close(self):
+        conn = self.create_connection(will_close=True)
+        self.solr.pool.get.return_value = (conn, True)
+        self.assertEqual(self.solr.select_body('q=test'), '{}')
+        self.solr.pool.put.assert_not_called()
+        conn.close.assert_called_once_with()
+
+    def test_select_retried_if_reused_connection_fails(self):
+        failed_conn = self.create_connection(error=socket.error('Connection reset by peer'))
+        conn = self.create_connection()
+        self.solr.pool.get.side_effect = [(failed_conn, True), (conn, False)]
+        self.assertEqual(self.solr.select_body('q=test'), '{}')
+        failed_conn.close.assert_called_once_with()
+        self.solr.pool.count_reconnect.assert_called_once_with()
+        self.solr.pool.put.assert_called_once_with(conn)
+
+    def test_select_retried_only_once(self):
+        self.solr.pool.get.side_effect = [(self.create_connection(error=socket.error()), True),
+                                          (self.create_connection(error=socket.error()), True)]
+        with self.assertRaises(socket.error):
+            self.solr.select_body('q=test')
+        self.assertEqual(self.solr.pool.get.call_count, 2)
+
+    def test_requests_not_retried(self):
+        for reused, error, query_string in [
+            (False, socket.error('Connection refused'), 'q=test'),  # New connection
+            (True, socket.timeout('timed out'), 'q=test'),  # Timeout
+            (True, socket.error('Connection reset by peer'), ''),  # Not a select
+        ]:
+            self.solr.pool.reset_mock()
+            conn = self.create_connection(error=error)
+            self.solr.pool.get.side_effect = [(conn, reused)]
+            with self.assertRaises(socket.error):
+                self.solr._request(query_string=query_string, message='<commit/>')
+            self.assertEqual(self.solr.pool.get.call_count, 1)
+            conn.close.assert_called_once_with()
+            self.solr.pool.count_reconnect.assert_not_called()
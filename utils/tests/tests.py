@@ -21,12 +21,13 @@
 import datetime
 import os
 import shutil
+import threading
 
 import mock
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import cache
-from django.test import TestCase, override_settings
+from django.test import TestCase, SimpleTestCase, override_settings
 from django.urls import reverse
 
 import utils.downloads
@@ -36,8 +37,10 @@ from utils.audioprocessing.freesound_audio_analysis import FreesoundAudioAnalyze
 from utils.audioprocessing.freesound_audio_processing import FreesoundAudioProcessor
 from utils.audioprocessing.processing import AudioProcessingException
 from utils.filesystem import create_directories
+from utils.similarity_utilities import get_sounds_descriptors, descriptors_local_cache
 from utils.sound_upload import get_csv_lines, validate_input_csv_file, bulk_describe_from_csv, create_sound, \
     NoAudioException, AlreadyExistsException
+from utils.tagrecommendation_utilities import post_sounds_to_tagrecommendation_service
 from utils.tags import clean_and_split_tags
 from utils.test_helpers import create_test_files, create_user_and_sounds, override_uploads_path_with_temp_directory, \
     override_csv_path_with_temp_directory, override_sounds_path_with_temp_directory, \
@@ -508,13 +511,12 @@ def convert_to_ogg_mock_fail(input_filename, output_filename, quality):
     raise AudioProcessingException("conversion to ogg (preview) has failed")
 
 
-def create_wave_images_mock(
-        input_filename, output_filename_w, output_filename_s, image_width, image_height, fft_size, **kwargs):
-    create_test_files(paths=[output_filename_w, output_filename_s])
+def create_display_images_mock(input_filename, displays, fft_size, **kwargs):
+    for output_filename_w, output_filename_s, _, _, _ in displays:
+        create_test_files(paths=[output_filename_w, output_filename_s])
 
 
-def create_wave_images_mock_fail(
-        input_filename, output_filename_w, output_filename_s, image_width, image_height, fft_size, **kwargs):
+def create_display_images_mock_fail(input_filename, displays, fft_size, **kwargs):
     raise AudioProcessingException("creation of display images has failed")
 
 
@@ -661,7 +663,32 @@ class AudioProcessingTestCase(TestCase):
         self.assertIn('conversion to ogg (preview) has failed', self.sound.processing_log)
         self.assertFalse(len(os.listdir(settings.PROCESSING_TEMP_DIR)), 0)
 
-    @mock.patch('utils.audioprocessing.processing.create_wave_images', side_effect=create_wave_images_mock_fail)
+    @mock.patch('utils.audioprocessing.processing.create_display_images', side_effect=create_display_images_mock)
+    @mock.patch('utils.audioprocessing.processing.convert_to_ogg', side_effect=convert_to_ogg_mock_fail)
+    @mock.patch('utils.audioprocessing.processing.convert_to_mp3', side_effect=convert_to_mp3_mock_fail)
+    @mock.patch('utils.audioprocessing.processing.stereofy_and_find_info', side_effect=stereofy_mock)
+    @mock.patch('utils.audioprocessing.processing.convert_to_pcm', side_effect=convert_to_pcm_mock)
+    @override_settings(USE_PREVIEWS_WHEN_ORIGINAL_FILES_MISSING=False)
+    @override_processing_tmp_path_with_temp_directory
+    @override_sounds_path_with_temp_directory
+    @override_previews_path_with_temp_directory
+    @override_displays_path_with_temp_directory
+    def test_make_previews_several_fail(self, *args):
+        self.pre_test()
+        num_threads = threading.active_count()
+        result = FreesoundAudioProcessor(sound_id=Sound.objects.first().id).process()
+        # processing will fail because both convert_to_mp3 and convert_to_ogg mocks raise an exception, as previews
+        # are generated concurrently the errors of all failed previews are logged
+        self.assertFalse(result)  # Processing failed, retutned False
+        self.assertEqual(threading.active_count(), num_threads)  # The threads of the encoders pool have finished
+        self.sound.refresh_from_db()
+        self.assertEqual(self.sound.processing_state, "FA")
+        self.assertEqual(self.sound.processing_ongoing_state, "FI")
+        self.assertIn('conversion to mp3 (preview) has failed', self.sound.processing_log)
+        self.assertIn('conversion to ogg (preview) has failed', self.sound.processing_log)
+        self.assertFalse(len(os.listdir(settings.PROCESSING_TEMP_DIR)), 0)
+
+    @mock.patch('utils.audioprocessing.processing.create_display_images', side_effect=create_display_images_mock_fail)
     @mock.patch('utils.audioprocessing.processing.convert_to_ogg', side_effect=convert_to_ogg_mock)
     @mock.patch('utils.audioprocessing.processing.convert_to_mp3', side_effect=convert_to_mp3_mock)
     @mock.patch('utils.audioprocessing.processing.stereofy_and_find_info', side_effect=stereofy_mock)
@@ -674,7 +701,7 @@ class AudioProcessingTestCase(TestCase):
     def test_create_images_fails(self, *args):
         self.pre_test()
         result = FreesoundAudioProcessor(sound_id=Sound.objects.first().id).process()
-        # processing will fail because create_wave_images mock raises an exception
+        # processing will fail because create_display_images mock raises an exception
         self.assertFalse(result)  # Processing failed, retutned False
         self.sound.refresh_from_db()
         self.assertEqual(self.sound.processing_state, "FA")
@@ -682,7 +709,7 @@ class AudioProcessingTestCase(TestCase):
         self.assertIn('creation of display images has failed', self.sound.processing_log)
         self.assertFalse(len(os.listdir(settings.PROCESSING_TEMP_DIR)), 0)
 
-    @mock.patch('utils.audioprocessing.processing.create_wave_images', side_effect=create_wave_images_mock)
+    @mock.patch('utils.audioprocessing.processing.create_display_images', side_effect=create_display_images_mock)
     @mock.patch('utils.audioprocessing.processing.convert_to_ogg', side_effect=convert_to_ogg_mock)
     @mock.patch('utils.audioprocessing.processing.convert_to_mp3', side_effect=convert_to_mp3_mock)
     @mock.patch('utils.audioprocessing.processing.stereofy_and_find_info', side_effect=stereofy_mock)
@@ -716,7 +743,7 @@ class AudioProcessingTestCase(TestCase):
         self.assertEqual(self.sound.processing_ongoing_state, "FI")
         self.assertFalse(len(os.listdir(settings.PROCESSING_TEMP_DIR)), 0)
 
-    @mock.patch('utils.audioprocessing.processing.create_wave_images', side_effect=create_wave_images_mock)
+    @mock.patch('utils.audioprocessing.processing.create_display_images', side_effect=create_display_images_mock)
     @mock.patch('utils.audioprocessing.processing.convert_to_ogg', side_effect=convert_to_ogg_mock)
     @mock.patch('utils.audioprocessing.processing.convert_to_mp3', side_effect=convert_to_mp3_mock)
     @mock.patch('utils.audioprocessing.processing.stereofy_and_find_info', side_effect=stereofy_mock)
@@ -842,3 +869,48 @@ class AudioAnalysisTestCase(TestCase):
         self.sound.refresh_from_db()
         self.assertEqual(self.sound.analysis_state, "OK")
         self.assertFalse(len(os.listdir(settings.PROCESSING_TEMP_DIR)), 0)
+
+
+class SoundsDescriptorsCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        descriptors_local_cache.clear()
+
+    @mock.patch('utils.similarity_utilities.Similarity.get_sounds_descriptors')
+    def test_get_sounds_descriptors_cache(self, similarity_get_sounds_descriptors):
+        similarity_get_sounds_descriptors.return_value = {u'1': {'a': 1}, u'2': {'a': 2}}
+        data = get_sounds_descriptors([1, 2], ['.a'], only_leaf_descriptors=True)
+        self.assertEqual(data, {u'1': {'a': 1}, u'2': {'a': 2}})
+        similarity_get_sounds_descriptors.assert_called_once_with([1, 2], ['.a'], True, True)
+
+        # Only sounds which are not cached are requested to the similarity server
+        similarity_get_sounds_descriptors.reset_mock()
+        similarity_get_sounds_descriptors.return_value = {u'3': {'a': 3}}
+        data = get_sounds_descriptors([1, 2, 3], ['.a'], only_leaf_descriptors=True)
+        self.assertEqual(data, {u'1': {'a': 1}, u'2': {'a': 2}, u'3': {'a': 3}})
+        similarity_get_sounds_descriptors.assert_called_once_with([3], ['.a'], True, True)
+
+        # Sounds in the shared cache are found even if they are not in the local cache
+        descriptors_local_cache.clear()
+        similarity_get_sounds_descriptors.reset_mock()
+        data = get_sounds_descriptors([1, 3], ['.a'], only_leaf_descriptors=True)
+        self.assertEqual(data, {u'1': {'a': 1}, u'3': {'a': 3}})
+        similarity_get_sounds_descriptors.assert_not_called()
+
+
+class PostSoundsToTagRecommendationTest(TestCase):
+
+    fixtures = ['licenses']
+
+    @mock.patch('utils.tagrecommendation_utilities.TagRecommendation.add_to_index')
+    def test_post_sounds_to_tagrecommendation_service(self, add_to_index):
+        _, _, sounds = create_user_and_sounds(num_sounds=3, tags="tag1 tag2")
+        sounds[2].set_tags([])
+        post_sounds_to_tagrecommendation_service(Sound.objects.all().order_by('id'))
+
+        # All sounds are sent in a single call with their tags
+        self.assertEqual(add_to_index.call_count, 1)
+        ids, tagss = add_to_index.call_args[0]
+        self.assertEqual(ids, [sound.id for sound in sounds])
+        self.assertEqual([sorted(tags) for tags in tagss], [['tag1', 'tag2'], ['tag1', 'tag2'], []])